@@ -30,7 +30,7 @@ class ScrambleEbookActionBase(InterfaceActionBase):
     supported_platforms = ['windows', 'osx', 'linux']
     author              = 'jackie_w'
     version             = PLUGIN_VERSION_TUPLE
-    minimum_calibre_version = (3, 47, 1)
+    minimum_calibre_version = (5, 0, 0)
 
     #: This field defines the GUI plugin class that contains all the code
     #: that actually does something. Its format is module_path:class_name
@@ -43,5 +43,10 @@ class ScrambleEbookActionBase(InterfaceActionBase):
         return False
 
     def cli_main(self, argv):
+        # headless commands do not need Qt, anything else opens the dialog
+        from calibre_plugins.scrambleebook_plugin.cli import COMMANDS
+        if len(argv) > 1 and argv[1] in COMMANDS:
+            from calibre_plugins.scrambleebook_plugin.cli import main
+            return main(argv[1:])
         from calibre_plugins.scrambleebook_plugin.scrambleebook import main
-        main('this came from a .zip', argv[1:])
\ No newline at end of file
+        main('this came from a .zip', argv[1:])
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Resumable batch scrambling. Every change in a book's state is appended to
+# a journal file (one JSON object per line) and fsync'd before moving on,
+# so a batch killed at any point can be restarted with the same command:
+# committed books are skipped, books which failed or were interrupted are
+# retried until they have failed max_failures times.
+#
+# A scrambled book is written to a staging directory inside the output
+# directory and only renamed into place when complete, so the output
+# directory never holds a partial book. Of two books with the same name,
+# the second one to finish gets a short hash of its path in its name.
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.scrambleebook_plugin.metrics import failed_book_record
+from calibre_plugins.scrambleebook_plugin.scramblecore import (get_book_format,
+    scramble_ebook)
+
+QUEUED, STARTED, COMMITTED, FAILED = 'queued', 'started', 'committed', 'failed'
+STAGING_DIR = '.scrambleebook-partial'
+
+def fsync_path(path):
+    # make a file, or a directory entry, durable
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except EnvironmentError:
+        return
+    try:
+        os.fsync(fd)
+    except EnvironmentError:
+        # directories cannot be fsync'd on Windows
+        pass
+    finally:
+        os.close(fd)
+
+def unique_name(fn, book):
+    # fn with a short hash of the source path added
+    h = hashlib.sha1(os.path.abspath(book).encode('utf-8')).hexdigest()[:8]
+    root, sep, ext = fn.rpartition('_scrambled.')
+    if sep:
+        return '%s_scrambled-%s.%s' % (root, h, ext)
+    return '%s-%s' % (h, fn)
+
+def commit_output(staged, dirout, book):
+    # Move a finished book from staging into dirout, returns its path.
+    # Books of the same name from different directories must not replace
+    # each other's output: the name is claimed with link(), which fails if
+    # it already exists, and a taken name gets a short hash of the source
+    # path added. Only this book maps to that name, so it may be replaced
+    fsync_path(staged)
+    fn = os.path.basename(staged)
+    outpath = os.path.join(dirout, fn)
+    try:
+        os.link(staged, outpath)
+    except EnvironmentError as err:
+        if err.errno == errno.EEXIST or os.path.exists(outpath):
+            outpath = os.path.join(dirout, unique_name(fn, book))
+        # else no hard links here, e.g. on some network filesystems
+        atomic_rename(staged, outpath)
+    else:
+        os.remove(staged)
+    fsync_path(dirout)
+    return outpath
+
+class Journal(object):
+    ''' Append-only record of the state of every book in a batch '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.books = {}
+        self.load()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # a crash during a write can leave a torn last line, do not glue
+        # the next entry onto it
+        if os.fstat(self.fd).st_size > 0:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    os.write(self.fd, b'\n')
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                self.apply(entry)
+
+    def apply(self, entry):
+        book = self.books.setdefault(entry['book'],
+            {'state': None, 'failures': 0, 'reason': None, 'output': None})
+        book['state'] = entry['state']
+        if entry['state'] == FAILED:
+            book['failures'] += 1
+            book['reason'] = entry.get('reason')
+        elif entry['state'] == COMMITTED:
+            book['output'] = entry.get('output')
+
+    def get(self, book):
+        return self.books.get(book, {'state': None, 'failures': 0, 'reason': None, 'output': None})
+
+    def write(self, entries):
+        # one write() per batch of entries keeps an O_APPEND update atomic,
+        # and one fsync() per batch keeps queueing a large batch quick
+        if not entries:
+            return
+        data = []
+        for entry in entries:
+            entry['time'] = round(time.time(), 3)
+            self.apply(entry)
+            data.append(json.dumps(entry, sort_keys=True))
+        os.write(self.fd, ('\n'.join(data) + '\n').encode('utf-8'))
+        os.fsync(self.fd)
+
+    def mark(self, book, state, **kw):
+        entry = {'book': book, 'state': state}
+        entry.update(kw)
+        self.write([entry])
+
+    def recover(self):
+        # books left 'started' were interrupted by a crash or a kill; count
+        # that as a failure so a book which keeps killing us is given up
+        self.write([{'book': book, 'state': FAILED, 'reason': 'interrupted'}
+                    for book, info in sorted(self.books.items()) if info['state'] == STARTED])
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def run_batch(books, dirout, journal_path, dsettings={}, max_failures=3,
+              metrics=None, log=print, prefetch=0, **kw):
+    # Scramble books into dirout, resuming from journal_path.
+    # Extra keyword arguments are passed to scramble_ebook().
+    # With prefetch > 0 books are loaded, scrambled and saved in overlapping
+    # stages (see pipeline.py), up to prefetch books loaded ahead.
+    # log is called like print(), with file=sys.stderr for problems.
+    # Returns counts of books by outcome.
+    dirout = os.path.abspath(dirout)
+    staging = os.path.join(dirout, STAGING_DIR)
+    # anything in staging is a partial book from an interrupted run
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    journal = Journal(journal_path)
+    lock = threading.Lock()
+    counts = {'committed': 0, 'failed': 0, 'skipped': 0, 'given_up': 0}
+
+    def started(book):
+        with lock:
+            journal.mark(book, STARTED)
+
+    def done(book, result, err):
+        staged, results, record = result
+        if err is None:
+            try:
+                outpath = commit_output(staged, dirout, book)
+            except Exception as e:
+                err = e
+        with lock:
+            if err is not None:
+                counts['failed'] += 1
+                journal.mark(book, FAILED, reason='%s: %s' % (err.__class__.__name__, err))
+                if metrics is not None:
+                    metrics.record_book(failed_book_record(book, get_book_format(book), err))
+                log('%s: FAILED: %s' % (book, err), file=sys.stderr)
+                return
+            counts['committed'] += 1
+            journal.mark(book, COMMITTED, output=outpath)
+            if metrics is not None:
+                metrics.record_book(record)
+            log('%s --> %s' % (book, outpath))
+
+    try:
+        journal.recover()
+        todo, queued = [], []
+        for book in [os.path.abspath(b) for b in books]:
+            info = journal.get(book)
+            if info['state'] == COMMITTED and info['output'] and os.path.exists(info['output']):
+                counts['skipped'] += 1
+            elif info['failures'] >= max_failures:
+                counts['given_up'] += 1
+                log('%s: giving up after %d failures, last: %s' % (book, info['failures'], info['reason']),
+                    file=sys.stderr)
+            else:
+                todo.append(book)
+                if info['state'] is None:
+                    queued.append({'book': book, 'state': QUEUED})
+        journal.write(queued)
+
+        if prefetch > 0:
+            from calibre_plugins.scrambleebook_plugin.pipeline import Pipeline
+            Pipeline(staging, dsettings, prefetch=prefetch, **kw).run(todo, started, done)
+        else:
+            for book in todo:
+                started(book)
+                try:
+                    result, err = scramble_ebook(book, staging, dsettings, **kw), None
+                except Exception as e:
+                    result, err = (None, None, None), e
+                done(book, result, err)
+    finally:
+        journal.close()
+        shutil.rmtree(staging, ignore_errors=True)
+    return counts
+
+def read_book_list(path):
+    # one book path per line, blank lines and # comments ignored
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+    return [l.strip() for l in lines if l.strip() and not l.strip().startswith('#')]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Phase level benchmarks. Each book is scrambled `iterations` times and the
+# median time per phase (see the metrics records from scramble_ebook) is
+# kept. Results are stored as JSON and can be compared with a previously
+# saved baseline, a phase which got slower than the threshold is a
+# regression.
+
+import json
+import os
+import platform
+import sys
+import time
+
+from polyglot.builtins import iteritems
+
+from calibre.constants import numeric_version
+
+from calibre_plugins.scrambleebook_plugin import PLUGIN_VERSION
+from calibre_plugins.scrambleebook_plugin.scramblecore import scramble_ebook
+from calibre_plugins.scrambleebook_plugin.tempspace import get_tempspace
+
+# relative slowdown allowed before a phase counts as a regression
+THRESHOLD = 0.25
+# phases faster than this are too noisy to compare
+MIN_SECONDS = 0.05
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if not n:
+        return 0
+    mid = n // 2
+    return values[mid] if n % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+def run_benchmark(books, iterations=3, dsettings={}, lazy=False, log=print):
+    results = {
+        'meta': {
+            'time': time.time(),
+            'plugin': PLUGIN_VERSION,
+            'calibre': '.'.join(str(x) for x in numeric_version),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+            'rules': dsettings,
+            'lazy': lazy,
+            },
+        'books': {},
+        }
+    space = get_tempspace()
+    for path in books:
+        samples = {}
+        with space.workspace('_bench') as outdir:
+            for i in range(iterations):
+                outpath, text, record = scramble_ebook(path, outdir, dsettings, lazy=lazy)
+                for phase, secs in iteritems(record['phases']):
+                    samples.setdefault(phase, []).append(secs)
+                samples.setdefault('total', []).append(sum(record['phases'].values()))
+                os.remove(outpath)
+        phases = {phase:round(median(v), 6) for (phase, v) in iteritems(samples)}
+        results['books'][os.path.basename(path)] = {
+            'bytes_in': record['bytes_in'],
+            'bytes_out': record['bytes_out'],
+            'phases': phases,
+            }
+        log('%-45s total %8.3fs  %s' % (os.path.basename(path), phases['total'],
+            '  '.join('%s=%.3f' % (k, v) for (k, v) in sorted(iteritems(phases)) if k != 'total')))
+    return results
+
+def compare(results, baseline, threshold=THRESHOLD, min_seconds=MIN_SECONDS):
+    # returns [(book, phase, baseline secs, current secs)] for regressions
+    ans = []
+    for book, cur in sorted(iteritems(results['books'])):
+        base = baseline['books'].get(book)
+        if base is None:
+            continue
+        for phase, secs in sorted(iteritems(cur['phases'])):
+            bsecs = base['phases'].get(phase)
+            if bsecs is None or max(bsecs, secs) < min_seconds:
+                continue
+            if secs > bsecs * (1 + threshold):
+                ans.append((book, phase, bsecs, secs))
+    return ans
+
+def save_results(results, path):
+    with open(path, 'wb') as f:
+        f.write(json.dumps(results, indent=2, sort_keys=True).encode('utf-8'))
+
+def load_results(path):
+    with open(path, 'rb') as f:
+        return json.loads(f.read())
+
+def report_regressions(regressions, threshold, out=sys.stdout):
+    if not regressions:
+        print('No regressions beyond %d%%' % (threshold * 100), file=out)
+        return
+    print('%d regressions beyond %d%%:' % (len(regressions), threshold * 100), file=out)
+    for book, phase, bsecs, secs in regressions:
+        print('   %s %s: %.3fs -> %.3fs (+%d%%)' % (book, phase, bsecs, secs,
+            (secs / bsecs - 1) * 100 if bsecs else 100), file=out)
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Headless command line front end. Run with e.g.:
+#   calibre-debug -r ScrambleEbook -- scramble -o /tmp/out book.epub
+# Nothing here may import Qt.
+
+import argparse
+import json
+import os
+import sys
+
+from calibre_plugins.scrambleebook_plugin.logsink import LogSink
+from calibre_plugins.scrambleebook_plugin.metrics import (Metrics,
+    failed_book_record)
+from calibre_plugins.scrambleebook_plugin.scramblecore import (MR_SETTINGS,
+    get_book_format, get_fileparts, new_shared_state, scramble_ebook)
+from calibre_plugins.scrambleebook_plugin.tempspace import configure as configure_tempspace
+
+COMMANDS = ('scramble', 'batch', 'watch', 'serve', 'corpus', 'bench', 'stress', 'spool')
+
+def parse_rule(text):
+    # 'x_fnames=true' -> ('x_fnames', True)
+    k, sep, v = text.partition('=')
+    if not sep or k not in MR_SETTINGS:
+        raise argparse.ArgumentTypeError('Unknown rule: %s' % text)
+    return (k, v.strip().lower() in ('1', 'true', 'yes', 'on'))
+
+def load_rules(opts):
+    # rules from an optional JSON profile, overridden by --rule options
+    dsettings = {}
+    if opts.rules:
+        with open(opts.rules, 'rb') as f:
+            dsettings.update(json.loads(f.read()))
+    dsettings.update(dict(opts.rule))
+    return dsettings
+
+def add_rule_options(parser):
+    parser.add_argument('--rules', default=None,
+        help='JSON file of scramble rules, e.g. {"x_fnames": true}')
+    parser.add_argument('--rule', action='append', default=[], type=parse_rule,
+        help='Set a single rule, e.g. --rule x_meta_extra=true. May be repeated.')
+
+def add_seed_option(parser):
+    parser.add_argument('--seed', type=int, default=None,
+        help='Scramble reproducibly: the same book, rules and seed always give the same output file')
+
+def add_container_options(parser):
+    parser.add_argument('--lazy', action='store_true',
+        help='Read EPUB/KEPUB members from the zip on demand instead of unpacking the whole book')
+    parser.add_argument('--mmap', action='store_true',
+        help='With --lazy, memory-map the source file')
+
+def add_tempspace_options(parser):
+    parser.add_argument('--tmpdir', default=None,
+        help='Base directory for working files (default: /dev/shm if large enough, else the system temp dir)')
+    parser.add_argument('--book-quota', type=float, default=None, metavar='MB',
+        help='Fail a book which needs more than this much temporary space')
+    parser.add_argument('--global-quota', type=float, default=None, metavar='MB',
+        help='Fail a book if all temporary space in use would exceed this')
+
+def setup_tempspace(opts):
+    mb = lambda x: None if x is None else int(x * 1024**2)
+    configure_tempspace(base=opts.tmpdir, book_quota=mb(opts.book_quota),
+        global_quota=mb(opts.global_quota))
+
+def add_metrics_options(parser):
+    parser.add_argument('--metrics-jsonl', default=None, metavar='FILE',
+        help='Append one JSON line per book, and a summary line at the end')
+    parser.add_argument('--metrics-prom', default=None, metavar='FILE',
+        help='Keep FILE updated with metrics in Prometheus text format')
+
+def create_metrics(opts):
+    return Metrics(jsonl_path=opts.metrics_jsonl, prom_path=opts.metrics_prom)
+
+def book_key(path):
+    # book.epub, book.kepub.epub and book.azw3 are formats of one book
+    dirname, fn, x, is_kepub_epub = get_fileparts(path)
+    if is_kepub_epub:
+        fn = fn.rpartition('.')[0]
+    return os.path.join(dirname, fn)
+
+def get_subset(opts):
+    if not (opts.only or opts.only_selector):
+        if opts.max_blocks:
+            return {'patterns': ('*',), 'max_blocks': opts.max_blocks}
+        return None
+    return {'patterns': opts.only, 'selector': opts.only_selector,
+            'max_blocks': opts.max_blocks}
+
+def cmd_scramble(opts):
+    setup_tempspace(opts)
+    dsettings = load_rules(opts)
+    metrics = create_metrics(opts)
+    log = LogSink(maxlines=1000, stream=sys.stdout, structured=opts.log_json)
+    errors = 0
+    shared = {}
+    for path in opts.books:
+        dirout = opts.output or os.path.dirname(os.path.abspath(path))
+        state = None
+        if opts.together or opts.share_text:
+            key = book_key(path)
+            if key not in shared:
+                shared[key] = new_shared_state(opts.share_text)
+            state = shared[key]
+        try:
+            outpath, results, record = scramble_ebook(path, dirout, dsettings,
+                lazy=opts.lazy, use_mmap=opts.mmap, verify=opts.verify, shared=state,
+                subset=get_subset(opts), seed=opts.seed)
+        except Exception as err:
+            errors += 1
+            metrics.record_book(failed_book_record(path, get_book_format(path), err))
+            if opts.log_json:
+                log.append('FAILED: %s' % err, level='error', book=path)
+            else:
+                print('%s: FAILED: %s' % (path, err), file=sys.stderr)
+            continue
+        metrics.record_book(record)
+        log.append('%s --> %s' % (path, outpath), book=path, output=outpath)
+        if opts.verbose:
+            log.append(results, book=path)
+    metrics.close()
+    return 1 if errors else 0
+
+def cmd_batch(opts):
+    from calibre_plugins.scrambleebook_plugin.batch import run_batch, read_book_list
+    setup_tempspace(opts)
+    books = list(opts.books)
+    if opts.list:
+        books.extend(read_book_list(opts.list))
+    if not os.path.isdir(opts.output):
+        os.makedirs(opts.output)
+    journal = opts.journal or os.path.join(opts.output, 'scrambleebook-journal.jsonl')
+    metrics = create_metrics(opts)
+    counts = run_batch(books, opts.output, journal, dsettings=load_rules(opts),
+        max_failures=opts.max_failures, metrics=metrics, prefetch=opts.prefetch, lazy=opts.lazy, use_mmap=opts.mmap, verify=opts.verify,
+        seed=opts.seed)
+    metrics.close()
+    print('%(committed)d committed, %(failed)d failed, %(skipped)d already done, '
+          '%(given_up)d given up' % counts)
+    return 1 if counts['failed'] else 0
+
+def cmd_spool(opts):
+    from calibre_plugins.scrambleebook_plugin.batch import read_book_list
+    from calibre_plugins.scrambleebook_plugin.spool import Spool, SpoolWorker
+    spool = Spool(opts.spool)
+    books = list(opts.books)
+    if opts.list:
+        books.extend(read_book_list(opts.list))
+    if books:
+        print('%d books queued' % spool.submit(books))
+    if opts.status:
+        print('%(queue)d queued, %(claimed)d in progress, %(done)d done, '
+              '%(failed)d given up' % spool.status())
+        return 0
+    if opts.submit_only:
+        return 0
+    if not opts.output:
+        print('An output directory (-o) is needed to work on the spool', file=sys.stderr)
+        return 2
+    if not os.path.isdir(opts.output):
+        os.makedirs(opts.output)
+    setup_tempspace(opts)
+    metrics = create_metrics(opts)
+    worker = SpoolWorker(spool, opts.output, dsettings=load_rules(opts),
+        lease=opts.lease, poll=opts.poll, follow=opts.follow,
+        max_failures=opts.max_failures, metrics=metrics,
+        lazy=opts.lazy, use_mmap=opts.mmap, verify=opts.verify, seed=opts.seed)
+    try:
+        counts = worker.run()
+    finally:
+        metrics.close()
+    print('%(committed)d committed, %(failed)d failed, %(given_up)d given up, '
+          '%(taken_over)d taken over from stopped hosts' % counts)
+    return 1 if counts['failed'] or counts['given_up'] else 0
+
+def cmd_watch(opts):
+    from calibre_plugins.scrambleebook_plugin.watch import WatchFolder
+    setup_tempspace(opts)
+    WatchFolder(opts.dirs, opts.output, dsettings=load_rules(opts),
+        workers=opts.workers, settle=opts.settle, poll=opts.poll,
+        interval=opts.interval, lazy=opts.lazy, metrics=create_metrics(opts)).run()
+    return 0
+
+def cmd_serve(opts):
+    from calibre_plugins.scrambleebook_plugin.service import ScrambleService
+    setup_tempspace(opts)
+    ScrambleService(host=opts.host, port=opts.port, workers=opts.workers,
+        max_queue=opts.max_queue, timeout=opts.timeout,
+        max_upload=int(opts.max_upload * 1024**2),
+        metrics=create_metrics(opts)).serve_forever()
+    return 0
+
+def add_corpus_options(parser):
+    from calibre_plugins.scrambleebook_plugin.corpus import PROFILES
+    parser.add_argument('--profile', default='small', choices=sorted(PROFILES))
+    parser.add_argument('--count', type=int, default=1, help='Books per format')
+    parser.add_argument('--formats', default='epub',
+        help='Comma separated list of epub, kepub, azw3')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spine', type=int, default=None, help='Number of chapters')
+    parser.add_argument('--paragraphs', type=int, default=None, help='Paragraphs per chapter')
+    parser.add_argument('--words', type=int, default=None, help='Words per paragraph')
+    parser.add_argument('--scripts', default=None,
+        help='Script mix, e.g. latin=0.7,cyrillic=0.2,cjk=0.1 (also greek, arabic)')
+    parser.add_argument('--links', type=float, default=None, help='Chance of a link per sentence')
+    parser.add_argument('--footnotes', type=float, default=None, help='Chance of a footnote per sentence')
+    parser.add_argument('--images', type=int, default=None)
+    parser.add_argument('--image-size', default=None, metavar='WxH')
+    parser.add_argument('--fonts', type=int, default=None, help='Embedded fonts')
+    parser.add_argument('--extra-items', type=int, default=None,
+        help='Unreferenced manifest items, to grow the manifest')
+
+def make_corpus(opts, outdir):
+    from calibre_plugins.scrambleebook_plugin.corpus import generate_corpus, parse_scripts
+    overrides = {k:getattr(opts, k) for k in ('spine', 'paragraphs', 'words', 'links',
+        'footnotes', 'images', 'fonts', 'extra_items')}
+    if opts.scripts:
+        overrides['scripts'] = parse_scripts(opts.scripts)
+    if opts.image_size:
+        overrides['image_size'] = tuple(int(x) for x in opts.image_size.lower().split('x'))
+    formats = tuple(f.strip().lower() for f in opts.formats.split(','))
+    return generate_corpus(outdir, count=opts.count, profile=opts.profile,
+        formats=formats, seed=opts.seed, **overrides)
+
+def cmd_corpus(opts):
+    for path in make_corpus(opts, opts.outdir):
+        print(path)
+    return 0
+
+def cmd_bench(opts):
+    from calibre_plugins.scrambleebook_plugin import bench
+    from calibre_plugins.scrambleebook_plugin.tempspace import get_tempspace
+    setup_tempspace(opts)
+    dsettings = load_rules(opts)
+    with get_tempspace().workspace('_corpus') as tdir:
+        books = opts.books or make_corpus(opts, tdir)
+        results = bench.run_benchmark(books, iterations=opts.iterations,
+            dsettings=dsettings, lazy=opts.lazy)
+    if opts.save:
+        bench.save_results(results, opts.save)
+    if opts.baseline:
+        regressions = bench.compare(results, bench.load_results(opts.baseline),
+            threshold=opts.threshold)
+        bench.report_regressions(regressions, opts.threshold)
+        if regressions:
+            return 1
+    return 0
+
+def cmd_stress(opts):
+    from calibre_plugins.scrambleebook_plugin import stress
+    setup_tempspace(opts)
+    results = stress.run_stress(opts.stage or None, scale=opts.scale,
+        repeat=opts.repeat, max_slope=opts.max_slope, memory=not opts.no_memory)
+    return 0 if all(r['ok'] for r in results) else 1
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='ScrambleEbook')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('scramble', help='Scramble one or more books without the GUI')
+    p.add_argument('books', nargs='+', help='EPUB/KEPUB/AZW3 files')
+    p.add_argument('-o', '--output', default=None,
+        help='Output directory (default: same directory as each book)')
+    p.add_argument('-v', '--verbose', action='store_true')
+    p.add_argument('--log-json', action='store_true',
+        help='Print one JSON record per log line, with the book it belongs to')
+    p.add_argument('--verify', action='store_true',
+        help='Check the scrambled book for surviving original text and structural changes')
+    p.add_argument('--together', action='store_true',
+        help='Treat files with the same name and a different extension as formats '
+        'of one book, and share image work between them')
+    p.add_argument('--share-text', action='store_true',
+        help='Implies --together. Scramble identical text identically in every format of a book')
+    p.add_argument('--only', action='append', default=[], metavar='PATTERN',
+        help='Keep only spine documents with this name or matching this pattern, '
+        'e.g. "Text/ch05.xhtml" or "*ch1?*". May be repeated.')
+    p.add_argument('--only-selector', default=None, metavar='SELECTOR',
+        help='Keep only spine documents where this CSS selector matches, e.g. "table.bug"')
+    p.add_argument('--max-blocks', type=int, default=None, metavar='N',
+        help='Cut each kept document after its first N paragraphs/blocks')
+    add_seed_option(p)
+    add_container_options(p)
+    add_tempspace_options(p)
+    add_metrics_options(p)
+    add_rule_options(p)
+    p.set_defaults(func=cmd_scramble)
+
+    p = sub.add_parser('batch', help='Scramble many books, resuming an interrupted run')
+    p.add_argument('books', nargs='*', help='EPUB/KEPUB/AZW3 files')
+    p.add_argument('-o', '--output', required=True, help='Output directory')
+    p.add_argument('--list', default=None, metavar='FILE',
+        help='Also scramble the books listed in FILE, one per line (- for stdin)')
+    p.add_argument('--journal', default=None, metavar='FILE',
+        help='Journal of book states (default: scrambleebook-journal.jsonl in the output directory)')
+    p.add_argument('--max-failures', type=int, default=3,
+        help='Stop retrying a book after it failed this many times')
+    p.add_argument('--prefetch', type=int, default=1, metavar='N',
+        help='Load up to N books ahead while others are scrambled and saved. '
+        '0 handles one book at a time.')
+    p.add_argument('--verify', action='store_true',
+        help='Check the scrambled book for surviving original text and structural changes')
+    add_seed_option(p)
+    add_container_options(p)
+    add_tempspace_options(p)
+    add_metrics_options(p)
+    add_rule_options(p)
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser('spool', help='Share a batch between machines through a spool directory')
+    p.add_argument('spool', help='Spool directory on a filesystem shared by all hosts')
+    p.add_argument('books', nargs='*', help='EPUB/KEPUB/AZW3 files to add to the spool')
+    p.add_argument('-o', '--output', default=None, help='Output directory')
+    p.add_argument('--list', default=None, metavar='FILE',
+        help='Also add the books listed in FILE, one per line (- for stdin)')
+    p.add_argument('--submit-only', action='store_true',
+        help='Only add books to the spool, do not scramble any')
+    p.add_argument('--status', action='store_true',
+        help='Show how many books are queued, in progress, done and given up')
+    p.add_argument('--lease', type=float, default=60.0,
+        help='Seconds without a heartbeat after which another host takes over a book')
+    p.add_argument('--poll', type=float, default=2.0,
+        help='Seconds between looks at the spool when there is nothing to claim')
+    p.add_argument('--follow', action='store_true',
+        help='Keep waiting for new books instead of exiting when the spool is empty')
+    p.add_argument('--max-failures', type=int, default=3,
+        help='Give a book up after it failed, or its host died, this many times')
+    p.add_argument('--verify', action='store_true',
+        help='Check the scrambled book for surviving original text and structural changes')
+    add_seed_option(p)
+    add_container_options(p)
+    add_tempspace_options(p)
+    add_metrics_options(p)
+    add_rule_options(p)
+    p.set_defaults(func=cmd_spool)
+
+    p = sub.add_parser('watch', help='Scramble books dropped into watched directories')
+    p.add_argument('dirs', nargs='+', help='Directories to watch')
+    p.add_argument('-o', '--output', required=True,
+        help='Directory for scrambled books and their reports')
+    p.add_argument('--workers', type=int, default=None,
+        help='Books scrambled at once (default: number of CPUs)')
+    p.add_argument('--settle', type=float, default=2.0,
+        help='Seconds a file must stay unchanged before it is picked up')
+    p.add_argument('--poll', action='store_true',
+        help='List the directories instead of using inotify, e.g. for network shares')
+    p.add_argument('--interval', type=float, default=1.0,
+        help='Seconds between directory listings when polling')
+    add_container_options(p)
+    add_tempspace_options(p)
+    add_metrics_options(p)
+    add_rule_options(p)
+    p.set_defaults(func=cmd_watch)
+
+    p = sub.add_parser('serve', help='Run a local HTTP scrambling service')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8642)
+    p.add_argument('--workers', type=int, default=None,
+        help='Books scrambled at once (default: number of CPUs)')
+    p.add_argument('--max-queue', type=int, default=16,
+        help='Books waiting for a worker before new uploads are refused')
+    p.add_argument('--timeout', type=int, default=600,
+        help='Seconds allowed to scramble one book')
+    p.add_argument('--max-upload', type=float, default=512, metavar='MB')
+    add_tempspace_options(p)
+    add_metrics_options(p)
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser('corpus', help='Generate synthetic books')
+    p.add_argument('outdir')
+    add_corpus_options(p)
+    p.set_defaults(func=cmd_corpus)
+
+    p = sub.add_parser('bench', help='Time each scrambling phase and compare with a baseline')
+    p.add_argument('books', nargs='*',
+        help='Books to time (default: generate a synthetic corpus)')
+    p.add_argument('--iterations', type=int, default=3)
+    p.add_argument('--save', default=None, metavar='FILE', help='Save results as JSON')
+    p.add_argument('--baseline', default=None, metavar='FILE',
+        help='Fail if any phase is slower than in this saved result')
+    p.add_argument('--threshold', type=float, default=0.25,
+        help='Allowed relative slowdown per phase (default: 0.25)')
+    p.add_argument('--lazy', action='store_true')
+    add_corpus_options(p)
+    add_tempspace_options(p)
+    add_rule_options(p)
+    p.set_defaults(func=cmd_bench)
+
+    p = sub.add_parser('stress', help='Check that scrambling pathological books scales linearly')
+    p.add_argument('--stage', action='append', default=[],
+        choices=('text', 'nesting', 'anchors', 'newbase', 'rename', 'metadata'),
+        help='Only run this stage. May be repeated.')
+    p.add_argument('--scale', type=float, default=1.0,
+        help='Multiply the input sizes of every stage')
+    p.add_argument('--repeat', type=int, default=3,
+        help='Time each size this many times and keep the best')
+    p.add_argument('--max-slope', type=float, default=1.3,
+        help='Fail a stage whose time or memory grows faster than n to this power')
+    p.add_argument('--no-memory', action='store_true',
+        help='Skip the (slower) peak memory measurements')
+    add_tempspace_options(p)
+    p.set_defaults(func=cmd_stress)
+
+    return parser
+
+def main(args):
+    opts = create_parser().parse_args(args)
+    return opts.func(opts)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Settings kept between sessions in calibre's config directory. No Qt and
+# no scrambling code here, this is loaded at calibre GUI startup.
+
+from calibre.utils.config import JSONConfig
+
+prefs = JSONConfig('plugins/ScrambleEbook')
+
+# rules last saved in the rules dialog, on top of MR_SETTINGS
+prefs.defaults['rules'] = {}
+
+def saved_rules(defaults):
+    # defaults updated with the saved rules, minus any which no longer exist
+    rules = defaults.copy()
+    rules.update((k, v) for (k, v) in prefs['rules'].items() if k in defaults)
+    return rules
+
+def save_rules(rules):
+    prefs['rules'] = dict(rules)
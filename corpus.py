@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Synthetic books for benchmarks and stress runs.
+# EPUB and KEPUB files are written directly with zipfile, AZW3 files are
+# converted from the generated EPUB with calibre's conversion pipeline.
+# Everything is driven by a seeded random.Random, so the same profile and
+# seed always give the same book.
+
+import os
+import random
+import struct
+import zipfile
+import zlib
+from xml.sax.saxutils import escape
+
+PROFILES = {
+    'small': dict(spine=5, paragraphs=20, words=60, images=3, image_size=(200, 300),
+                  fonts=0, links=0.05, footnotes=0.05, extra_items=0),
+    'medium': dict(spine=30, paragraphs=60, words=80, images=20, image_size=(600, 800),
+                   fonts=2, links=0.05, footnotes=0.1, extra_items=50),
+    'large': dict(spine=120, paragraphs=120, words=100, images=150, image_size=(1200, 1600),
+                  fonts=4, links=0.1, footnotes=0.2, extra_items=1000),
+    }
+DEFAULT_SCRIPTS = {'latin': 1.0}
+SCRIPTS = {
+    'latin': 'abcdefghijklmnopqrstuvwxyz',
+    'cyrillic': 'абвгдежзийклмнопрстуфхцчшщэюя',
+    'greek': 'αβγδεζηθικλμνξοπρστυφχψω',
+    'arabic': 'ابتثجحخدذرزسشصضطظعغفقكلمنهوي',
+    'cjk': None,
+    }
+FORMATS = ('epub', 'kepub', 'azw3')
+
+def book_params(profile='small', **overrides):
+    ans = dict(PROFILES[profile])
+    ans['scripts'] = dict(DEFAULT_SCRIPTS)
+    ans.update({k:v for (k, v) in overrides.items() if v is not None})
+    return ans
+
+def parse_scripts(text):
+    # 'latin=0.7,cyrillic=0.3' -> {'latin': 0.7, 'cyrillic': 0.3}
+    ans = {}
+    for part in text.split(','):
+        k, sep, v = part.partition('=')
+        if k.strip() not in SCRIPTS:
+            raise ValueError('Unknown script: %s' % k)
+        ans[k.strip()] = float(v) if sep else 1.0
+    return ans
+
+def make_png(width, height, rgb):
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+    row = b'\x00' + bytes(bytearray(rgb)) * width
+    raw = zlib.compress(row * height, 6)
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', raw) + chunk(b'IEND', b''))
+
+
+class BookGenerator(object):
+
+    def __init__(self, params, seed=0):
+        self.p = params
+        self.rnd = random.Random(seed)
+        scripts = sorted(params['scripts'].items())
+        self.script_names = [k for (k, v) in scripts]
+        self.script_weights = [v for (k, v) in scripts]
+        self.note_chapters = []
+
+    def word(self, script):
+        rnd = self.rnd
+        if script == 'cjk':
+            return ''.join(chr(rnd.randint(0x4e00, 0x9fff)) for i in range(rnd.randint(1, 4)))
+        letters = SCRIPTS[script]
+        return ''.join(rnd.choice(letters) for i in range(rnd.randint(1, 10)))
+
+    def sentences(self, nwords):
+        # list of sentences in a single script per paragraph
+        rnd = self.rnd
+        script = rnd.choices(self.script_names, self.script_weights)[0]
+        ans, words = [], []
+        for i in range(nwords):
+            words.append(self.word(script))
+            if len(words) > 4 and (rnd.random() < 0.12 or i == nwords - 1):
+                s = ' '.join(words)
+                ans.append(s[0].upper() + s[1:] + '.')
+                words = []
+        if words:
+            ans.append(' '.join(words) + '.')
+        return ans
+
+    def paragraph(self, chapter, npara, kepub):
+        rnd, p = self.rnd, self.p
+        parts = []
+        for i, s in enumerate(self.sentences(p['words'])):
+            s = escape(s)
+            if rnd.random() < p['links']:
+                target = rnd.randint(1, p['spine'])
+                s = '<a href="chapter%03d.xhtml">%s</a> %s' % (target, self.word('latin'), s)
+            if rnd.random() < p['footnotes']:
+                self.note_chapters.append(chapter)
+                n = len(self.note_chapters)
+                s += '<a href="notes.xhtml#fn%d" id="fnref%d">%d</a>' % (n, n, n)
+            if kepub:
+                s = '<span class="koboSpan" id="kobo.%d.%d">%s</span>' % (npara, i + 1, s)
+            parts.append(s)
+        return '<p class="para">%s</p>' % ' '.join(parts)
+
+    def xhtml(self, title, body, kepub=False):
+        if kepub:
+            body = '<div id="book-columns"><div id="book-inner">%s</div></div>' % body
+        return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>%s</title>'
+            '<link rel="stylesheet" type="text/css" href="../styles/style.css"/></head>'
+            '<body>%s</body></html>') % (escape(title), body)
+
+    def build(self, path, kepub=False):
+        rnd, p = self.rnd, self.p
+        self.note_chapters = []
+        files, manifest, spine, navpoints = [], [], [], []
+
+        def add(name, mt, data, item_id, in_spine=False):
+            files.append(('OEBPS/' + name, data))
+            manifest.append('<item id="%s" href="%s" media-type="%s"/>' % (item_id, name, mt))
+            if in_spine:
+                spine.append('<itemref idref="%s"/>' % item_id)
+
+        images = []
+        w, h = p['image_size']
+        for i in range(p['images']):
+            name = 'images/img%03d.png' % (i + 1)
+            rgb = [rnd.randint(0, 255) for x in range(3)]
+            add(name, 'image/png', make_png(w, h, rgb), 'img%d' % i)
+            images.append(name)
+
+        css = ['.para { text-indent: 1em; margin: 0 }', 'h1 { text-align: center }']
+        for i in range(p['fonts']):
+            name = 'fonts/font%d.ttf' % (i + 1)
+            data = b'\x00\x01\x00\x00' + bytes(bytearray(rnd.getrandbits(8) for x in range(20000)))
+            add(name, 'application/x-font-truetype', data, 'font%d' % i)
+            css.append('@font-face { font-family: "F%d"; src: url(../%s) }' % (i, name))
+        add('styles/style.css', 'text/css', '\n'.join(css).encode('utf-8'), 'css')
+
+        imgs_per_chapter = {}
+        for i, name in enumerate(images):
+            imgs_per_chapter.setdefault(i % p['spine'], []).append(name)
+
+        for c in range(p['spine']):
+            title = 'Chapter %d %s' % (c + 1, ' '.join(self.sentences(3)[:1]))
+            body = ['<h1>%s</h1>' % escape(title)]
+            for n in range(p['paragraphs']):
+                body.append(self.paragraph(c, n + 1, kepub))
+            for img in imgs_per_chapter.get(c, ()):
+                body.append('<div><img src="../%s" alt="%s"/></div>' % (img, escape(' '.join(self.sentences(5)[:1]))))
+            name = 'text/chapter%03d.xhtml' % (c + 1)
+            add(name, 'application/xhtml+xml', self.xhtml(title, ''.join(body), kepub).encode('utf-8'),
+                'ch%d' % c, in_spine=True)
+            navpoints.append('<navPoint id="np%d" playOrder="%d"><navLabel><text>%s</text></navLabel>'
+                '<content src="%s"/></navPoint>' % (c, c + 1, escape(title), name))
+
+        notes = ['<h1>Notes</h1>']
+        for n, c in enumerate(self.note_chapters, 1):
+            notes.append('<p id="fn%d"><a href="chapter%03d.xhtml#fnref%d">%d</a> %s</p>' % (
+                n, c + 1, n, n, escape(self.sentences(12)[0])))
+        add('text/notes.xhtml', 'application/xhtml+xml', self.xhtml('Notes', ''.join(notes), kepub).encode('utf-8'),
+            'notes', in_spine=True)
+
+        for i in range(p['extra_items']):
+            add('misc/extra%04d.css' % i, 'text/css', ('.x%d { color: red }' % i).encode('ascii'), 'extra%d' % i)
+
+        ncx = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1"><head>'
+            '<meta name="dtb:uid" content="urn:uuid:synthetic-%d"/></head>'
+            '<docTitle><text>Synthetic book</text></docTitle><navMap>%s</navMap></ncx>') % (
+                p['spine'], ''.join(navpoints))
+        files.append(('OEBPS/toc.ncx', ncx.encode('utf-8')))
+        manifest.append('<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>')
+
+        opf = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="uid">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+            '<dc:title>Synthetic book</dc:title><dc:creator opf:file-as="Author, Test">Test Author</dc:creator>'
+            '<dc:identifier id="uid">urn:uuid:synthetic-%d</dc:identifier>'
+            '<dc:identifier opf:scheme="ISBN">9780000000000</dc:identifier>'
+            '<dc:description>%s</dc:description><dc:language>en</dc:language>'
+            '<meta name="calibre:timestamp" content="2020-01-01T00:00:00+00:00"/>%s</metadata>'
+            '<manifest>%s</manifest><spine toc="ncx">%s</spine></package>') % (
+                p['spine'], escape(' '.join(self.sentences(30))),
+                '<meta name="cover" content="img0"/>' if images else '',
+                ''.join(manifest), ''.join(spine))
+
+        container = ('<?xml version="1.0"?>\n'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+            '</rootfiles></container>')
+
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(zipfile.ZipInfo('mimetype'), b'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+            zf.writestr('META-INF/container.xml', container.encode('utf-8'))
+            zf.writestr('OEBPS/content.opf', opf.encode('utf-8'))
+            for name, data in files:
+                zf.writestr(name, data)
+        return path
+
+
+def convert_to_azw3(epub_path, azw3_path):
+    from calibre.ebooks.conversion.plumber import Plumber
+    from calibre.utils.logging import default_log
+    Plumber(epub_path, azw3_path, default_log).run()
+    return azw3_path
+
+def generate_corpus(outdir, count=1, profile='small', formats=('epub',), seed=0, **overrides):
+    # returns the paths of the generated books
+    params = book_params(profile, **overrides)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    ans = []
+    for i in range(count):
+        base = os.path.join(outdir, 'synthetic_%s_%03d' % (profile, i + 1))
+        gen = BookGenerator(params, seed=seed + i)
+        epub = gen.build(base + '.epub')
+        if 'kepub' in formats:
+            gen = BookGenerator(params, seed=seed + i)
+            ans.append(gen.build(base + '.kepub.epub', kepub=True))
+        if 'azw3' in formats:
+            ans.append(convert_to_azw3(epub, base + '.azw3'))
+        if 'epub' in formats:
+            ans.append(epub)
+        else:
+            os.remove(epub)
+    return sorted(ans)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Library interface for other tools. Build one ScrambleEngine per process
+# and call it for each book:
+#
+#   from calibre_plugins.scrambleebook_plugin.engine import ScrambleEngine
+#   engine = ScrambleEngine()
+#   result = engine.scramble_file('book.epub', '/tmp/out', {'x_fnames': True})
+#   result.output, result.file_map, result.timings ...
+#
+# The engine keeps what is expensive to set up between books: the
+# placeholder images per format, already rendered placeholders and image
+# sizes, and the calibre modules scrambling needs. Errors are raised, not
+# logged. An engine is not meant to be used by several threads at once.
+
+import os
+from functools import partial
+from importlib import import_module
+
+from calibre_plugins.scrambleebook_plugin.scramblecore import (MR_SETTINGS,
+    get_book_format, get_dummy_images, get_scrambled_fname, load_book,
+    new_shared_state, save_book, scramble_book)
+
+# rendered placeholders kept between books, each is a whole image file
+MAX_PLACEHOLDERS = 256
+# sizes of original images kept between books, a few hundred bytes each
+MAX_IMAGES = 20000
+# imported lazily by scrambling, see warm()
+WARM_MODULES = (
+    'calibre.utils.magick',
+    'calibre.ebooks.oeb.polish.cover',
+    'calibre.ebooks.oeb.polish.replace',
+    'calibre_plugins.scrambleebook_plugin.zipcontainer',
+    )
+
+class ScrambleResult(object):
+    ''' What scrambling one book did '''
+    def __init__(self, source, output, scrambler, record):
+        self.source = source
+        self.output = output                    # None for scramble_container()
+        self.format = record['format']
+        self.log = list(scrambler.log)
+        self.file_map = dict(scrambler.file_map)
+        self.removed_names = list(scrambler.removed_names)
+        self.bytes_saved = dict(scrambler.bytes_saved)
+        self.timings = dict(record['phases'])
+        self.cache_stats = dict(record['cache'])
+        self.seed = record['seed']
+        self.record = record
+
+    @property
+    def text(self):
+        return '\n'.join(self.log)
+
+    def as_dict(self):
+        return {
+            'source': self.source,
+            'output': self.output,
+            'format': self.format,
+            'log': self.log,
+            'file_map': self.file_map,
+            'removed_names': self.removed_names,
+            'bytes_saved': self.bytes_saved,
+            'timings': self.timings,
+            'cache_stats': self.cache_stats,
+            'seed': self.seed,
+            }
+
+class ScrambleEngine(object):
+
+    def __init__(self, rules=None, warm=True):
+        # rules are defaults for every book, see MR_SETTINGS
+        self.rules = self.check_rules(rules)
+        self.dummies = {}
+        self.shared = new_shared_state()
+        if warm:
+            self.warm()
+
+    def warm(self):
+        # import now what the first book would otherwise wait for
+        for module in WARM_MODULES:
+            import_module(module)
+        for fmt in ('epub', 'kepub', 'azw3'):
+            self.get_dummies(fmt)
+
+    def check_rules(self, rules):
+        rules = dict(rules or {})
+        unknown = [k for k in rules if k not in MR_SETTINGS]
+        if unknown:
+            raise ValueError('Unknown rules: %s' % ', '.join(sorted(unknown)))
+        return rules
+
+    def get_settings(self, rules):
+        settings = self.rules.copy()
+        settings.update(self.check_rules(rules))
+        return settings
+
+    def get_dummies(self, fmt):
+        if fmt not in self.dummies:
+            self.dummies[fmt] = get_dummy_images(fmt)
+        return self.dummies[fmt]
+
+    def get_shared(self):
+        # image caches carry over between books, scrambled text does not.
+        # Both are bounded, an engine may live for a great many books
+        if len(self.shared['placeholders']) > MAX_PLACEHOLDERS:
+            self.shared['placeholders'].clear()
+        if len(self.shared['images']) > MAX_IMAGES:
+            self.shared['images'].clear()
+        return self.shared
+
+    def clear(self):
+        self.dummies.clear()
+        self.shared = new_shared_state()
+
+    def scramble_container(self, container, rules=None, verify=False, subset=None, seed=None):
+        # Scramble an open calibre container in place; saving it is up to
+        # the caller. Returns a ScrambleResult
+        from calibre_plugins.scrambleebook_plugin.metrics import new_book_record
+        source = getattr(container, 'path_to_ebook', None)
+        fmt = get_book_format(source) if source else 'epub'
+        record = new_book_record(source, fmt)
+        scrambler = scramble_book(container, record, self.get_settings(rules),
+            verify=verify, shared=self.get_shared(), subset=subset,
+            dummies=self.get_dummies(fmt), seed=seed)
+        return ScrambleResult(source, None, scrambler, record)
+
+    def scramble_file(self, src, dst, rules=None, lazy=False, use_mmap=False,
+            verify=False, subset=None, seed=None):
+        # Scramble the book src into dst, a file or an existing directory
+        # (for the usual *_scrambled name). With a seed the output is
+        # byte-identical on every run. Returns a ScrambleResult
+        from calibre_plugins.scrambleebook_plugin.libfiles import check_writable
+        from calibre_plugins.scrambleebook_plugin.tempspace import get_tempspace
+        settings = self.get_settings(rules)
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, get_scrambled_fname(src))
+        check_writable(dst, (), sources=(src,))
+        space = get_tempspace()
+        with space.workspace('_scramble_book', needed=os.path.getsize(src)) as tdir:
+            ebook, record = load_book(src, tdir, lazy=lazy, use_mmap=use_mmap)
+            check = partial(space.check, tdir)
+            try:
+                check()
+                scrambler = scramble_book(ebook, record, settings, verify=verify,
+                    shared=self.get_shared(), subset=subset,
+                    dummies=self.get_dummies(record['format']), seed=seed, check=check)
+            except:
+                if hasattr(ebook, 'close_source'):
+                    ebook.close_source()
+                raise
+            output = save_book(ebook, record, src, None, dest=dst,
+                reproducible=seed is not None, check=check)
+        return ScrambleResult(src, output, scrambler, record)
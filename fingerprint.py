@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Structural fingerprints, used to check that a scrambled book keeps the
+# structure, and so the rendering bugs, of the original.
+# Each document is reduced in one pass to:
+#   skeleton - tags, attribute names and class values in document order
+#   text     - the length of every text and tail (scrambling is 1:1 per char),
+#              except the <title> and inline <style> sheets
+#   css      - the stylesheets it links to
+# Attribute values other than class are left out, they legitimately
+# change when files are renamed.
+
+import hashlib
+from collections import namedtuple
+
+from polyglot.builtins import iteritems
+
+from calibre.ebooks.oeb.base import OEB_DOCS
+
+DocPrint = namedtuple('DocPrint', 'skeleton text css')
+
+def fingerprint_doc(container, name):
+    root = container.parsed(name)
+    skeleton, text = hashlib.sha1(), hashlib.sha1()
+    css = []
+    for e in root.iter():
+        if callable(e.tag):
+            # comments and processing instructions
+            skeleton.update(b'<!>')
+            continue
+        tag = e.tag.rpartition('}')[-1]
+        # external link hrefs may be removed by the x_extlink rule
+        attrs = sorted(k.rpartition('}')[-1] for k in e.attrib if k != 'href')
+        item = '<%s %s class="%s">' % (tag, ' '.join(attrs), e.get('class', ''))
+        skeleton.update(item.encode('utf-8'))
+        # the <title> is always replaced, and x_optimize drops unused
+        # rules from inline <style> sheets
+        tlen = 0 if tag in ('title', 'style') else len(e.text or '')
+        text.update(('%d,%d;' % (tlen, len(e.tail or ''))).encode('ascii'))
+        if tag == 'link' and 'stylesheet' in e.get('rel', '').lower() and e.get('href'):
+            css.append(container.href_to_name(e.get('href'), name))
+    return DocPrint(skeleton.hexdigest(), text.hexdigest(), tuple(css))
+
+def fingerprint_book(container):
+    return {name:fingerprint_doc(container, name)
+            for (name, mt) in iteritems(container.mime_map) if mt in OEB_DOCS}
+
+def compare_fingerprints(orig, scrambled, file_map={}, removed=()):
+    # returns [(original name, [problems])] for documents which diverge
+    # file_map maps original names to scrambled names (x_fnames)
+    # removed holds scrambled names dropped on purpose (x_optimize)
+    ans = []
+    for name, fp in sorted(iteritems(orig)):
+        if file_map.get(name, name) in removed:
+            continue
+        problems = []
+        sfp = scrambled.get(file_map.get(name, name))
+        if sfp is None:
+            problems.append('missing from scrambled book')
+        else:
+            if fp.skeleton != sfp.skeleton:
+                problems.append('element/attribute/class structure differs')
+            if fp.text != sfp.text:
+                problems.append('text length profile differs')
+            if tuple(file_map.get(n, n) for n in fp.css) != sfp.css:
+                problems.append('stylesheet references differ')
+        if problems:
+            ans.append((name, problems))
+    return ans
+
+def format_divergences(divergences, ndocs):
+    if not divergences:
+        return ['   Structure check: all %d documents match the original' % ndocs]
+    log = ['   Structure check: %d of %d documents differ from the original:' % (
+        len(divergences), ndocs)]
+    for name, problems in divergences:
+        log.append('      %s: %s' % (name, '; '.join(problems)))
+    return log
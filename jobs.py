@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Jobs run by the calibre GUI in calibre's worker processes, with
+# job_manager.run_job('arbitrary_n', ...), so scrambling never competes
+# with the GUI for the interpreter. What is printed ends up in the job log.
+
+def do_scramble_formats(paths, dirout, dsettings, notification=None):
+    # One shared pass over all formats, so every format ends up with the
+    # same scrambled text and placeholder images. Returns the paths written
+    from calibre_plugins.scrambleebook_plugin.scramblecore import scramble_ebook_formats
+    ans = []
+    for outpath, results, record in scramble_ebook_formats(paths, dirout, dsettings, share_text=True):
+        print('%s --> %s' % (record['source'], outpath))
+        print(results)
+        ans.append(outpath)
+    return ans
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Verify that no original prose survives scrambling.
+# Every run of NGRAM_SIZE consecutive words found in the original book is
+# hashed into a sorted array. Then every text node, tail, attribute value
+# and comment of the scrambled book is checked against it. Scrambled words
+# are random letters, so any match is original text which the rules left
+# alone (alt/title attributes, extra NCX files, comments, metadata ...).
+# OPF metadata which the chosen rules keep on purpose, e.g. the title
+# without x_meta_extra, is not reported.
+
+import hashlib
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+from calibre.ebooks.oeb.base import OEB_DOCS, NCX_MIME, SVG_MIME
+
+NGRAM_SIZE = 4
+WORD_PAT = re.compile(r'[^\W\d_]+', re.UNICODE)
+# attributes which never carry prose
+SKIP_ATTRS = frozenset(('href', 'src', 'id', 'class', 'style', 'type', 'rel',
+    'lang', 'dir', 'width', 'height', 'viewBox', 'idref', 'playOrder',
+    'media-type', 'properties', 'version', 'xmlns', 'refines', 'scheme'))
+
+# OPF metadata changed by x_meta, and by x_meta_extra as well
+META_BASIC = frozenset(('description',))
+META_EXTRA = META_BASIC | frozenset(('title', 'creator', 'rights', 'publisher',
+    'source', 'subject'))
+
+Leak = namedtuple('Leak', 'name where text')
+
+class NgramIndex(object):
+    ''' A compact set of hashed word n-grams '''
+
+    def __init__(self, n=NGRAM_SIZE):
+        self.n = n
+        self.hashes = array('q')
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add_text(self, text):
+        words = tokenize(text)
+        n = self.n
+        self.hashes.extend(ngram_hash(words[i:i+n]) for i in range(len(words) - n + 1))
+
+    def finalize(self):
+        self.hashes = array('q', sorted(set(self.hashes)))
+
+    def __contains__(self, h):
+        i = bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def matches(self, text):
+        # (first, last) word index of each run of words found in the index
+        words = tokenize(text)
+        n = self.n
+        runs = []
+        for i in range(len(words) - n + 1):
+            if ngram_hash(words[i:i+n]) in self:
+                if runs and i <= runs[-1][1]:
+                    runs[-1][1] = i + n
+                else:
+                    runs.append([i, i + n])
+        return words, runs
+
+def tokenize(text):
+    return WORD_PAT.findall(text.lower())
+
+def ngram_hash(words):
+    # the same in every process, unlike hash()
+    digest = hashlib.blake2b(' '.join(words).encode('utf-8'), digest_size=8).digest()
+    return struct.unpack('<q', digest)[0]
+
+def kept_metadata(dsettings):
+    # skip(element) for the OPF: True for metadata the rules leave alone
+    if not dsettings.get('x_meta'):
+        changed = frozenset()
+    elif dsettings.get('x_meta_extra'):
+        changed = META_EXTRA
+    else:
+        changed = META_BASIC
+    def skip(e):
+        if callable(e.tag):
+            # x_meta removes comments from <metadata>
+            if dsettings.get('x_meta'):
+                return False
+        elif e.tag.rpartition('}')[-1] in changed:
+            return False
+        return any(a.tag.rpartition('}')[-1] == 'metadata' for a in e.iterancestors())
+    return skip
+
+def get_text_bearing_names(container):
+    names = []
+    for name, mt in sorted(container.mime_map.items()):
+        if mt in OEB_DOCS or mt in (NCX_MIME, SVG_MIME) or name == container.opf_name:
+            names.append(name)
+    return names
+
+def iter_text_pieces(root, skip=None):
+    # yield (where, text) for every piece of text in an lxml tree
+    for e in root.iter():
+        if skip is not None and skip(e):
+            continue
+        if callable(e.tag):
+            tag = 'comment'
+        else:
+            tag = e.tag.rpartition('}')[-1]
+            for k, v in e.attrib.items():
+                k = k.rpartition('}')[-1]
+                if v and k not in SKIP_ATTRS:
+                    yield '<%s %s> line %s' % (tag, k, e.sourceline), v
+        if e.text:
+            yield '<%s> line %s' % (tag, e.sourceline), e.text
+        if e.tail:
+            yield 'after <%s> line %s' % (tag, e.sourceline), e.tail
+
+def build_index(container, n=NGRAM_SIZE):
+    # must be called on the original, unscrambled book
+    index = NgramIndex(n)
+    for name in get_text_bearing_names(container):
+        for where, text in iter_text_pieces(container.parsed(name)):
+            index.add_text(text)
+    index.finalize()
+    return index
+
+def find_leaks(container, index, limit=None, dsettings={}):
+    # dsettings are the rules the book was scrambled with
+    leaks = []
+    if not len(index):
+        return leaks
+    skip_opf = kept_metadata(dsettings)
+    for name in get_text_bearing_names(container):
+        skip = skip_opf if name == container.opf_name else None
+        for where, text in iter_text_pieces(container.parsed(name), skip):
+            words, runs = index.matches(text)
+            for first, last in runs:
+                snippet = ' '.join(words[first:last])
+                if len(snippet) > 80:
+                    snippet = snippet[:77] + '...'
+                leaks.append(Leak(name, where, snippet))
+                if limit and len(leaks) >= limit:
+                    return leaks
+    return leaks
+
+def format_leaks(leaks, limit=20):
+    if not leaks:
+        return ['   Leak check: no original text found']
+    log = ['   Leak check: %d runs of original text found:' % len(leaks)]
+    for leak in leaks[:limit]:
+        log.append('      %s %s: "%s"' % (leak.name, leak.where, leak.text))
+    if len(leaks) > limit:
+        log.append('      ... and %d more' % (len(leaks) - limit))
+    return log
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Read access to the format files stored in a calibre library, without
+# copying them when it can be helped. A library file is cloned (reflink)
+# or hard linked into a working directory when both are on the same
+# filesystem. The working space is often elsewhere (e.g. /dev/shm), and
+# the file is then read where it is, which writes nothing; it is only
+# copied if it cannot be opened for reading. Nothing may ever be written
+# to, or deleted from, a library: check_writable() and is_library_path()
+# enforce that.
+
+import os
+import shutil
+import sys
+
+# ioctl to share a file's extents (btrfs, XFS, bcachefs ...)
+FICLONE = 0x40049409
+
+def normpath(path):
+    return os.path.normcase(os.path.realpath(os.path.abspath(path)))
+
+def is_library_path(path, calibre_libpaths):
+    path = normpath(path)
+    for lib in calibre_libpaths:
+        lib = normpath(lib)
+        if path == lib or path.startswith(lib.rstrip(os.sep) + os.sep):
+            return True
+    return False
+
+def reflink(src, dest):
+    import fcntl
+    try:
+        with open(src, 'rb') as s, open(dest, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except Exception:
+        try:
+            os.remove(dest)
+        except EnvironmentError:
+            pass
+        raise
+
+def open_library_file(path, tdir):
+    # Returns (path to read the book from, method), method being:
+    #   'reflink'  a private copy-on-write clone in tdir
+    #   'hardlink' another name for the library file, in tdir
+    #   'inplace'  the library file itself, when tdir is on another filesystem
+    #   'copy'     a private copy in tdir, if the file could not be opened
+    # A hard link or the file itself must only ever be read.
+    dest = os.path.join(tdir, os.path.basename(path))
+    if sys.platform.startswith('linux'):
+        try:
+            reflink(path, dest)
+            return dest, 'reflink'
+        except (EnvironmentError, ImportError):
+            pass
+    try:
+        os.link(path, dest)
+        return dest, 'hardlink'
+    except (EnvironmentError, AttributeError, NotImplementedError):
+        pass
+    try:
+        with open(path, 'rb'):
+            pass
+        return path, 'inplace'
+    except EnvironmentError:
+        pass
+    try:
+        shutil.copyfile(path, dest)
+    except EnvironmentError:
+        try:
+            os.remove(dest)
+        except EnvironmentError:
+            pass
+        raise
+    return dest, 'copy'
+
+def check_writable(path, calibre_libpaths, sources=()):
+    # refuse to write into a library, or over a (hard linked) source book
+    if is_library_path(path, calibre_libpaths):
+        raise ValueError('Refusing to write inside a calibre library: %s' % path)
+    if os.path.exists(path):
+        for src in sources:
+            if os.path.exists(src) and os.path.samefile(path, src):
+                raise ValueError('Refusing to overwrite the source book: %s' % path)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Log collector shared by the dialog and the command line. Lines are kept
+# in a ring buffer with a running sequence number, so a viewer can ask for
+# just the lines it has not shown yet instead of re-rendering the whole
+# history. Optionally every line is also written to a stream, as plain
+# text or as one JSON record per line. No Qt here.
+
+import json
+import time
+from collections import deque
+
+class LogSink(object):
+
+    def __init__(self, maxlines=10000, stream=None, structured=False):
+        self.lines = deque(maxlen=maxlines)
+        self.seq = 0                # number of lines ever appended
+        self.stream = stream
+        self.structured = structured
+        self.listeners = []
+
+    def append(self, text, level='info', **fields):
+        # text may hold several lines; fields are only used for records
+        new = text.split('\n')
+        self.lines.extend(new)
+        self.seq += len(new)
+        if self.stream is not None:
+            self.write(new, level, fields)
+        for listener in self.listeners:
+            listener()
+
+    def extend(self, texts):
+        texts = list(texts)
+        if texts:
+            self.append('\n'.join(texts))
+
+    def since(self, seq):
+        # (lines appended after seq which are still buffered, current seq)
+        n = min(self.seq - seq, len(self.lines))
+        if n <= 0:
+            return [], self.seq
+        # indexing a deque near its right end is cheap
+        return [self.lines[-i] for i in range(n, 0, -1)], self.seq
+
+    def text(self):
+        return '\n'.join(self.lines)
+
+    def write(self, lines, level, fields):
+        if self.structured:
+            now = round(time.time(), 3)
+            for line in lines:
+                rec = {'time': now, 'level': level, 'msg': line}
+                rec.update(fields)
+                self.stream.write(json.dumps(rec, sort_keys=True) + '\n')
+        else:
+            self.stream.write('\n'.join(lines) + '\n')
+        self.stream.flush()
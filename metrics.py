@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Machine readable metrics for headless and batch runs.
+# Each scrambled book produces a record (see new_book_record()) which is
+# returned to the caller, so records from pool workers can be collected by
+# the parent process. Metrics aggregates the records into counters and
+# histograms and writes them as JSON lines and in the Prometheus text
+# exposition format.
+
+import json
+import threading
+import time
+from collections import deque
+
+from polyglot.builtins import iteritems
+
+from calibre.utils.filenames import atomic_rename
+
+# histogram buckets for phase latencies, in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# samples kept per phase for percentiles
+MAX_SAMPLES = 10000
+PERCENTILES = (50, 90, 99)
+
+def new_book_record(source, format):
+    return {
+        'type': 'book',
+        'source': source,
+        'format': format,
+        'status': 'ok',
+        'error': None,
+        'bytes_in': 0,
+        'bytes_out': 0,
+        'bytes_saved': {},
+        'phases': {},
+        'cache': {},
+        'seed': None,
+        'time': time.time(),
+        }
+
+def failed_book_record(source, format, err):
+    ans = new_book_record(source, format)
+    ans['status'] = 'failed'
+    ans['error'] = '%s: %s' % (type(err).__name__, err)
+    return ans
+
+def percentile(sorted_samples, pc):
+    if not sorted_samples:
+        return 0
+    i = int(round((len(sorted_samples) - 1) * pc / 100.0))
+    return sorted_samples[i]
+
+def escape_label(v):
+    return ('%s' % v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    ''' Thread safe aggregate of book records '''
+
+    def __init__(self, jsonl_path=None, prom_path=None):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.jsonl_path, self.prom_path = jsonl_path, prom_path
+        self.books = {}             # (format, status) -> count
+        self.bytes_in = self.bytes_out = 0
+        self.cache = {}             # cache -> [hits, misses]
+        self.phase_counts = {}      # phase -> [count per bucket..., +Inf]
+        self.phase_sums = {}
+        self.phase_samples = {}     # phase -> deque of recent samples
+
+    def record_book(self, rec):
+        with self.lock:
+            k = (rec['format'], rec['status'])
+            self.books[k] = self.books.get(k, 0) + 1
+            self.bytes_in += rec['bytes_in']
+            self.bytes_out += rec['bytes_out']
+            for cache, (hits, misses) in iteritems(rec['cache']):
+                c = self.cache.setdefault(cache, [0, 0])
+                c[0] += hits
+                c[1] += misses
+            for phase, secs in iteritems(rec['phases']):
+                self.observe(phase, secs)
+            if rec['phases']:
+                self.observe('total', sum(rec['phases'].values()))
+        if self.jsonl_path:
+            self.write_jsonl(rec)
+        if self.prom_path:
+            self.write_prometheus(self.prom_path)
+
+    def observe(self, phase, secs):
+        counts = self.phase_counts.setdefault(phase, [0] * (len(BUCKETS) + 1))
+        for i, le in enumerate(BUCKETS):
+            if secs <= le:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.phase_sums[phase] = self.phase_sums.get(phase, 0) + secs
+        self.phase_samples.setdefault(phase, deque(maxlen=MAX_SAMPLES)).append(secs)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            done = sum(n for (k, n) in iteritems(self.books) if k[1] == 'ok')
+            failures = {}
+            for (fmt, status), n in iteritems(self.books):
+                if status != 'ok':
+                    failures[fmt] = failures.get(fmt, 0) + n
+            phases = {}
+            for phase, samples in iteritems(self.phase_samples):
+                ss = sorted(samples)
+                phases[phase] = {'count': sum(self.phase_counts[phase]),
+                    'sum': round(self.phase_sums[phase], 6)}
+                for pc in PERCENTILES:
+                    phases[phase]['p%d' % pc] = round(percentile(ss, pc), 6)
+            return {
+                'type': 'summary',
+                'time': time.time(),
+                'elapsed': round(elapsed, 3),
+                'books_ok': done,
+                'books_failed': sum(failures.values()),
+                'books_per_minute': round(done * 60.0 / elapsed, 3),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'failures_by_format': failures,
+                'cache_hit_rate': {c:round(h / float(h + m), 4) if h + m else 0
+                                   for (c, (h, m)) in iteritems(self.cache)},
+                'phases': phases,
+                }
+
+    def write_jsonl(self, rec):
+        line = json.dumps(rec, sort_keys=True) + '\n'
+        with self.lock:
+            with open(self.jsonl_path, 'ab') as f:
+                f.write(line.encode('utf-8'))
+
+    def prometheus(self):
+        lines = []
+        def metric(name, mtype, helptext):
+            lines.append('# HELP scrambleebook_%s %s' % (name, helptext))
+            lines.append('# TYPE scrambleebook_%s %s' % (name, mtype))
+
+        with self.lock:
+            metric('books_total', 'counter', 'Books processed')
+            for (fmt, status), n in sorted(iteritems(self.books)):
+                lines.append('scrambleebook_books_total{format="%s",status="%s"} %d' % (
+                    escape_label(fmt), escape_label(status), n))
+            metric('bytes_in_total', 'counter', 'Bytes of source books read')
+            lines.append('scrambleebook_bytes_in_total %d' % self.bytes_in)
+            metric('bytes_out_total', 'counter', 'Bytes of scrambled books written')
+            lines.append('scrambleebook_bytes_out_total %d' % self.bytes_out)
+            metric('cache_requests_total', 'counter', 'Cache lookups by result')
+            for cache, (hits, misses) in sorted(iteritems(self.cache)):
+                lines.append('scrambleebook_cache_requests_total{cache="%s",result="hit"} %d' % (cache, hits))
+                lines.append('scrambleebook_cache_requests_total{cache="%s",result="miss"} %d' % (cache, misses))
+            metric('phase_seconds', 'histogram', 'Time spent per phase of scrambling a book')
+            for phase, counts in sorted(iteritems(self.phase_counts)):
+                cum = 0
+                for le, n in zip(BUCKETS + ('+Inf',), counts):
+                    cum += n
+                    lines.append('scrambleebook_phase_seconds_bucket{phase="%s",le="%s"} %d' % (phase, le, cum))
+                lines.append('scrambleebook_phase_seconds_sum{phase="%s"} %f' % (phase, self.phase_sums[phase]))
+                lines.append('scrambleebook_phase_seconds_count{phase="%s"} %d' % (phase, cum))
+            metric('uptime_seconds', 'gauge', 'Seconds since metrics collection started')
+            lines.append('scrambleebook_uptime_seconds %f' % (time.time() - self.started))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # atomic, so a scraper never sees a partial file
+        text = self.prometheus()
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(text.encode('utf-8'))
+        atomic_rename(tmp, path)
+
+    def close(self):
+        # final summary line
+        if self.jsonl_path:
+            self.write_jsonl(self.snapshot())
+        if self.prom_path:
+            self.write_prometheus(self.prom_path)
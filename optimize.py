@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Post-scramble size optimizer (rule x_optimize), to get scrambled books
+# under forum upload limits. It only removes things:
+#   - manifest items which nothing links to, starting from the spine, the
+#     TOC, the cover, the guide and names_that_must_not_be_changed
+#   - CSS rules whose selectors match nothing in the book
+# and reports the bytes saved per category.
+# dedup_images() (rule x_imgdedup) keeps one file per distinct placeholder
+# image and points every reference at it.
+
+from polyglot.builtins import iteritems, itervalues
+
+from calibre.ebooks.oeb.base import (OEB_DOCS, OEB_STYLES, NCX_MIME, SVG_MIME,
+    OEB_RASTER_IMAGES)
+from calibre.ebooks.oeb.polish.container import OEB_FONTS
+
+def get_category(mt):
+    if mt in OEB_RASTER_IMAGES or mt == SVG_MIME:
+        return 'images'
+    if mt in OEB_FONTS:
+        return 'fonts'
+    if mt in OEB_STYLES:
+        return 'stylesheets'
+    if mt in OEB_DOCS:
+        return 'text'
+    return 'other'
+
+def get_root_names(ebook):
+    # names which must stay whether or not anything links to them
+    from calibre.ebooks.oeb.polish.cover import find_cover_image
+    roots = set(ebook.names_that_must_not_be_changed)
+    roots.add(ebook.opf_name)
+    roots.update(name for name, linear in ebook.spine_names)
+    id_map = ebook.manifest_id_map
+    for item in ebook.opf_xpath('//opf:manifest/opf:item'):
+        name = id_map.get(item.get('id'))
+        # NCX and EPUB 3 nav / cover-image and other special items
+        if name is not None and (item.get('properties') or ebook.mime_map.get(name) == NCX_MIME):
+            roots.add(name)
+        for attr in ('fallback', 'media-overlay'):
+            if item.get(attr) in id_map:
+                roots.add(id_map[item.get(attr)])
+    for meta in ebook.opf_xpath('//opf:meta[@name="cover" and @content]'):
+        if meta.get('content') in id_map:
+            roots.add(id_map[meta.get('content')])
+    for href in ebook.opf_xpath('//opf:guide/opf:reference/@href'):
+        name = ebook.href_to_name(href, ebook.opf_name)
+        if name is not None:
+            roots.add(name)
+    cover = find_cover_image(ebook)
+    if cover:
+        roots.add(cover)
+    return roots
+
+def get_pinned_names(ebook):
+    # names the OPF refers to by id or by special role, which must keep
+    # their manifest item
+    pinned = set(ebook.names_that_must_not_be_changed)
+    id_map = ebook.manifest_id_map
+    for item in ebook.opf_xpath('//opf:manifest/opf:item'):
+        if item.get('properties') and item.get('id') in id_map:
+            pinned.add(id_map[item.get('id')])
+        if item.get('fallback') in id_map:
+            pinned.add(id_map[item.get('fallback')])
+    for meta in ebook.opf_xpath('//opf:meta[@name="cover" and @content]'):
+        if meta.get('content') in id_map:
+            pinned.add(id_map[meta.get('content')])
+    return pinned
+
+def dedup_images(ebook, keys, saved, log):
+    # keys maps image names to the key of the placeholder that replaced
+    # them; images with the same key hold the same bytes. Returns the
+    # removed names
+    from calibre.ebooks.oeb.polish.replace import replace_links
+    pinned = get_pinned_names(ebook)
+    groups = {}
+    for name in sorted(keys):
+        if name in ebook.name_path_map:
+            groups.setdefault(keys[name], []).append(name)
+    link_map = {}
+    for names in itervalues(groups):
+        keep = ([n for n in names if n in pinned] or names)[0]
+        for name in names:
+            if name != keep and name not in pinned:
+                link_map[name] = keep
+    if not link_map:
+        return []
+    # XHTML and CSS, then the guide, the only place the OPF links by href
+    replace_links(ebook, link_map)
+    for ref in ebook.opf_xpath('//opf:guide/opf:reference[@href]'):
+        name = ebook.href_to_name(ref.get('href'), ebook.opf_name)
+        if name in link_map:
+            ref.set('href', ebook.name_to_href(link_map[name], ebook.opf_name))
+            ebook.dirty(ebook.opf_name)
+    for name in sorted(link_map):
+        saved['duplicate images'] = saved.get('duplicate images', 0) + ebook.filesize(name)
+        ebook.remove_item(name)
+        log.append('      - %s \t--> %s' % (name, link_map[name]))
+    return sorted(link_map)
+
+def iter_linked_names(ebook, name):
+    mt = ebook.mime_map.get(name)
+    if mt == NCX_MIME:
+        for src in ebook.parsed(name).xpath('//*[local-name()="content"]/@src'):
+            yield ebook.href_to_name(src, name)
+    elif mt in OEB_DOCS or mt in OEB_STYLES or mt == SVG_MIME:
+        for href in ebook.iterlinks(name, get_line_numbers=False):
+            yield ebook.href_to_name(href, name)
+
+def get_reachable_names(ebook):
+    # walk the link graph from the root names
+    reached = set()
+    todo = [n for n in get_root_names(ebook) if n in ebook.name_path_map]
+    while todo:
+        name = todo.pop()
+        if name in reached:
+            continue
+        reached.add(name)
+        for linked in iter_linked_names(ebook, name):
+            if linked is not None and linked not in reached and linked in ebook.name_path_map:
+                todo.append(linked)
+    return reached
+
+def remove_unreferenced(ebook, saved, log):
+    reached = get_reachable_names(ebook)
+    manifest = set(itervalues(ebook.manifest_id_map))
+    removed = []
+    for name in sorted(manifest - reached):
+        if name in ebook.names_that_must_not_be_changed:
+            continue
+        cat = get_category(ebook.mime_map.get(name))
+        saved[cat] = saved.get(cat, 0) + ebook.filesize(name)
+        ebook.remove_item(name)
+        removed.append(name)
+        log.append('      - unreferenced %s: %s' % (cat, name))
+    return removed
+
+def remove_unused_rules(ebook, saved, log):
+    # stylesheets and documents with <style> blocks may both shrink
+    from calibre.ebooks.oeb.polish.css import remove_unused_css
+    names = [n for n, mt in iteritems(ebook.mime_map) if mt in OEB_STYLES or mt in OEB_DOCS]
+    before = sum(ebook.filesize(n) for n in names)
+    messages = []
+    if remove_unused_css(ebook, report=messages.append):
+        saved['css rules'] = max(0, before - sum(ebook.filesize(n) for n in names))
+        log.extend('      - %s' % m for m in messages)
+
+def optimize_book(ebook, log):
+    # returns ({category: bytes saved}, [removed names]), and adds its
+    # report lines to log
+    saved = {}
+    removed = remove_unreferenced(ebook, saved, log)
+    remove_unused_rules(ebook, saved, log)
+    return saved, removed
+
+def format_saved(saved):
+    ans = ['   Bytes saved for upload:']
+    for cat, nbytes in sorted(iteritems(saved)):
+        ans.append('      %s: %d' % (cat, nbytes))
+    ans.append('      total: %d' % sum(itervalues(saved)))
+    return ans
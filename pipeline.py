@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Pipelined batch scrambling. Each book goes through three stages, load
+# (unzip), scramble and save (zip), and each stage runs in its own thread
+# with a bounded queue in between: while book N is scrambled, book N+1 is
+# already being unpacked and book N-1 is being written out.
+#
+# Threads are enough for this: unzipping, zipping and file I/O run in zlib
+# and the OS without holding the GIL, so they overlap with the pure Python
+# scrambling. Queue sizes bound the temporary space in use to about
+# prefetch + 3 books.
+
+import os
+import threading
+from functools import partial
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from calibre_plugins.scrambleebook_plugin.scramblecore import (load_book,
+    scramble_book, save_book)
+from calibre_plugins.scrambleebook_plugin.tempspace import get_tempspace
+
+class Job(object):
+    ''' One book travelling through the pipeline '''
+    def __init__(self, path):
+        self.path = path
+        self.tdir = self.ebook = self.record = None
+        self.outpath = self.results = None
+        self.err = None
+
+class Pipeline(object):
+
+    def __init__(self, dirout, dsettings={}, prefetch=1, lazy=False,
+            use_mmap=False, verify=False, seed=None):
+        self.dirout = dirout
+        self.dsettings = dsettings
+        self.prefetch = max(1, prefetch)
+        self.lazy, self.use_mmap, self.verify = lazy, use_mmap, verify
+        self.seed = seed
+        self.space = get_tempspace()
+
+    def run(self, books, started=None, done=None):
+        # started(path) is called as a loaded book starts being scrambled,
+        # not while it only waits in the prefetch queue, and
+        # done(path, (outpath, results, record), err) once it is saved or
+        # has failed, in the order of books
+        loaded = queue.Queue(self.prefetch)
+        scrambled = queue.Queue(1)
+        stop = threading.Event()
+        errors = []
+
+        def load_stage():
+            try:
+                for path in books:
+                    if stop.is_set():
+                        break
+                    job = Job(path)
+                    try:
+                        self.space.check(needed=os.path.getsize(path))
+                        job.tdir = self.space.mkdtemp('_scramble_book')
+                        job.ebook, job.record = load_book(path, job.tdir,
+                            lazy=self.lazy, use_mmap=self.use_mmap)
+                        self.space.check(job.tdir)
+                    except Exception as err:
+                        job.err = err
+                    loaded.put(job)
+            except Exception as err:
+                errors.append(err)
+                stop.set()
+            finally:
+                loaded.put(None)
+
+        def save_stage():
+            while True:
+                job = scrambled.get()
+                if job is None:
+                    break
+                try:
+                    if job.err is None and not stop.is_set():
+                        try:
+                            job.outpath = save_book(job.ebook, job.record, job.path, self.dirout,
+                                reproducible=self.seed is not None,
+                                check=partial(self.space.check, job.tdir))
+                        except Exception as err:
+                            job.err = err
+                    self.release(job)
+                    if done is not None and not stop.is_set():
+                        done(job.path, (job.outpath, job.results, job.record), job.err)
+                except Exception as err:
+                    errors.append(err)
+                    stop.set()
+
+        loader = threading.Thread(target=load_stage, name='ScrambleLoader')
+        saver = threading.Thread(target=save_stage, name='ScrambleSaver')
+        loader.daemon = saver.daemon = True
+        loader.start()
+        saver.start()
+        job = None
+        try:
+            while True:
+                job = loaded.get()
+                if job is None:
+                    break
+                if job.err is None and not stop.is_set():
+                    if started is not None:
+                        started(job.path)
+                    try:
+                        scrambler = scramble_book(job.ebook, job.record, self.dsettings,
+                            verify=self.verify, seed=self.seed,
+                            check=partial(self.space.check, job.tdir))
+                        job.results = scrambler.results
+                    except Exception as err:
+                        job.err = err
+                scrambled.put(job)
+                job = None
+        except BaseException:
+            # e.g. KeyboardInterrupt: drop what is in flight, let the
+            # loader finish its current book and clean up after it
+            stop.set()
+            if job is not None:
+                self.release(job)
+            while True:
+                job = loaded.get()
+                if job is None:
+                    break
+                self.release(job)
+            raise
+        finally:
+            scrambled.put(None)
+            saver.join()
+            loader.join()
+        if errors:
+            raise errors[0]
+
+    def release(self, job):
+        if job.ebook is not None and hasattr(job.ebook, 'close_source'):
+            job.ebook.close_source()
+        if job.tdir is not None:
+            self.space.remove(job.tdir)
+        job.ebook = job.tdir = None
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Worker pools for headless scrambling. Worker processes must be able to
+# import calibre_plugins.*, which only works when they are forked from a
+# process that already loaded the plugin. Where fork is not available
+# (Windows, frozen macOS builds) a thread pool is used instead.
+
+import multiprocessing
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def can_fork():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+def create_executor(workers=None):
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    workers = workers or cpu_count()
+    if can_fork():
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'))
+    return ThreadPoolExecutor(workers)
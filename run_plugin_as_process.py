@@ -7,13 +7,19 @@ def main(path_to_ebook, book_id, from_calibre, calibre_libpaths):
     # See uiaction.py show_dialog() for the call which launches this function
     # via self.gui.job_manager.launch_gui_app()
 
+    # The process stays alive after the dialog is closed and is sent any
+    # further books over a local socket (see warmworker.py), so later
+    # launches open almost instantly. It exits after an idle timeout.
+
     # This import must happen before creating the Application() object
     from PyQt5.QtWebEngineWidgets import QWebEngineView
     from calibre.gui2 import Application
-    from calibre_plugins.scrambleebook_plugin.scrambleebook import EbookScramble
+    from calibre_plugins.scrambleebook_plugin.scrambleebook import EbookScrambleWorker
 
     app = Application([])
-    w = EbookScramble(path_to_ebook, book_id=book_id, from_calibre=from_calibre, calibre_libpaths=calibre_libpaths)
-    w.show()
-    w.raise_()
+    app.setQuitOnLastWindowClosed(False)
+    worker = EbookScrambleWorker(app)
+    worker.open_dialog(dict(path_to_ebook=path_to_ebook, book_id=book_id,
+        from_calibre=from_calibre, calibre_libpaths=calibre_libpaths))
     app.exec_()
+    worker.shutdown()
@@ -0,0 +1,811 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# The scrambling engine and its helpers. This module must not import Qt so
+# it can be used by calibre at GUI startup, by worker processes and by the
+# command line without paying for the GUI libraries. The heavier calibre
+# modules (magick, polish checks) are only imported when first needed.
+
+import binascii
+import filecmp
+import hashlib
+import os
+import random
+import re
+import shutil
+import time
+from functools import partial
+
+from lxml import etree
+
+from polyglot.builtins import iteritems, itervalues, unicode_type
+
+from calibre.utils.filenames import ascii_text
+from calibre.ebooks.oeb.base import (OEB_DOCS, OEB_STYLES, NCX_MIME, SVG_MIME, OEB_RASTER_IMAGES)
+from calibre.ebooks.oeb.polish.container import (Container, OEB_FONTS)
+
+MR_SETTINGS = {
+    'x_dgts': True,
+    'x_html': True,
+    'keep_num_link': True,
+    'x_extlink': False,
+    'x_toc': True,
+    'x_imgs': True,
+    'keep_cover': False,
+    'x_imgdedup': False,
+    'x_fontsno': True,
+    'x_fontsob': False,
+    'x_meta': True,
+    'x_meta_extra': False,
+    'x_fnames': False,
+    'x_optimize': False
+    }
+
+# queries run on every document, compiled once per process
+XP_TITLE = etree.XPath("//*[local-name()='title']")
+XP_BODY = etree.XPath("//*[local-name()='body']")
+XP_LINKS = etree.XPath('//*[local-name()="a" and @href]')
+XP_NCX_TEXT = etree.XPath("//*[local-name()='text']")
+
+# replacement for a character, indexed by a random byte. Each table is the
+# largest whole multiple of its alphabet that fits in a byte; bytes past
+# the end are drawn again, so every replacement is equally likely
+LOWER_PICKS = tuple('abcdefghijklmnopqrstuvwxyz' * (256 // 26))
+UPPER_PICKS = tuple(c.upper() for c in LOWER_PICKS)
+DIGIT_PICKS = tuple('0123456789' * (256 // 10))
+
+
+class EbookScrambleAction():
+    ''' Main scrambling routines '''
+    def __init__(self, ebook, dsettings, dummyimg, dummysvg, shared=None, seed=None, run=True,
+                 check=None):
+        self.eb = ebook
+
+        self.dsettings = dsettings.copy()
+        self.dummyimg, self.dummysvg = dummyimg, dummysvg
+
+        # every document gets its own generator derived from the seed, so
+        # the same seed always gives the same book
+        self.seed = new_seed() if seed is None else seed
+        self.rng = derive_rng(self.seed)
+        # char -> random byte indexed picks, or None to keep it
+        self.picks = ({}, {})
+        self.log = []
+        self.file_map = {}
+        # seconds per phase, and (hits, misses) per cache, for metrics.py
+        self.timings = {}
+        self.cache_stats = {}
+        self.bytes_saved = {}
+        self.removed_names = []
+        # replaced image name -> placeholder key, for x_imgdedup
+        self.replaced = {}
+        # caches which may be shared with the scramblers of other formats
+        # of the same book, see new_shared_state()
+        self.shared = new_shared_state() if shared is None else shared
+        self.placeholders = self.shared['placeholders']
+        self.imginfo = self.shared['images']
+        self.text_map = self.shared['text']
+        self.dummykey = hashlib.sha1(dummyimg).hexdigest()
+        # called after every phase, e.g. to enforce a temp space quota
+        self.check = check
+
+        if run:
+            self.scramble_main()
+
+    @property
+    def results(self):
+        return '\n'.join(self.log)
+
+    def lap(self, phase=None):
+        # charge the time since the previous lap to phase
+        now = time.time()
+        if phase is not None:
+            self.timings[phase] = self.timings.get(phase, 0) + now - self.lap_start
+            if self.check is not None:
+                self.check()
+        self.lap_start = now
+
+    def count_cache(self, cache, hit):
+        hits, misses = self.cache_stats.get(cache, (0, 0))
+        self.cache_stats[cache] = (hits + 1, misses) if hit else (hits, misses + 1)
+
+    def scramble_main(self):
+        # NB: an epub3 nav.xhtml file will currently be scrambled by HTML rules not NCX rules
+        self.lap()
+        textnames = get_textnames(self.eb)
+        if self.dsettings['x_html']:
+            [self.scramble_html(n, scramble_dgts=self.dsettings['x_dgts']) for n in textnames]
+            self.log.append('   Scrambled text content')
+        self.lap('text')
+
+        self.ncxnames = get_ncxnames(self.eb)
+        # no need to scramble digits in a TOC
+        if self.dsettings['x_toc']:
+            if len(self.ncxnames) > 0:
+                self.scramble_toc(self.ncxnames[0], scramble_dgts=False)
+                self.log.append('   Scrambled TOC')
+        self.lap('toc')
+
+        svgnames = get_imgnames(self.eb, SVG_MIME)
+        imgnames = get_imgnames(self.eb, OEB_RASTER_IMAGES)
+        if self.dsettings['x_imgs']:
+            from calibre.ebooks.oeb.polish.cover import find_cover_image
+            cover_img_name = find_cover_image(self.eb, strict=True)
+            cover_img_names = []
+            if self.dsettings['keep_cover']:
+                if cover_img_name:
+                    cover_img_names.append(cover_img_name)
+            [self.scramble_img(n) for n in imgnames if n not in cover_img_names]
+            for svgn in [n for n in svgnames if n not in cover_img_names]:
+                #self.eb.remove_item(svgn)
+                data = self.eb.parsed(svgn)
+                self.eb.replace(svgn, self.dummysvg)
+                self.replaced[svgn] = (self.dummykey, 'svg')
+            self.log.append('   Replaced images')
+        self.lap('images')
+
+        if self.dsettings['x_imgs'] and self.dsettings['x_imgdedup'] and self.replaced:
+            from calibre_plugins.scrambleebook_plugin.optimize import dedup_images
+            self.log.append('   Stored identical placeholder images once:')
+            removed = dedup_images(self.eb, self.replaced, self.bytes_saved, self.log)
+            self.removed_names.extend(removed)
+            if not removed:
+                self.log.append('      (none)')
+        self.lap('dedup')
+
+        fontnames = get_fontnames(self.eb)
+        if len(fontnames) > 0 and (self.dsettings['x_fontsno'] or self.dsettings['x_fontsob']):
+            self.log.append('   Removed these fonts:')
+        if self.dsettings['x_fontsno']:
+            # remove non-obfuscated embedded fonts
+            for name in [n for n in fontnames if n not in self.eb.obfuscated_fonts]:
+                self.eb.remove_item(name)
+                self.log.append('      - non-obfuscated font: %s' % name)
+        if self.dsettings['x_fontsob']:
+            # remove obfuscated embedded fonts
+            for name in [n for n in self.eb.obfuscated_fonts]:
+                self.eb.remove_item(name)
+                self.log.append('      - obfuscated font: %s' % name)
+        self.lap('fonts')
+
+        if self.dsettings['x_meta']:
+            self.scramble_metadata()
+            msg = '   Removed basic metadata'
+            if self.dsettings['x_meta_extra']:
+                msg += ' & extra metadata'
+            self.log.append(msg)
+        self.lap('metadata')
+
+        if self.dsettings['x_fnames']:
+            # a property which rebuilds a set on every access
+            fixed_names = self.eb.names_that_must_not_be_changed
+            spine_names = tuple([n for n in get_spinenames(self.eb) if n not in fixed_names])
+            self.scramble_filenames(spine_names, 'txcontent_')
+
+            # x_imgdedup may have removed some
+            imgnames = get_imgnames(self.eb, OEB_RASTER_IMAGES)
+            svgnames = get_imgnames(self.eb, SVG_MIME)
+            img_names = tuple([n for n in imgnames + svgnames if n not in fixed_names])
+            self.scramble_filenames(img_names, 'img_')
+
+            css_names = tuple([n for n in get_cssnames(self.eb) if n not in fixed_names])
+            self.scramble_filenames(css_names, 'style_')
+
+        if self.file_map:
+            from calibre.ebooks.oeb.polish.replace import rename_files
+            rename_files(self.eb, self.file_map)
+            self.log.append('   Renamed internal files:')
+            [self.log.append('      %s \t--> %s' % (old, self.file_map.get(old, old))) for old in spine_names + img_names + css_names]
+        self.lap('filenames')
+
+        if self.dsettings['x_optimize']:
+            from calibre_plugins.scrambleebook_plugin.optimize import optimize_book, format_saved
+            self.log.append('   Removed for upload size:')
+            saved, removed = optimize_book(self.eb, self.log)
+            self.bytes_saved.update(saved)
+            self.removed_names.extend(removed)
+            self.log.extend(format_saved(self.bytes_saved))
+        self.lap('optimize')
+
+    def scramble_html(self, name, scramble_dgts=False):
+        self.rng = derive_rng(self.seed, 'html', name)
+        root = self.eb.parsed(name)
+        for e in XP_TITLE(root):
+            e.text = 'Scrambled'
+
+        bodys = XP_BODY(root)
+        if len(bodys) == 0: return
+
+        delinks = {}
+        body0 = bodys[0]
+        if self.dsettings['x_extlink'] or (self.dsettings['keep_num_link'] and self.dsettings['x_dgts']):
+            for anch in XP_LINKS(body0):
+                ahref = anch.get('href')
+                ahrefname = name if ahref.startswith('#') else self.eb.href_to_name(ahref, name)
+                if ahrefname is None:
+                    if self.dsettings['x_extlink']:
+                        anch.attrib.pop('href')
+                elif self.dsettings['keep_num_link'] and self.dsettings['x_dgts']:
+                    alltext = []
+                    [alltext.append(tx) for tx in anch.itertext('*')]
+                    atext = ''.join(alltext)
+                    num = [c.lower() != c.upper() for c in atext].count(True)
+                    if num < 1:
+                        # scramble (text, tail)
+                        delinks[anch] = (False, True)
+                        for e in anch.iterdescendants('*'):
+                            delinks[e] = (False, False)
+
+        # Collect every text and tail first and scramble them as one run.
+        # KEPUBs wrap each sentence in a koboSpan, so there are several
+        # text nodes per paragraph; lengths are kept, so span boundaries
+        # and ids stay exactly where they were.
+        slots, texts = [], []
+        for be in body0.iterdescendants('*'):
+            do_text, do_tail = delinks.get(be, (True, True)) if delinks else (True, True)
+            if do_text and be.text:
+                slots.append((be, 'text'))
+                texts.append(be.text)
+            if do_tail and be.tail:
+                slots.append((be, 'tail'))
+                texts.append(be.tail)
+        for (be, attr), text in zip(slots, self.scramble_texts(texts, scramble_dgts)):
+            setattr(be, attr, text)
+
+        self.eb.dirty(name)
+
+    def scramble_toc(self, name, scramble_dgts=False):
+        self.rng = derive_rng(self.seed, 'toc', name)
+        root = self.eb.parsed(name)
+        [self.scramble_ele(e, scramble_dgts) for e in XP_NCX_TEXT(root)]
+        self.eb.dirty(name)
+
+    def scramble_img(self, name, scramble_dgts=False):
+        if self.eb.mime_map[name] in OEB_RASTER_IMAGES:
+            from calibre.utils.magick import Image
+            data = self.eb.parsed(name)
+            # the same picture usually appears in every format of a book
+            digest = hashlib.sha1(data).hexdigest()
+            info = self.imginfo.get(digest)
+            self.count_cache('image', info is not None)
+            if info is None:
+                oldimg = Image()
+                try:
+                    oldimg.load(data)
+                    wid, hgt = oldimg.size
+                except:
+                    wid, hgt = (50, 50)
+                try:
+                    fmt = oldimg.format
+                except:
+                    x, x, fmt = get_nameparts(name)
+                info = self.imginfo[digest] = (wid, hgt, fmt.upper())
+            wid, hgt, fmt = info
+
+            # placeholders only depend on the dummy image, size and format
+            key = (self.dummykey, wid, hgt, fmt)
+            data = self.placeholders.get(key)
+            self.count_cache('placeholder', data is not None)
+            if data is None:
+                newimg = Image()
+                newimg.load(self.dummyimg)
+                newimg.size = (wid, hgt)
+                data = self.placeholders[key] = newimg.export(fmt)
+
+            self.eb.replace(name, data)
+            self.replaced[name] = key
+
+
+    def scramble_ele(self, ele, scramble_dgts, do_text_tail=(True, True)):
+        do_text, do_tail = do_text_tail
+        if do_text:
+            ele.text = self.scramble_text(ele.text, scramble_dgts)
+        if do_tail:
+            ele.tail = self.scramble_text(ele.tail, scramble_dgts)
+
+
+    def get_picks(self, char, scramble_dgts):
+        picks = None
+        if char.upper() != char.lower():
+            if char == char.lower():
+                picks = LOWER_PICKS
+            elif char == char.upper():
+                picks = UPPER_PICKS
+        elif scramble_dgts and char in '0123456789':
+            picks = DIGIT_PICKS
+        self.picks[scramble_dgts][char] = picks
+        return picks
+
+    def scramble_chars(self, text, scramble_dgts):
+        # one random byte per character, drawn in a single call
+        # (plus one more for each byte a table rejects)
+        cache = self.picks[scramble_dgts]
+        ans = []
+        for char, r in zip(text, random_bytes(self.rng, len(text))):
+            picks = cache[char] if char in cache else self.get_picks(char, scramble_dgts)
+            if picks is None:
+                ans.append(char)
+                continue
+            while r >= len(picks):
+                r = self.rng.getrandbits(8)
+            ans.append(picks[r])
+        return ''.join(ans)
+
+
+    def scramble_texts(self, texts, scramble_dgts):
+        # scramble a list of strings with a single random draw
+        if self.text_map is not None:
+            # keep identical text identical across the formats of a book
+            todo = []
+            for text in texts:
+                key = (text, scramble_dgts)
+                if key not in self.text_map:
+                    self.text_map[key] = None
+                    todo.append(text)
+            for text, ans in zip(todo, self.split_run(todo, scramble_dgts)):
+                self.text_map[(text, scramble_dgts)] = ans
+            return [self.text_map[(text, scramble_dgts)] for text in texts]
+        return self.split_run(texts, scramble_dgts)
+
+    def split_run(self, texts, scramble_dgts):
+        run = self.scramble_chars(''.join(texts), scramble_dgts)
+        ans, pos = [], 0
+        for text in texts:
+            ans.append(run[pos:pos + len(text)])
+            pos += len(text)
+        return ans
+
+
+    def scramble_text(self, text, scramble_dgts):
+        if not text: return text
+        if self.text_map is None:
+            return self.scramble_chars(text, scramble_dgts)
+        # keep identical text identical across the formats of a book
+        key = (text, scramble_dgts)
+        ans = self.text_map.get(key)
+        if ans is None:
+            ans = self.text_map[key] = self.scramble_chars(text, scramble_dgts)
+        return ans
+
+
+    def scramble_filenames(self, names, base):
+        if len(names) == 0: return
+
+        dgts = len(str(len(names)))
+        fns = [get_nameparts(n)[1] for n in names]
+
+        newbase = get_newbase(base, fns)
+
+        i = 0
+        for name in names:
+            dir, fn, ext = get_nameparts(name)
+            nname = newbase + str(i).zfill(dgts) + '.' + ext
+            if dir:
+                nname = '/'.join((dir, nname))
+            self.file_map[name] = nname
+            i += 1
+
+
+    def scramble_metadata(self):
+
+        def reset_package_uid(uidname, uidval):
+            idents = self.eb.opf_xpath('//*[local-name()="identifier" and @id]')
+            ident = idents[0] if idents else None
+            if pk is not None:
+                pk.set('unique-identifier', uidname)
+            if ident is not None:
+                ident.set('id', uidname)
+                ident.text = uidval
+            if len(self.ncxnames) > 0:
+                ncxname = self.ncxnames[0]
+                ncxroot = self.eb.parsed(ncxname)
+                dtbuids = ncxroot.xpath('//*[local-name()="meta" and @name="dtb:uid"]')
+                dtbuid = dtbuids[0] if dtbuids else None
+                if dtbuid is not None:
+                    dtbuid.set('content', uidval)
+                    self.eb.dirty(ncxname)
+
+        to_remove = []
+        pk = None
+
+        # remove <metadata> comments found in Amazon books
+        for child in [e for e in self.eb.opf_xpath('//opf:metadata')[0]]:
+            try:
+                tag = child.tag.rpartition('}')[-1]
+            except:
+                to_remove.append(child)
+
+        # remove all calibre <meta> items
+        for meta in self.eb.opf_xpath('//opf:metadata/opf:meta'):
+            if [val for val in itervalues(meta.attrib) if val.startswith('calibre:')]:
+                to_remove.append(meta)
+
+        if self.dsettings['x_meta_extra']:
+            for meta in self.eb.opf_xpath('//opf:metadata/opf:meta[@property]'):
+                if meta.get('property').startswith('dcterms:'):
+                    # remove all dcterms <meta> @property items
+                    to_remove.append(meta)
+                elif meta.get('property')=='file-as':
+                    # anonymise all <meta> with property "file-as"
+                    meta.text = 'Anon'
+
+            #get the <package> unique-identifier
+            pk = self.eb.opf_xpath('//opf:package')[0]
+            pk_uid = pk.get('unique-identifier')
+
+            # remove all dc:identifier except the one which matches package unique-identifier
+            for ident in self.eb.opf_xpath('//*[local-name()="metadata"]/*[local-name()="identifier"]'):
+                if ident.get('id', '') != pk_uid:
+                    to_remove.append(ident)
+
+        # remove the elements from <metadata>
+        md = self.eb.opf_xpath('//opf:metadata')[0]
+        [md.remove(child) for child in to_remove]
+
+        # obscure some dc: items.
+        dcitems = ('description',)
+        searchpath = '//*[' + ' or '.join(['local-name()="%s"' % dc for dc in dcitems]) + ']'
+        for elem in [e for e in self.eb.opf_xpath(searchpath)]:
+            elem.text = '*removed*'
+            elem.attrib.clear()
+
+        if self.dsettings['x_meta_extra']:
+            # obscure more dc: items
+            dcitems = ('title', 'creator', 'rights', 'publisher', 'source', 'subject')
+            searchpath = '//*[' + ' or '.join(['local-name()="%s"' % dc for dc in dcitems]) + ']'
+            for elem in [e for e in self.eb.opf_xpath(searchpath)]:
+                # do not remove all attribs. needed for epub3 creator/title
+                #elem.attrib.clear()
+                if elem.tag.lower().endswith(('title', 'creator')):
+                    elem.text = 'Anon'
+                elif elem.text is not None:
+                    elem.text = '*removed*'
+
+        if self.dsettings['x_meta_extra']:
+            reset_package_uid('bookid', 'unknown')
+
+        self.eb.dirty(self.eb.opf_name)
+
+# ####################################################################
+
+def new_shared_state(share_text=False):
+    # Caches shared by the scramblers of several formats of one book:
+    # original image (width, height, format) keyed by content hash,
+    # finished placeholder images, and optionally original -> scrambled
+    # text so the same passage reads the same in every format
+    return {
+        'images': {},
+        'placeholders': {},
+        'text': {} if share_text else None,
+        }
+
+def scramble_document(ebook, name, dsettings, dummyimg, dummysvg):
+    # Scramble just one text document, and the images it shows, to preview
+    # the rules without a full run. The rest of the book is left alone.
+    # Changes are written to disk for the viewer. Returns the scrambler
+    settings = MR_SETTINGS.copy()
+    settings.update(dsettings)
+    scrambler = EbookScrambleAction(ebook, settings, dummyimg, dummysvg, run=False)
+    if settings['x_html']:
+        scrambler.scramble_html(name, scramble_dgts=settings['x_dgts'])
+    if settings['x_imgs']:
+        cover = None
+        if settings['keep_cover']:
+            from calibre.ebooks.oeb.polish.cover import find_cover_image
+            cover = find_cover_image(ebook, strict=True)
+        for href in ebook.iterlinks(name, get_line_numbers=False):
+            iname = ebook.href_to_name(href, name)
+            if iname is None or iname == cover or iname in scrambler.replaced:
+                continue
+            mt = ebook.mime_map.get(iname)
+            if mt in OEB_RASTER_IMAGES:
+                scrambler.scramble_img(iname)
+            elif mt == SVG_MIME:
+                ebook.replace(iname, dummysvg)
+                scrambler.replaced[iname] = (scrambler.dummykey, 'svg')
+    for dname in list(ebook.dirtied):
+        ebook.commit_item(dname, keep_parsed=True)
+    return scrambler
+
+def new_seed():
+    return int(binascii.hexlify(os.urandom(8)), 16)
+
+def derive_rng(seed, *parts):
+    # independent generator for one part of a run, e.g. ('html', name),
+    # so the result does not depend on the order parts are scrambled in
+    key = '\0'.join(['%d' % seed] + list(parts))
+    return random.Random(int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16))
+
+def random_bytes(rng, n):
+    if n <= 0:
+        return bytearray()
+    if hasattr(rng, 'randbytes'):
+        # Python 3.9+
+        return rng.randbytes(n)
+    return bytearray(binascii.unhexlify('%0*x' % (2 * n, rng.getrandbits(8 * n))))
+
+def get_run_check_error(ebook):
+    from calibre.ebooks.oeb.polish.check.main import run_checks
+    ans = []
+    errors = run_checks(ebook)
+    for err in errors:
+        lev = err.level
+        n = err.name
+        msg = err.msg
+        ans.append((lev, msg, n))
+
+    dans = {}
+    for lev, msg, n in ans:
+        k = (lev, msg)
+        dans[k] = dans.get(k, 0) + 1
+    return dans
+
+def reset_container(ebook, eborig):
+    # Restore a scrambled container to the state of its pristine clone.
+    # Untouched files are still hard links to the clone, so only files
+    # which were changed, renamed or removed on disk are relinked.
+    # Unsaved changes held in the parsed cache are simply discarded.
+    root = ebook.root
+    name_path_map = {}
+    for (name, opath) in iteritems(eborig.name_path_map):
+        name_path_map[name] = os.path.join(root, os.path.relpath(opath, eborig.root))
+    wanted = {path:eborig.name_path_map[name] for (name, path) in iteritems(name_path_map)}
+
+    # remove files added or renamed by scrambling
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fn in filenames:
+            path = os.path.join(dirpath, fn)
+            if path not in wanted:
+                os.remove(path)
+
+    lazy_members = []
+    for path, opath in iteritems(wanted):
+        if not os.path.exists(opath):
+            # never extracted from a zip backed book (see zipcontainer.py)
+            lazy_members.append(eborig.abspath_to_name(opath))
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        if os.path.exists(path):
+            if os.path.samefile(path, opath) or filecmp.cmp(path, opath):
+                continue
+            os.remove(path)
+        else:
+            dirn = os.path.dirname(path)
+            if not os.path.exists(dirn):
+                os.makedirs(dirn)
+        try:
+            os.link(opath, path)
+        except:
+            shutil.copy2(opath, path)
+
+    clone_data = {
+        'root': root,
+        'opf_name': eborig.opf_name,
+        'mime_map': eborig.mime_map.copy(),
+        'pretty_print': set(eborig.pretty_print),
+        'encoding_map': eborig.encoding_map.copy(),
+        'tweak_mode': eborig.tweak_mode,
+        'name_path_map': name_path_map,
+        'obfuscated_fonts': eborig.obfuscated_fonts.copy(),
+        }
+    for k in ('pathtoepub', 'pathtoazw3', 'is_dir', 'use_mmap'):
+        if hasattr(eborig, k):
+            clone_data[k] = getattr(eborig, k)
+    if hasattr(eborig, 'lazy_members'):
+        clone_data['lazy_members'] = lazy_members
+
+    cls = type(eborig)
+    if cls is Container:
+        ans = cls(None, None, eborig.log, clone_data=clone_data)
+    else:
+        ans = cls(None, eborig.log, clone_data=clone_data)
+    # files are shared with eborig, so writes must break the links first
+    ans.cloned = True
+    return ans
+
+def get_metadata(ebook):
+    opf_raw = ebook.raw_data(ebook.opf_name)
+    res = re.findall(r'<[^<>]*package.+metadata>', opf_raw, re.I | re.S)
+    return res[0] if res else ''
+
+def get_textnames(ebook):
+    # return doc names in spine order + any non-spine docs (e.g. nav.xhtml)
+    names = list(get_spinenames(ebook))
+    spine = set(names)
+    others = [n for (n, m) in sorted(iteritems(ebook.mime_map)) if m in OEB_DOCS and n not in spine]
+    return tuple(names + others)
+
+def get_spinenames(ebook):
+    return tuple([n for (n, lin) in ebook.spine_names])
+
+def get_ncxnames(ebook):
+    names = [n for (n, m) in iteritems(ebook.mime_map) if m == NCX_MIME]
+    if not names:
+        [names.append(n) for n in ebook.mime_map if n.rpartition('.')[-1] == 'ncx']
+    return tuple(names)
+
+def get_imgnames(ebook, mtypes):
+    if isinstance(mtypes, unicode_type):
+        mtypes = [mtypes]
+    return tuple(sorted([n for (n, m) in iteritems(ebook.mime_map) if m in mtypes]))
+
+def get_fontnames(ebook):
+    # sometimes embedded fonts have an incorrect media-type
+    names = set([n for (n, m) in iteritems(ebook.mime_map) if m in OEB_FONTS])
+    [names.add(n) for n in ebook.mime_map if n.rpartition('.')[-1] in ('otf', 'ttf')]
+    return tuple(sorted(names))
+
+def get_cssnames(ebook):
+    names = set([n for (n, m) in iteritems(ebook.mime_map) if m in OEB_STYLES])
+    [names.add(n) for n in ebook.mime_map if n.rpartition('.')[-1] == 'css']
+    return tuple(sorted(names))
+
+def get_newbase(base, fns):
+    # Shortest of base, base1, base2, ... which is not a prefix of any of
+    # the file names fns. Found in one pass: a name can only rule out the
+    # numbers its leading digits after base spell.
+    taken = set()
+    for fn in fns:
+        if fn.startswith(base):
+            taken.add(0)
+            digits = re.match(r'[1-9][0-9]{0,17}', fn[len(base):])
+            if digits:
+                d = digits.group()
+                taken.update(int(d[:l]) for l in range(1, len(d) + 1))
+    i = 0
+    while i in taken:
+        i += 1
+    return base + str(i) if i else base
+
+def get_nameparts(name):
+    dirname, fe = name.rpartition('/')[0::2]
+    fn, ext = fe.rpartition('.')[0::2]
+    return (dirname, fn, ext)
+
+def get_fileparts(path):
+    abspath = os.path.normpath(os.path.abspath(path))
+    dirname, basename = os.path.split(abspath)
+    fn, ext1 = os.path.splitext(basename)
+    ext = ext1.rpartition('.')[-1]
+    is_kepub_epub = fn.rpartition('.')[-1].lower() == 'kepub'
+    return (dirname, fn, ext, is_kepub_epub)
+
+def get_book_format(path):
+    # 'azw3', 'epub' or 'kepub'
+    x, x, ext, is_kepub_epub = get_fileparts(path)
+    return 'kepub' if is_kepub_epub else ext.lower()
+
+def get_scrambled_fname(path):
+    x, fname, ext, is_kepub_epub = get_fileparts(path)
+    fn = fname + '_scrambled.'
+    fn += 'kepub.' + ext if is_kepub_epub else ext
+    return ascii_text(fn)
+
+def get_dummy_images(format):
+    # placeholder (raster, svg) images for a book format
+    return (get_resources('images/' + format + '.png'),
+            get_resources('images/' + format + '.svg'))
+
+def load_book(pathtoebook, tdir, lazy=False, use_mmap=False):
+    # First stage of scramble_ebook(): open a book into tdir.
+    # Returns (container, metrics record)
+    from calibre_plugins.scrambleebook_plugin.metrics import new_book_record
+    from calibre_plugins.scrambleebook_plugin.zipcontainer import get_book_container
+    record = new_book_record(pathtoebook, get_book_format(pathtoebook))
+    record['bytes_in'] = os.path.getsize(pathtoebook)
+    start = time.time()
+    ebook = get_book_container(pathtoebook, lazy=lazy, use_mmap=use_mmap, tdir=tdir)
+    record['phases']['load'] = time.time() - start
+    return ebook, record
+
+def scramble_book(ebook, record, dsettings={}, verify=False, shared=None, subset=None,
+                  dummies=None, seed=None, check=None):
+    # Second stage of scramble_ebook(): scramble a loaded book in place.
+    # dummies is an already loaded get_dummy_images() pair. The seed used
+    # (a new one unless given) is kept in the record. check() is called
+    # after every phase and may raise to abandon the book.
+    # Returns the EbookScrambleAction
+    settings = MR_SETTINGS.copy()
+    settings.update(dsettings)
+    phases = record['phases']
+    if dummies is None:
+        dummies = get_dummy_images(get_book_format(ebook.path_to_ebook))
+    dummyimg, dummysvg = dummies
+    sublog = []
+    if subset:
+        from calibre_plugins.scrambleebook_plugin.subset import make_subset
+        start = time.time()
+        make_subset(ebook, log=sublog, **subset)
+        phases['subset'] = time.time() - start
+    if verify:
+        from calibre_plugins.scrambleebook_plugin.fingerprint import (
+            fingerprint_book, compare_fingerprints, format_divergences)
+        from calibre_plugins.scrambleebook_plugin.leakcheck import (
+            build_index, find_leaks, format_leaks)
+        start = time.time()
+        index = build_index(ebook)
+        prints = fingerprint_book(ebook)
+        phases['verify'] = time.time() - start
+    scrambler = EbookScrambleAction(ebook, settings, dummyimg, dummysvg, shared=shared, seed=seed,
+        check=check)
+    scrambler.log[:0] = sublog
+    record['seed'] = scrambler.seed
+    phases.update(scrambler.timings)
+    record['cache'] = dict(scrambler.cache_stats)
+    record['bytes_saved'] = dict(scrambler.bytes_saved)
+    if verify:
+        start = time.time()
+        scrambler.log.extend(format_leaks(find_leaks(ebook, index, dsettings=settings)))
+        divs = compare_fingerprints(prints, fingerprint_book(ebook), scrambler.file_map,
+            removed=scrambler.removed_names)
+        scrambler.log.extend(format_divergences(divs, len(prints)))
+        phases['verify'] += time.time() - start
+    return scrambler
+
+def save_book(ebook, record, pathtoebook, dirout, dest=None, reproducible=False, check=None):
+    # Last stage of scramble_ebook(): write the scrambled book to dirout,
+    # or to the file dest. reproducible=True strips the file timestamps
+    # from an EPUB/KEPUB. If check() raises, the book is removed again.
+    # Returns the path written
+    path_to_scrambled_ebook = dest or os.path.join(dirout, get_scrambled_fname(pathtoebook))
+    start = time.time()
+    try:
+        ebook.commit(path_to_scrambled_ebook)
+    finally:
+        if hasattr(ebook, 'close_source'):
+            ebook.close_source()
+    if reproducible and get_book_format(pathtoebook) in ('epub', 'kepub'):
+        from calibre_plugins.scrambleebook_plugin.zipcontainer import normalize_zip
+        normalize_zip(path_to_scrambled_ebook)
+    record['phases']['commit'] = time.time() - start
+    record['bytes_out'] = os.path.getsize(path_to_scrambled_ebook)
+    if check is not None:
+        try:
+            check()
+        except:
+            os.remove(path_to_scrambled_ebook)
+            raise
+    return path_to_scrambled_ebook
+
+def scramble_ebook(pathtoebook, dirout, dsettings={}, lazy=False, use_mmap=False, verify=False, shared=None,
+                   subset=None, seed=None):
+    # Headless equivalent of the EbookScramble dialog: load, scramble and
+    # save a book in one go.
+    # Returns (path_to_scrambled_ebook, log text, metrics record)
+    # lazy=True reads EPUB/KEPUB members straight from the zip on demand
+    # verify=True reports any original text which survived scrambling
+    # and any structural difference from the original
+    # shared is a new_shared_state() used by several formats of one book
+    # subset is a dict of make_subset() arguments (patterns, selector,
+    # max_blocks) to scramble only part of the book
+    # seed makes the output byte-identical for the same book and rules
+    from calibre_plugins.scrambleebook_plugin.tempspace import get_tempspace
+    space = get_tempspace()
+    with space.workspace('_scramble_book', needed=os.path.getsize(pathtoebook)) as tdir:
+        ebook, record = load_book(pathtoebook, tdir, lazy=lazy, use_mmap=use_mmap)
+        check = partial(space.check, tdir)
+        try:
+            check()
+            scrambler = scramble_book(ebook, record, dsettings, verify=verify, shared=shared,
+                subset=subset, seed=seed, check=check)
+        except:
+            if hasattr(ebook, 'close_source'):
+                ebook.close_source()
+            raise
+        path_to_scrambled_ebook = save_book(ebook, record, pathtoebook, dirout,
+            reproducible=seed is not None, check=check)
+    return path_to_scrambled_ebook, scrambler.results, record
+
+def scramble_ebook_formats(paths, dirout, dsettings={}, share_text=False, **kw):
+    # Scramble several formats of the same book in one pass. Image sizes
+    # and placeholder images are only worked out once, and with
+    # share_text=True identical text scrambles identically in every format.
+    # The metadata rules are fixed, so every format already gets the same
+    # metadata. Returns a list of scramble_ebook() results.
+    # EPUB first: its images are usually the originals of the AZW3 ones
+    order = {'epub': 0, 'kepub': 1, 'azw3': 2}
+    paths = sorted(paths, key=lambda p: order.get(get_book_format(p), 3))
+    shared = new_shared_state(share_text)
+    return [scramble_ebook(path, dirout, dsettings, shared=shared, **kw) for path in paths]
@@ -2,18 +2,18 @@
 # vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
 from __future__ import (unicode_literals, division, absolute_import, print_function)
 import os
-import random
 import re
-import shutil
+from functools import partial
+from threading import Lock, Thread
 
-from polyglot.builtins import iteritems, iterkeys, itervalues, unicode_type
+from polyglot.builtins import iteritems, unicode_type
 from polyglot.binary import as_base64_unicode
 
 from PyQt5.Qt import (QApplication, QDialog, Qt, QLabel, QTextBrowser,
     QDialogButtonBox, QMessageBox, QImage, QCheckBox, QPushButton,
     QFont, QTextCursor, QVBoxLayout, QHBoxLayout, QGridLayout, QGroupBox,
     QLineEdit, QIcon, QUrl, QListWidget, QSplitter,
-    QTextEdit, QTextDocument)
+    QTextEdit, QTextDocument, QObject, QTimer, pyqtSignal)
 
 try:
     from PyQt5.QtWebKitWidgets import QWebView as Webview
@@ -27,39 +27,36 @@ except:
         print('PyQt5.QtWebEngineWidgets.QWebEngineView failed')
         Webview = None
 
-from calibre.library import db
 from calibre.gui2 import (choose_dir, choose_files, error_dialog, warning_dialog)
-from calibre.ptempfile import PersistentTemporaryDirectory
-from calibre.utils.filenames import ascii_text
-from calibre.utils.magick import Image
-from calibre.ebooks.oeb.base import (OEB_DOCS, OEB_STYLES, NCX_MIME, SVG_MIME, OEB_RASTER_IMAGES)
-from calibre.ebooks.oeb.polish.container import (get_container, clone_container, OEB_FONTS)
-from calibre.ebooks.oeb.polish.check.main import run_checks
-from calibre.ebooks.oeb.polish.cover import find_cover_image
-from calibre.ebooks.oeb.polish.replace import rename_files
+from calibre.ebooks.oeb.polish.container import (get_container, clone_container)
 #from calibre.ebooks.oeb.polish.pretty import pretty_all
 
 from calibre_plugins.scrambleebook_plugin import PLUGIN_NAME, PLUGIN_VERSION
+from calibre_plugins.scrambleebook_plugin.config import saved_rules, save_rules
+from calibre_plugins.scrambleebook_plugin.scramblecore import (MR_SETTINGS,
+    EbookScrambleAction, reset_container, get_run_check_error, get_metadata,
+    get_textnames, get_fileparts, get_book_format, get_scrambled_fname,
+    get_dummy_images, scramble_document)
+from calibre_plugins.scrambleebook_plugin.fingerprint import (fingerprint_book,
+    compare_fingerprints, format_divergences)
+from calibre_plugins.scrambleebook_plugin.leakcheck import (build_index,
+    find_leaks, format_leaks)
+from calibre_plugins.scrambleebook_plugin.libfiles import (is_library_path,
+    open_library_file, check_writable)
+from calibre_plugins.scrambleebook_plugin.logsink import LogSink
+from calibre_plugins.scrambleebook_plugin.tempspace import (TempSpaceError,
+    get_tempspace)
+from calibre_plugins.scrambleebook_plugin.warmworker import (CLIENT_TIMEOUT,
+    IDLE_TIMEOUT, authenticate, create_listener)
 
 CAPTION = '%s [v%s]' % (PLUGIN_NAME, PLUGIN_VERSION)
 
-MR_SETTINGS = {
-    'x_dgts': True,
-    'x_html': True,
-    'keep_num_link': True,
-    'x_extlink': False,
-    'x_toc': True,
-    'x_imgs': True,
-    'keep_cover': False,
-    'x_fontsno': True,
-    'x_fontsob': False,
-    'x_meta': True,
-    'x_meta_extra': False,
-    'x_fnames': False
-    }
-
 CSSBG = 'background-color: #ebdbc8;'
 
+# log lines kept by the dialog, and ms to wait before showing new ones
+LOG_MAXLINES = 10000
+LOG_DELAY = 100
+
 class EbookScramble(QDialog):
     ''' Read an EPUB/KEPUB/AZW3 de-DRM'd ebook file and
         scramble various contents '''
@@ -71,20 +68,24 @@ class EbookScramble(QDialog):
         self.book_id = book_id
         self.from_calibre = from_calibre
         self.calibre_libpaths = calibre_libpaths
-        self.dsettings = MR_SETTINGS.copy()
+        self.dsettings = saved_rules(MR_SETTINGS)
         self.dsettings.update(dsettings)
 
         self.ebook = None
         self.eborig = None
         self.cleanup_dirs = []
         self.cleanup_files = []
-        self.log = []
+        self.library_sources = []
+        self.log = LogSink(maxlines=LOG_MAXLINES)
+        self.log_seen = 0
 
         self.rename_file_map = {}
         self.meta, self.errors = {}, {}
         self.is_scrambled = False
         self.dummyimg = None
         self.dummysvg = ''
+        self.leak_index = None
+        self.orig_prints = {}
 
         self.setWindowTitle(CAPTION)
         self.setWindowIcon(get_icons('images/plugin_icon.png'))
@@ -99,6 +100,14 @@ class EbookScramble(QDialog):
         self.browser.setMinimumWidth(600)
         self.browser.setMinimumHeight(150)
         self.browser.setReadOnly(True)
+        self.browser.document().setMaximumBlockCount(LOG_MAXLINES)
+
+        # lines logged between viewlog() calls are shown in batches
+        self.log_timer = QTimer(self)
+        self.log_timer.setSingleShot(True)
+        self.log_timer.setInterval(LOG_DELAY)
+        self.log_timer.timeout.connect(self.flushlog)
+        self.log.listeners.append(self.schedule_flushlog)
 
         self.savefile = QLineEdit()
         self.savefile.setReadOnly(True)
@@ -112,6 +121,8 @@ class EbookScramble(QDialog):
 
         about_button = QPushButton('About', self)
         self.runButton = QPushButton('Scramble now')
+        self.resetButton = QPushButton('Reset to original')
+        self.resetButton.setToolTip('Undo scrambling so the book can be scrambled again with different rules')
         previewButton = QPushButton('Preview content')
         if Webview is None:
             previewButton.setEnabled(False)
@@ -140,6 +151,7 @@ class EbookScramble(QDialog):
         layaction = QVBoxLayout()
         gpaction.setLayout(layaction)
         layaction.addWidget(self.runButton)
+        layaction.addWidget(self.resetButton)
         layaction.addStretch()
         layaction.addWidget(previewButton)
         layaction.addStretch()
@@ -168,6 +180,7 @@ class EbookScramble(QDialog):
         # create connect signals/slots
         about_button.clicked.connect(self.about_button_clicked)
         self.runButton.clicked.connect(self.create_scramble_book)
+        self.resetButton.clicked.connect(self.reset_scramble_book)
         previewButton.clicked.connect(self.preview_ebook)
         configButton.clicked.connect(self.change_rules)
         metadataButton.clicked.connect(self.view_metadata)
@@ -189,15 +202,34 @@ class EbookScramble(QDialog):
         self.is_scrambled = False
         self.dummyimg = None
         self.dummysvg = ''
+        self.leak_index = None
+        self.orig_prints = {}
         self.runButton.setEnabled(True)
+        self.resetButton.setEnabled(False)
         self.buttonBox.button(QDialogButtonBox.Save).setEnabled(False)
 
         fileok = True
+        space = get_tempspace()
+        self.library_sources = []
         if not os.path.isfile(pathtoebook):
             fileok = False
         else:
             try:
-                self.ebook = get_container(pathtoebook)
+                space.check(needed=os.path.getsize(pathtoebook))
+                if is_library_path(pathtoebook, self.calibre_libpaths):
+                    # read the stored file without copying it, see libfiles.py
+                    tdir = space.mkdtemp('_library_file')
+                    self.cleanup_dirs.append(tdir)
+                    self.library_sources.append(pathtoebook)
+                    pathtoebook, how = open_library_file(pathtoebook, tdir)
+                    self.library_sources.append(pathtoebook)
+                tdir = space.mkdtemp('_scramble_book')
+                self.cleanup_dirs.append(tdir)
+                self.ebook = get_container(pathtoebook, tdir=tdir)
+            except TempSpaceError as err:
+                fileok = False
+                error_dialog(self, CAPTION,
+                    unicode_type(err), show=True, show_copy_button=True)
             except:
                 fileok = False
                 msg = "Source ebook must be de-DRM'd and in one of these formats:" \
@@ -208,22 +240,18 @@ class EbookScramble(QDialog):
         if not fileok:
             self.log.append('No ebook selected yet')
         else:
-            self.cleanup_dirs.append(self.ebook.root)
-            tdir = PersistentTemporaryDirectory('_scramble_clone_orig')
+            tdir = space.mkdtemp('_scramble_clone_orig')
             self.cleanup_dirs.append(tdir)
             self.eborig = clone_container(self.ebook, tdir)
 
-            dirn, fname, ext, is_kepub_epub = get_fileparts(self.ebook.path_to_ebook)
-            ext = ext.lower()
-            format = 'kepub' if is_kepub_epub else ext
+            dirn = get_fileparts(self.ebook.path_to_ebook)[0]
 
-            if self.book_id is not None:
-                # calibre library book
+            if self.book_id is not None and self.ebook.path_to_ebook not in self.library_sources:
+                # temporary copy of a calibre library book
                 self.cleanup_files.append(self.ebook.path_to_ebook)
             sourcepath = self.ebook.path_to_ebook
 
-            self.dummyimg = get_resources('images/' + format + '.png')
-            self.dummysvg = get_resources('images/' + format + '.svg')
+            self.dummyimg, self.dummysvg = get_dummy_images(get_book_format(sourcepath))
 
             if self.from_calibre:
                 # calibre plugin
@@ -233,10 +261,8 @@ class EbookScramble(QDialog):
                 self.dirout = dirn
                 self.log.append('\n--- New ebook: %s' % sourcepath)
 
-            fn = fname + '_scrambled.'
-            fn += 'kepub.' + ext if is_kepub_epub else ext
-            self.fname_scrambled_ebook = ascii_text(fn)
-            self.sourcefile.setText(sourcepath)
+            self.fname_scrambled_ebook = get_scrambled_fname(sourcepath)
+            self.sourcefile.setText(self.library_sources[0] if self.library_sources else sourcepath)
             self.savefile.setText(self.fname_scrambled_ebook)
             self.meta['orig'] = get_metadata(self.ebook)
             self.errors['orig'] = get_run_check_error(self.ebook)
@@ -255,6 +281,7 @@ class EbookScramble(QDialog):
             self.log.append('\nSaving now ... %s' % msg)
             self.viewlog()
             path_to_scrambled_ebook = os.path.join(savedir, self.fname_scrambled_ebook)
+            check_writable(path_to_scrambled_ebook, self.calibre_libpaths, self.library_sources)
             self.ebook.commit(path_to_scrambled_ebook)
             self.cleanup()
             QDialog.accept(self)
@@ -267,17 +294,17 @@ class EbookScramble(QDialog):
         # delete calibre plugin temp files
         if self.book_id:
             for f in self.cleanup_files:
+                if is_library_path(f, self.calibre_libpaths):
+                    continue
                 try:
                     os.remove(f)
                 except:
                     pass
 
-        if self.from_calibre:
-            for d in self.cleanup_dirs:
-                try:
-                    shutil.rmtree(d)
-                except:
-                    pass
+        space = get_tempspace()
+        for d in self.cleanup_dirs:
+            space.remove(d)
+        self.cleanup_dirs = []
 
     def choose_save_dir(self, default_dir):
         savedir = None
@@ -328,26 +355,58 @@ class EbookScramble(QDialog):
         self.errors['scramb'] = get_run_check_error(self.ebook)
         self.buttonBox.button(QDialogButtonBox.Save).setEnabled(True)
         self.runButton.setEnabled(False)
+        self.resetButton.setEnabled(True)
         self.is_scrambled = True
 
         self.log.append(scrambler.results)
+        if self.leak_index is None:
+            self.leak_index = build_index(self.eborig)
+            self.orig_prints = fingerprint_book(self.eborig)
+        self.log.extend(format_leaks(find_leaks(self.ebook, self.leak_index,
+            dsettings=self.dsettings)))
+        divs = compare_fingerprints(self.orig_prints, fingerprint_book(self.ebook), self.rename_file_map,
+            removed=scrambler.removed_names)
+        self.log.extend(format_divergences(divs, len(self.orig_prints)))
         self.log.append('\n... finished')
         self.viewlog()
 
+    def reset_scramble_book(self):
+        # restore the working copy from the pristine clone so the
+        # book can be re-scrambled without re-reading the source file
+        if self.ebook is None or not self.is_scrambled:
+            return
+
+        self.ebook = reset_container(self.ebook, self.eborig)
+        self.rename_file_map = {}
+        self.meta.pop('scramb', None)
+        self.errors.pop('scramb', None)
+        self.is_scrambled = False
+        self.runButton.setEnabled(True)
+        self.resetButton.setEnabled(False)
+        self.buttonBox.button(QDialogButtonBox.Save).setEnabled(False)
+
+        self.log.append('\n--- Reset to original ebook ---')
+        self.viewlog()
+
     def change_rules(self):
         dlg = EbookScrambleRulesDlg(self.dsettings, parent=self.gui)
         if dlg.exec_():
             self.dsettings.update(dlg.dsettings)
+            save_rules(self.dsettings)
             self.log.append('\n--- Scrambling rules updated ---')
+            if self.is_scrambled:
+                self.reset_scramble_book()
         self.viewlog()
 
     def preview_ebook(self):
         if self.ebook is None:
             return
 
-        dlg = EbookScramblePreviewDlg(self.ebook, self.eborig, self.is_scrambled, self.rename_file_map, parent=self.gui)
+        dlg = EbookScramblePreviewDlg(self.ebook, self.eborig, self.is_scrambled, self.rename_file_map,
+            dsettings=self.dsettings, dummies=(self.dummyimg, self.dummysvg), parent=self.gui)
         dlg.exec_()
         dlg.raise_()
+        dlg.cleanup()
 
     def view_metadata(self):
         if self.ebook is None:
@@ -369,9 +428,26 @@ class EbookScramble(QDialog):
         self.log.append('\nCurrent Scramble rules:')
         [self.log.append('%s: %s' % (k, v)) for (k,v) in sorted(iteritems(self.dsettings))]
 
-    def viewlog(self):
-        self.browser.setText('\n'.join(self.log))
+    def schedule_flushlog(self):
+        if not self.log_timer.isActive():
+            self.log_timer.start()
+
+    def flushlog(self):
+        # add only the lines the browser has not shown yet
+        self.log_timer.stop()
+        lines, self.log_seen = self.log.since(self.log_seen)
+        if not lines:
+            return
+        cursor = self.browser.textCursor()
+        cursor.movePosition(QTextCursor.End)
+        if not self.browser.document().isEmpty():
+            cursor.insertBlock()
+        cursor.insertText('\n'.join(lines))
         self.browser.moveCursor(QTextCursor.End)
+
+    def viewlog(self):
+        # show the log now, before a step which blocks the event loop
+        self.flushlog()
         QApplication.instance().processEvents()
 
     def about_button_clicked(self):
@@ -390,306 +466,14 @@ class EbookScramble(QDialog):
         QMessageBox.about(self, 'About %s %s' % (CAPTION, source), text)
 
 
-class EbookScrambleAction():
-    ''' Main scrambling routines '''
-    def __init__(self, ebook, dsettings, dummyimg, dummysvg):
-        self.eb = ebook
-
-        self.dsettings = dsettings.copy()
-        self.dummyimg, self.dummysvg = dummyimg, dummysvg
-
-        self.lowers = list('abcdefghijklmnopqrstuvwxyz')
-        self.uppers = [c.upper() for c in self.lowers]
-        self.digits = list('0123456789')
-        self.log = []
-        self.file_map = {}
-
-        self.scramble_main()
-
-    @property
-    def results(self):
-        return '\n'.join(self.log)
-
-    def scramble_main(self):
-        # NB: an epub3 nav.xhtml file will currently be scrambled by HTML rules not NCX rules
-        textnames = get_textnames(self.eb)
-        if self.dsettings['x_html']:
-            [self.scramble_html(n, scramble_dgts=self.dsettings['x_dgts']) for n in textnames]
-            self.log.append('   Scrambled text content')
-
-        self.ncxnames = get_ncxnames(self.eb)
-        # no need to scramble digits in a TOC
-        if self.dsettings['x_toc']:
-            if len(self.ncxnames) > 0:
-                self.scramble_toc(self.ncxnames[0], scramble_dgts=False)
-                self.log.append('   Scrambled TOC')
-
-        svgnames = get_imgnames(self.eb, SVG_MIME)
-        imgnames = get_imgnames(self.eb, OEB_RASTER_IMAGES)
-        if self.dsettings['x_imgs']:
-            cover_img_name = find_cover_image(self.eb, strict=True)
-            cover_img_names = []
-            if self.dsettings['keep_cover']:
-                if cover_img_name:
-                    cover_img_names.append(cover_img_name)
-            [self.scramble_img(n) for n in imgnames if n not in cover_img_names]
-            for svgn in [n for n in svgnames if n not in cover_img_names]:
-                #self.eb.remove_item(svgn)
-                data = self.eb.parsed(svgn)
-                self.eb.replace(svgn, self.dummysvg)
-            self.log.append('   Replaced images')
-
-
-        fontnames = get_fontnames(self.eb)
-        if len(fontnames) > 0 and (self.dsettings['x_fontsno'] or self.dsettings['x_fontsob']):
-            self.log.append('   Removed these fonts:')
-        if self.dsettings['x_fontsno']:
-            # remove non-obfuscated embedded fonts
-            for name in [n for n in fontnames if n not in self.eb.obfuscated_fonts]:
-                self.eb.remove_item(name)
-                self.log.append('      - non-obfuscated font: %s' % name)
-        if self.dsettings['x_fontsob']:
-            # remove obfuscated embedded fonts
-            for name in [n for n in self.eb.obfuscated_fonts]:
-                self.eb.remove_item(name)
-                self.log.append('      - obfuscated font: %s' % name)
-
-        if self.dsettings['x_meta']:
-            self.scramble_metadata()
-            msg = '   Removed basic metadata'
-            if self.dsettings['x_meta_extra']:
-                msg += ' & extra metadata'
-            self.log.append(msg)
-
-        if self.dsettings['x_fnames']:
-            spine_names = tuple([n for n in get_spinenames(self.eb) if n not in self.eb.names_that_must_not_be_changed])
-            self.scramble_filenames(spine_names, 'txcontent_')
-
-            svgnames = get_imgnames(self.eb, SVG_MIME)
-            img_names = tuple([n for n in imgnames + svgnames if n not in self.eb.names_that_must_not_be_changed])
-            self.scramble_filenames(img_names, 'img_')
-
-            css_names = tuple([n for n in get_cssnames(self.eb) if n not in self.eb.names_that_must_not_be_changed])
-            self.scramble_filenames(css_names, 'style_')
-
-        if self.file_map:
-            rename_files(self.eb, self.file_map)
-            self.log.append('   Renamed internal files:')
-            [self.log.append('      %s \t--> %s' % (old, self.file_map.get(old, old))) for old in spine_names + img_names + css_names]
-
-    def scramble_html(self, name, scramble_dgts=False):
-        root = self.eb.parsed(name)
-        for e in root.xpath("//*[local-name()='title']"):
-            e.text = 'Scrambled'
-
-        bodys = root.xpath("//*[local-name()='body']")
-        if len(bodys) == 0: return
-
-        delinks = {}
-        body0 = bodys[0]
-        if self.dsettings['x_extlink'] or (self.dsettings['keep_num_link'] and self.dsettings['x_dgts']):
-            for anch in body0.xpath('//*[local-name()="a" and @href]'):
-                ahref = anch.get('href')
-                ahrefname = name if ahref.startswith('#') else self.eb.href_to_name(ahref, name)
-                if ahrefname is None:
-                    if self.dsettings['x_extlink']:
-                        anch.attrib.pop('href')
-                elif self.dsettings['keep_num_link'] and self.dsettings['x_dgts']:
-                    alltext = []
-                    [alltext.append(tx) for tx in anch.itertext('*')]
-                    atext = ''.join(alltext)
-                    num = [c.lower() != c.upper() for c in atext].count(True)
-                    if num < 1:
-                        # scramble (text, tail)
-                        delinks[anch] = (False, True)
-                        for e in anch.iterdescendants('*'):
-                            delinks[e] = (False, False)
-
-        for be in body0.iterdescendants('*'):
-            do_text_tail = delinks.get(be, (True, True))
-            self.scramble_ele(be, scramble_dgts, do_text_tail=do_text_tail)
-
-        self.eb.dirty(name)
-
-    def scramble_toc(self, name, scramble_dgts=False):
-        root = self.eb.parsed(name)
-        [self.scramble_ele(e, scramble_dgts) for e in root.xpath("//*[local-name()='text']")]
-        self.eb.dirty(name)
-
-    def scramble_img(self, name, scramble_dgts=False):
-        if self.eb.mime_map[name] in OEB_RASTER_IMAGES:
-            data = self.eb.parsed(name)
-            oldimg = Image()
-            oldpath = self.eb.name_to_abspath(name)
-            try:
-                oldimg.load(data)
-                wid, hgt = oldimg.size
-            except:
-                wid, hgt = (50, 50)
-            try:
-                fmt = oldimg.format
-            except:
-                x, x, fmt = get_nameparts(name)
-
-            newimg = Image()
-            newimg.load(self.dummyimg)
-            newimg.size = (wid, hgt)
-
-            self.eb.replace(name, newimg.export(fmt.upper()))
-
-
-    def scramble_ele(self, ele, scramble_dgts, do_text_tail=(True, True)):
-        do_text, do_tail = do_text_tail
-        if do_text:
-            ele.text = self.scramble_text(ele.text, scramble_dgts)
-        if do_tail:
-            ele.tail = self.scramble_text(ele.tail, scramble_dgts)
-
-
-    def scramble_text(self, text, scramble_dgts):
-
-        def scramble_char(char, scramble_dgts):
-            newchar = char
-            if char.upper() != char.lower():
-                if char == char.lower():
-                    newchar = random.choice(self.lowers)
-                elif char == char.upper():
-                    newchar = random.choice(self.uppers)
-            elif scramble_dgts and char in self.digits:
-                newchar = random.choice(self.digits)
-            return newchar
-
-        if not text: return text
-        return ''.join([scramble_char(char, scramble_dgts) for char in text])
-
-
-    def scramble_filenames(self, names, base):
-
-        def get_newbase(base):
-            alpha = 'xab'
-            done = False
-            i = 0
-            newbase = base
-            while not done:
-                found = False
-                for n in fns:
-                    if n.startswith(newbase):
-                        found = True
-                        break
-                if not found:
-                    done = True
-                    break
-                else:
-                    i += 1
-                    newbase = base + str(i)
-            return newbase
-
-        if len(names) == 0: return
-
-        dgts = len(str(len(names)))
-        fns = [get_nameparts(n)[1] for n in names]
-
-        newbase = get_newbase(base)
-
-        i = 0
-        for name in names:
-            dir, fn, ext = get_nameparts(name)
-            nname = newbase + str(i).zfill(dgts) + '.' + ext
-            if dir:
-                nname = '/'.join((dir, nname))
-            self.file_map[name] = nname
-            i += 1
-
-
-    def scramble_metadata(self):
-
-        def reset_package_uid(uidname, uidval):
-            idents = self.eb.opf_xpath('//*[local-name()="identifier" and @id]')
-            ident = idents[0] if idents else None
-            if pk is not None:
-                pk.set('unique-identifier', uidname)
-            if ident is not None:
-                ident.set('id', uidname)
-                ident.text = uidval
-            if len(self.ncxnames) > 0:
-                ncxname = self.ncxnames[0]
-                ncxroot = self.eb.parsed(ncxname)
-                dtbuids = ncxroot.xpath('//*[local-name()="meta" and @name="dtb:uid"]')
-                dtbuid = dtbuids[0] if dtbuids else None
-                if dtbuid is not None:
-                    dtbuid.set('content', uidval)
-                    self.eb.dirty(ncxname)
-
-        to_remove = []
-        pk = None
-
-        # remove <metadata> comments found in Amazon books
-        for child in [e for e in self.eb.opf_xpath('//opf:metadata')[0]]:
-            try:
-                tag = child.tag.rpartition('}')[-1]
-            except:
-                to_remove.append(child)
-
-        # remove all calibre <meta> items
-        for meta in self.eb.opf_xpath('//opf:metadata/opf:meta'):
-            if [val for val in itervalues(meta.attrib) if val.startswith('calibre:')]:
-                to_remove.append(meta)
-
-        if self.dsettings['x_meta_extra']:
-            for meta in self.eb.opf_xpath('//opf:metadata/opf:meta[@property]'):
-                if meta.get('property').startswith('dcterms:'):
-                    # remove all dcterms <meta> @property items
-                    to_remove.append(meta)
-                elif meta.get('property')=='file-as':
-                    # anonymise all <meta> with property "file-as"
-                    meta.text = 'Anon'
-
-            #get the <package> unique-identifier
-            pk = self.eb.opf_xpath('//opf:package')[0]
-            pk_uid = pk.get('unique-identifier')
-
-            # remove all dc:identifier except the one which matches package unique-identifier
-            for ident in self.eb.opf_xpath('//*[local-name()="metadata"]/*[local-name()="identifier"]'):
-                if ident.get('id', '') != pk_uid:
-                    to_remove.append(ident)
-
-        # remove the elements from <metadata>
-        md = self.eb.opf_xpath('//opf:metadata')[0]
-        [md.remove(child) for child in to_remove]
-
-        # obscure some dc: items.
-        dcitems = ('description',)
-        searchpath = '//*[' + ' or '.join(['local-name()="%s"' % dc for dc in dcitems]) + ']'
-        for elem in [e for e in self.eb.opf_xpath(searchpath)]:
-            elem.text = '*removed*'
-            elem.attrib.clear()
-
-        if self.dsettings['x_meta_extra']:
-            # obscure more dc: items
-            dcitems = ('title', 'creator', 'rights', 'publisher', 'source', 'subject')
-            searchpath = '//*[' + ' or '.join(['local-name()="%s"' % dc for dc in dcitems]) + ']'
-            for elem in [e for e in self.eb.opf_xpath(searchpath)]:
-                # do not remove all attribs. needed for epub3 creator/title
-                #elem.attrib.clear()
-                if elem.tag.lower().endswith(('title', 'creator')):
-                    elem.text = 'Anon'
-                elif elem.text is not None:
-                    elem.text = '*removed*'
-
-        if self.dsettings['x_meta_extra']:
-            reset_package_uid('bookid', 'unknown')
-
-        self.eb.dirty(self.eb.opf_name)
-
-
 class EbookScrambleRulesDlg(QDialog):
     def __init__(self, dsettings, parent=None):
         QDialog.__init__(self, parent=parent)
 
         self.dsettings = dsettings.copy()
         self.cbkeys = ('x_html', 'x_dgts', 'keep_num_link', 'x_extlink', 'x_toc',
-                'x_imgs', 'keep_cover', 'x_fontsno', 'x_fontsob',
-                'x_meta', 'x_meta_extra', 'x_fnames')
+                'x_imgs', 'keep_cover', 'x_imgdedup', 'x_fontsno', 'x_fontsob',
+                'x_meta', 'x_meta_extra', 'x_fnames', 'x_optimize')
 
         chkbox_labels = {
         'x_html': 'Scramble book alpha chars',
@@ -699,11 +483,13 @@ class EbookScrambleRulesDlg(QDialog):
         'x_toc': 'Scramble TOC alpha chars (keep digits)',
         'x_imgs': 'Replace images with a dummy image',
         'keep_cover': '... but try to keep cover image',
+        'x_imgdedup': '... and store identical dummy images only once',
         'x_fontsno': 'Remove non-obfuscated fonts',
         'x_fontsob': 'Remove obfuscated fonts',
         'x_meta': 'Remove some descriptive metadata\n(e.g. dc:description, calibre)',
         'x_meta_extra': 'Try to remove more metadata\n(e.g. ISBN)',
-        'x_fnames': 'Rename to generic filenames (not AZW3)\n(HTML, images, CSS)'
+        'x_fnames': 'Rename to generic filenames (not AZW3)\n(HTML, images, CSS)',
+        'x_optimize': 'Remove unreferenced files and unused CSS rules\n(smaller upload)'
         }
 
         self.setWindowTitle('%s: Configure rules' % CAPTION)
@@ -736,6 +522,9 @@ class EbookScrambleRulesDlg(QDialog):
         gpbox6 = QGroupBox('Internal filenames')
         cblay6 = QVBoxLayout()
         gpbox6.setLayout(cblay6)
+        gpbox7 = QGroupBox('Upload size')
+        cblay7 = QVBoxLayout()
+        gpbox7.setLayout(cblay7)
 
         cblay1.addWidget(self.dcheckbox['x_html'], 0, 0, 1, 3)
         cblay1.addWidget(self.dcheckbox['x_dgts'], 1, 1, 1, 2)
@@ -746,6 +535,7 @@ class EbookScrambleRulesDlg(QDialog):
 
         cblay3.addWidget(self.dcheckbox['x_imgs'], 0, 0, 1, 2)
         cblay3.addWidget(self.dcheckbox['keep_cover'], 1, 1)
+        cblay3.addWidget(self.dcheckbox['x_imgdedup'], 2, 1)
 
         cblay4.addWidget(self.dcheckbox['x_fontsno'])
         cblay4.addWidget(self.dcheckbox['x_fontsob'])
@@ -755,6 +545,8 @@ class EbookScrambleRulesDlg(QDialog):
 
         cblay6.addWidget(self.dcheckbox['x_fnames'])
 
+        cblay7.addWidget(self.dcheckbox['x_optimize'])
+
         lay = QVBoxLayout()
         lay.addWidget(gpbox1)
         lay.addWidget(gpbox2)
@@ -762,6 +554,7 @@ class EbookScrambleRulesDlg(QDialog):
         lay.addWidget(gpbox4)
         lay.addWidget(gpbox5)
         lay.addWidget(gpbox6)
+        lay.addWidget(gpbox7)
         lay.addStretch()
         lay.addWidget(defButton)
         lay.addWidget(buttonBox)
@@ -801,10 +594,12 @@ class EbookScrambleRulesDlg(QDialog):
     def images_toggled(self, bool):
         if not bool:
             self.dcheckbox['keep_cover'].setChecked(not bool)
+            self.dcheckbox['x_imgdedup'].setChecked(bool)
         else:
             self.dcheckbox['keep_cover'].setChecked(self.dsettings['keep_cover'])
+            self.dcheckbox['x_imgdedup'].setChecked(self.dsettings['x_imgdedup'])
 
-        for k in ('keep_cover',):
+        for k in ('keep_cover', 'x_imgdedup'):
             self.dcheckbox[k].setEnabled(bool)
 
     def digits_toggled(self, bool):
@@ -832,7 +627,7 @@ class EbookScrambleRulesDlg(QDialog):
 
 class EbookScramblePreviewDlg(QDialog):
 
-    def __init__(self, ebook, orig, is_scrambled, fmap, parent=None):
+    def __init__(self, ebook, orig, is_scrambled, fmap, dsettings=None, dummies=None, parent=None):
         QDialog.__init__(self, parent=parent)
 
         self.setWindowFlags(Qt.Window)
@@ -841,6 +636,13 @@ class EbookScramblePreviewDlg(QDialog):
         self.ebook = ebook
         self.revfmap = {v:k for (k, v) in iteritems(fmap)}
 
+        # before a full run, the selected document is scrambled on its own
+        # into a scratch copy of the book (see preview_path)
+        self.on_demand = not is_scrambled and dsettings is not None
+        self.dsettings, self.dummies = dsettings, dummies
+        self.scratch = self.scratch_dir = None
+        self.previewed = set()
+
         # create widgets
         lay = QVBoxLayout()
         self.setLayout(lay)
@@ -921,7 +723,12 @@ class EbookScramblePreviewDlg(QDialog):
             gpbox1.setVisible(False)
 
         msg = '%s Preview: Original' % CAPTION
-        if not is_scrambled:
+        if self.on_demand:
+            self.setWindowTitle(msg + ' vs. Scrambled (this document only)')
+            gpbox1.setVisible(False)
+            gpbox3.setTitle('HTML files: %s' % len(self.htmlnames_scram))
+            gpbox4.setTitle('Scrambled preview with current rules:')
+        elif not is_scrambled:
             self.setWindowTitle(msg)
             gpbox1.setVisible(False)
             gpbox2.setVisible(False)
@@ -942,11 +749,30 @@ class EbookScramblePreviewDlg(QDialog):
         name = item.text()
         self.webview_refresh(name)
 
+    def preview_path(self, name):
+        if self.scratch is None:
+            # hard linked clone, written files are unlinked first
+            self.scratch_dir = get_tempspace().mkdtemp('_scramble_preview')
+            self.scratch = clone_container(self.orig, self.scratch_dir)
+        if name not in self.previewed:
+            scramble_document(self.scratch, name, self.dsettings, *self.dummies)
+            self.previewed.add(name)
+        return self.scratch.name_to_abspath(name)
+
+    def cleanup(self):
+        if self.scratch_dir is not None:
+            get_tempspace().remove(self.scratch_dir)
+        self.scratch = self.scratch_dir = None
+        self.previewed = set()
+
     def webview_refresh(self, name):
         name_orig = self.revfmap.get(name, name)
 
         abspath_orig = self.orig.name_to_abspath(name_orig)
-        abspath = self.ebook.name_to_abspath(name)
+        if self.on_demand:
+            abspath = self.preview_path(name)
+        else:
+            abspath = self.ebook.name_to_abspath(name)
 
         if isinstance(self.webview_orig, QTextBrowser):
             self.webview_orig.setSource(QUrl.fromLocalFile(abspath_orig))
@@ -1076,71 +902,120 @@ class EbookScrambleErrorsDlg(QDialog):
         if hasattr(self, 'ctc_button'):
             self.ctc_button.setText(_('Copied'))
 
-# ####################################################################
+class EbookScrambleWorker(QObject):
+    ''' Keeps a dialog process alive and opens a new EbookScramble
+        window for each book sent by the calibre GUI '''
+
+    request = pyqtSignal(object)
+
+    def __init__(self, app, idle_timeout=IDLE_TIMEOUT):
+        QObject.__init__(self)
+        self.app = app
+        self.dialogs = []
+        # requests accepted but not yet opened, the process must not quit
+        # while there are any
+        self.pending = 0
+        self.lock = Lock()
+        self.request.connect(self.take_request, type=Qt.QueuedConnection)
+
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(idle_timeout * 1000)
+        self.idle_timer.timeout.connect(self.idle_timeout)
+
+        # None if another worker process already owns the socket
+        self.listener = create_listener()
+        if self.listener is not None:
+            t = Thread(target=self.serve, name='ScrambleEbookWorker')
+            t.daemon = True
+            t.start()
+
+    def serve(self):
+        # runs in a thread, every client gets a thread of its own so a
+        # stuck one cannot hold up the others
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self.listener is None:
+                    break
+                continue
+            t = Thread(target=self.handle_client, args=(conn,), name='ScrambleEbookClient')
+            t.daemon = True
+            t.start()
+
+    def handle_client(self, conn):
+        # requests are handed to the GUI thread by signal
+        try:
+            authenticate(conn)
+            if not conn.poll(CLIENT_TIMEOUT):
+                return
+            kwargs = conn.recv()
+            # once shut down, refuse so the caller starts a new process
+            with self.lock:
+                accepted = self.listener is not None
+                if accepted and kwargs is not None:
+                    self.pending += 1
+                    self.request.emit(kwargs)
+            conn.send('ok' if accepted else 'closing')
+        except Exception:
+            pass
+        finally:
+            conn.close()
+
+    def take_request(self, kwargs):
+        with self.lock:
+            self.pending -= 1
+        try:
+            self.open_dialog(kwargs)
+        finally:
+            if not self.dialogs and self.listener is None:
+                # shut down while this was queued and it failed to open
+                self.quit()
+
+    def open_dialog(self, kwargs):
+        self.idle_timer.stop()
+        w = EbookScramble(kwargs['path_to_ebook'], book_id=kwargs['book_id'],
+            from_calibre=kwargs['from_calibre'], calibre_libpaths=kwargs['calibre_libpaths'])
+        w.finished.connect(partial(self.dialog_closed, w))
+        self.dialogs.append(w)
+        w.show()
+        w.raise_()
+        w.activateWindow()
+
+    def dialog_closed(self, w, *args):
+        if w in self.dialogs:
+            self.dialogs.remove(w)
+        w.deleteLater()
+        if not self.dialogs:
+            if self.listener is None:
+                self.quit()
+            else:
+                self.idle_timer.start()
+
+    def idle_timeout(self):
+        if not self.dialogs:
+            self.quit()
+
+    def quit(self):
+        # stop accepting first; requests already accepted still open
+        # their dialog, and closing the last of those quits
+        self.shutdown()
+        with self.lock:
+            pending = self.pending
+        if not pending:
+            self.app.quit()
+
+    def shutdown(self):
+        with self.lock:
+            listener, self.listener = self.listener, None
+        if listener is not None:
+            try:
+                listener.close()
+            except Exception:
+                pass
 
-def get_run_check_error(ebook):
-    ans = []
-    errors = run_checks(ebook)
-    for err in errors:
-        lev = err.level
-        n = err.name
-        msg = err.msg
-        ans.append((lev, msg, n))
-
-    dans = {}
-    for lev, msg, n in ans:
-        k = (lev, msg)
-        dans[k] = dans.get(k, 0) + 1
-    return dans
-
-def get_metadata(ebook):
-    opf_raw = ebook.raw_data(ebook.opf_name)
-    res = re.findall(r'<[^<>]*package.+metadata>', opf_raw, re.I | re.S)
-    return res[0] if res else ''
-
-def get_textnames(ebook):
-    # return doc names in spine order + any non-spine docs (e.g. nav.xhtml)
-    names = list(get_spinenames(ebook))
-    others = [n for (n, m) in sorted(iteritems(ebook.mime_map)) if m in OEB_DOCS and n not in names]
-    return tuple(names + others)
-
-def get_spinenames(ebook):
-    return tuple([n for (n, lin) in ebook.spine_names])
-
-def get_ncxnames(ebook):
-    names = [n for (n, m) in iteritems(ebook.mime_map) if m == NCX_MIME]
-    if not names:
-        [names.append(n) for n in ebook.mime_map if n.rpartition('.')[-1] == 'ncx']
-    return tuple(names)
-
-def get_imgnames(ebook, mtypes):
-    if isinstance(mtypes, unicode_type):
-        mtypes = [mtypes]
-    return tuple(sorted([n for (n, m) in iteritems(ebook.mime_map) if m in mtypes]))
-
-def get_fontnames(ebook):
-    # sometimes embedded fonts have an incorrect media-type
-    names = set([n for (n, m) in iteritems(ebook.mime_map) if m in OEB_FONTS])
-    [names.add(n) for n in ebook.mime_map if n.rpartition('.')[-1] in ('otf', 'ttf')]
-    return tuple(sorted(names))
-
-def get_cssnames(ebook):
-    names = [n for (n, m) in iteritems(ebook.mime_map) if m in OEB_STYLES]
-    [names.append(n) for n in ebook.mime_map if n.rpartition('.')[-1] == 'css' and n not in names]
-    return tuple(sorted(names))
-
-def get_nameparts(name):
-    dirname, fe = name.rpartition('/')[0::2]
-    fn, ext = fe.rpartition('.')[0::2]
-    return (dirname, fn, ext)
-
-def get_fileparts(path):
-    abspath = os.path.normpath(os.path.abspath(path))
-    dirname, basename = os.path.split(abspath)
-    fn, ext1 = os.path.splitext(basename)
-    ext = ext1.rpartition('.')[-1]
-    is_kepub_epub = fn.rpartition('.')[-1].lower() == 'kepub'
-    return (dirname, fn, ext, is_kepub_epub)
+# ####################################################################
 
 def main(prog, args):
     # Run the plugin
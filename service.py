@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Local HTTP scrambling service, run with:
+#   calibre-debug -r ScrambleEbook -- serve --port 8642
+#
+#   POST /scramble?filename=book.epub[&rules={"x_fnames":true}][&lazy=1][&report=1]
+#       body: the EPUB/KEPUB/AZW3 file. Rules may also be sent as JSON in an
+#       X-Scramble-Rules header. Returns the scrambled book, named in the
+#       Content-Disposition header, with a short JSON summary in
+#       X-Scramble-Report. With report=1 the response is multipart/mixed:
+#       the full JSON report, log included, then the book
+#   GET /health
+#       {"status": "ok", "running": n, "queued": n, ...}
+#   GET /metrics
+#       Prometheus text format, see metrics.py
+#
+# Requests are handled on an asyncio event loop, the scrambling itself runs
+# in a process pool. At most `workers` books are scrambled at once and at
+# most `max_queue` wait for a worker; beyond that requests are refused with
+# 503 so clients back off instead of piling up. Uploads and results are
+# streamed through the temporary space, not held in memory.
+
+import asyncio
+import binascii
+import json
+import os
+from urllib.parse import parse_qs, unquote, urlparse
+
+from calibre.utils.filenames import ascii_filename
+
+from calibre_plugins.scrambleebook_plugin.metrics import (Metrics,
+    failed_book_record)
+from calibre_plugins.scrambleebook_plugin.pool import cpu_count, create_executor
+from calibre_plugins.scrambleebook_plugin.scramblecore import (MR_SETTINGS,
+    get_book_format, scramble_ebook)
+from calibre_plugins.scrambleebook_plugin.tempspace import (TempSpaceError,
+    get_tempspace)
+
+OK_EXTS = ('epub', 'kepub', 'azw3')
+MIME_TYPES = {
+    'epub': 'application/epub+zip', 'kepub': 'application/epub+zip',
+    'azw3': 'application/vnd.amazon.mobi8-ebook',
+    }
+CHUNK = 1024**2
+# bytes of the X-Scramble-Report header, well below the 8 KB many
+# clients and proxies allow for all headers together
+MAX_REPORT_HEADER = 4096
+STATUS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+    413: 'Payload Too Large', 500: 'Internal Server Error',
+    503: 'Service Unavailable', 504: 'Gateway Timeout', 507: 'Insufficient Storage',
+    }
+
+def report_header(report):
+    # the report without its log, made smaller still if need be so that
+    # it never gets the whole response rejected by a client
+    summary = {k:v for (k, v) in report.items() if k != 'log'}
+    summary['log_lines'] = len(report['log'])
+    for key in (None, 'phases', 'rules', 'source'):
+        summary.pop(key, None)
+        text = json.dumps(summary, sort_keys=True)
+        if len(text) <= MAX_REPORT_HEADER:
+            break
+    return text
+
+class HTTPError(Exception):
+
+    def __init__(self, status, msg):
+        Exception.__init__(self, msg)
+        self.status = status
+
+
+class ScrambleService(object):
+
+    def __init__(self, host='127.0.0.1', port=8642, workers=None, max_queue=16,
+            timeout=600, max_upload=512 * 1024**2, metrics=None):
+        self.host, self.port = host, port
+        self.workers = workers or cpu_count()
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.max_upload = max_upload
+        self.metrics = metrics or Metrics()
+        self.executor = None
+        self.slots = None
+        self.running = self.queued = 0
+        self.done = self.failed = 0
+
+    def serve_forever(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.executor = create_executor(self.workers)
+        self.slots = asyncio.Semaphore(self.workers)
+        server = loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+        print('Scramble service listening on http://%s:%d/ with %d workers' % (
+            self.host, self.port, self.workers))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.executor.shutdown(wait=False)
+            self.metrics.close()
+            loop.close()
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, query, headers = await self.read_head(reader)
+                if path == '/health':
+                    status, body = 200, self.health()
+                elif path == '/metrics':
+                    status, body = 200, self.metrics.prometheus()
+                elif path == '/scramble':
+                    if method != 'POST':
+                        raise HTTPError(405, 'Use POST')
+                    await self.scramble(reader, writer, query, headers)
+                    status = None
+                else:
+                    raise HTTPError(404, 'No such endpoint: %s' % path)
+            except HTTPError as err:
+                status, body = err.status, {'error': str(err)}
+            except Exception as err:
+                status, body = 500, {'error': '%s: %s' % (type(err).__name__, err)}
+            if status is not None:
+                self.write_response(writer, status, body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_head(self, reader):
+        line = (await reader.readline()).decode('latin-1').strip()
+        try:
+            method, target, version = line.split()
+        except ValueError:
+            raise HTTPError(400, 'Malformed request line')
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            if len(headers) > 100:
+                raise HTTPError(400, 'Too many headers')
+            k, sep, v = line.partition(':')
+            headers[k.strip().lower()] = v.strip()
+        url = urlparse(target)
+        query = {k:v[-1] for (k, v) in parse_qs(url.query).items()}
+        return method.upper(), unquote(url.path), query, headers
+
+    def write_response(self, writer, status, body):
+        if isinstance(body, dict):
+            ctype, data = 'application/json', json.dumps(body).encode('utf-8')
+        else:
+            ctype, data = 'text/plain; version=0.0.4', body.encode('utf-8')
+        head = ['HTTP/1.1 %d %s' % (status, STATUS.get(status, '')),
+            'Content-Type: ' + ctype,
+            'Content-Length: %d' % len(data),
+            'Connection: close']
+        if status == 503:
+            head.append('Retry-After: 5')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('ascii') + data)
+
+    def health(self):
+        return {'status': 'ok', 'workers': self.workers, 'running': self.running,
+            'queued': self.queued, 'done': self.done, 'failed': self.failed}
+
+    def get_rules(self, query, headers):
+        text = query.get('rules') or headers.get('x-scramble-rules')
+        if not text:
+            return {}
+        try:
+            rules = json.loads(text)
+        except ValueError:
+            raise HTTPError(400, 'Rules must be a JSON object')
+        if not isinstance(rules, dict):
+            raise HTTPError(400, 'Rules must be a JSON object')
+        unknown = [k for k in rules if k not in MR_SETTINGS]
+        if unknown:
+            raise HTTPError(400, 'Unknown rules: %s' % ', '.join(unknown))
+        return rules
+
+    async def scramble(self, reader, writer, query, headers):
+        # sends the response itself, the book is streamed from disk
+        filename = ascii_filename(os.path.basename(query.get('filename', '')))
+        if filename.rpartition('.')[-1].lower() not in OK_EXTS:
+            raise HTTPError(400, 'filename must end with one of: %s' % ', '.join(OK_EXTS))
+        rules = self.get_rules(query, headers)
+        lazy = query.get('lazy', '') in ('1', 'true', 'yes')
+        full_report = query.get('report', '') in ('1', 'true', 'yes')
+        try:
+            length = int(headers.get('content-length', ''))
+        except ValueError:
+            raise HTTPError(400, 'Content-Length required')
+        if length > self.max_upload:
+            raise HTTPError(413, 'Book larger than %d bytes' % self.max_upload)
+
+        # refuse rather than queue without limit. The place in the queue is
+        # taken before the upload, books still arriving count as queued
+        if self.queued >= self.max_queue:
+            raise HTTPError(503, 'Too many books queued, try again later')
+        self.queued += 1
+        waiting, tdir, job = True, None, None
+        space = get_tempspace()
+        try:
+            try:
+                space.check(needed=length)
+                tdir = space.mkdtemp('_service')
+            except TempSpaceError as err:
+                raise HTTPError(507, str(err))
+            src = os.path.join(tdir, filename)
+            await self.receive(reader, src, length)
+            outdir = os.path.join(tdir, 'out')
+            os.mkdir(outdir)
+            await self.slots.acquire()
+            self.queued -= 1
+            waiting = False
+            job = self.start_job(src, outdir, rules, lazy)
+            outpath, results, record = await self.wait_job(job, src)
+            report = {
+                'source': filename,
+                'format': get_book_format(filename),
+                'rules': rules,
+                'bytes_in': length,
+                'bytes_out': os.path.getsize(outpath),
+                'phases': record['phases'],
+                'log': results.splitlines(),
+                }
+            await self.send_book(writer, outpath, report, full_report)
+        finally:
+            if waiting:
+                self.queued -= 1
+            if tdir is not None:
+                if job is None or job.done():
+                    space.remove(tdir)
+                else:
+                    # timed out: the worker still writes to tdir
+                    job.add_done_callback(lambda job: space.remove(tdir))
+
+    async def receive(self, reader, path, length):
+        # written to disk as it arrives, never held in memory
+        with open(path, 'wb') as f:
+            while length > 0:
+                chunk = await reader.readexactly(min(length, CHUNK))
+                f.write(chunk)
+                length -= len(chunk)
+
+    async def send_book(self, writer, path, report, full_report=False):
+        # a summary of the report goes in a header. The body is the book,
+        # or with full_report the report and the book as two parts
+        fmt = get_book_format(path)
+        book_head = ['Content-Type: ' + MIME_TYPES.get(fmt, 'application/octet-stream'),
+            'Content-Disposition: attachment; filename="%s"' % os.path.basename(path)]
+        before = after = b''
+        if full_report:
+            boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+            before = ('--%s\r\nContent-Type: application/json\r\n\r\n%s\r\n--%s\r\n%s\r\n\r\n' % (
+                boundary, json.dumps(report, sort_keys=True), boundary,
+                '\r\n'.join(book_head))).encode('utf-8')
+            after = ('\r\n--%s--\r\n' % boundary).encode('ascii')
+            book_head = ['Content-Type: multipart/mixed; boundary=' + boundary]
+        with open(path, 'rb') as f:
+            size = len(before) + os.fstat(f.fileno()).st_size + len(after)
+            head = ['HTTP/1.1 200 OK'] + book_head + [
+                'Content-Length: %d' % size,
+                'X-Scramble-Report: ' + report_header(report),
+                'Connection: close']
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('ascii'))
+            writer.write(before)
+            while True:
+                chunk = f.read(CHUNK)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+            writer.write(after)
+
+    def start_job(self, src, outdir, rules, lazy):
+        # A process pool cannot cancel a running job, so the worker slot
+        # is only given back once the worker is really done with the book,
+        # even if its client timed out long before
+        loop = asyncio.get_event_loop()
+        self.running += 1
+        try:
+            job = loop.run_in_executor(self.executor, scramble_ebook, src, outdir, rules, lazy)
+        except:
+            self.job_done(None)
+            raise
+        job.add_done_callback(self.job_done)
+        return job
+
+    def job_done(self, job):
+        self.running -= 1
+        self.slots.release()
+        if job is not None and not job.cancelled():
+            # mark a late failure as seen, nobody is waiting for it
+            job.exception()
+
+    async def wait_job(self, job, src):
+        # the metrics record comes back from the worker process
+        try:
+            # shielded, so a timeout leaves the job itself alone
+            outpath, results, record = await asyncio.wait_for(asyncio.shield(job), self.timeout)
+        except asyncio.TimeoutError as err:
+            self.failed += 1
+            self.metrics.record_book(failed_book_record(src, get_book_format(src), err))
+            raise HTTPError(504, 'Scrambling took longer than %d seconds' % self.timeout)
+        except Exception as err:
+            self.failed += 1
+            self.metrics.record_book(failed_book_record(src, get_book_format(src), err))
+            raise HTTPError(500, 'Scrambling failed: %s' % err)
+        self.done += 1
+        self.metrics.record_book(record)
+        return outpath, results, record
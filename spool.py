@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Work sharing between machines through a spool directory on a shared
+# filesystem, run on every host with:
+#   calibre-debug -r ScrambleEbook -- spool /mnt/share/spool -o /mnt/share/out [books ...]
+#
+# Every book is a small JSON ticket which moves between subdirectories
+# with rename(), which is atomic on local filesystems and NFS alike:
+#
+#   queue/<id>.json            waiting for a host
+#   claimed/<id>.<host>.json   being scrambled by <host>
+#   done/<id>.json             scrambled, with the output path
+#   failed/<id>.json           given up after max_failures
+#
+# Exactly one host wins the rename of a queued ticket. The claimed ticket
+# is the lease: its owner touches it every few seconds, and a ticket whose
+# mtime is older than `lease` seconds belongs to a host which died. Any
+# host then renames it to itself and puts it back in the queue, counting
+# a failure so a book which keeps killing hosts is eventually given up.
+# Times are compared with the file server's clock, not the local one.
+#
+# A host whose lease was taken over while it was still working (e.g. a
+# long network stall) notices when it tries to finish, and drops its
+# result. Scrambled books are written to a per-host staging directory and
+# renamed into place, so the output directory never holds a partial book.
+
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import threading
+import time
+
+from calibre_plugins.scrambleebook_plugin.batch import STAGING_DIR, commit_output
+from calibre_plugins.scrambleebook_plugin.metrics import failed_book_record
+from calibre_plugins.scrambleebook_plugin.scramblecore import (get_book_format,
+    scramble_ebook)
+
+QUEUE, CLAIMED, DONE, FAILED = 'queue', 'claimed', 'done', 'failed'
+SUBDIRS = (QUEUE, CLAIMED, DONE, FAILED, 'tmp', 'clock')
+LEASE = 60.0
+
+def new_host_id():
+    # unique per process: several workers may run on one host
+    host = re.sub(r'[^A-Za-z0-9_-]+', '-', socket.gethostname()) or 'host'
+    return '%s-%d-%s' % (host, os.getpid(), hashlib.sha1(os.urandom(16)).hexdigest()[:6])
+
+def ticket_id(path):
+    return hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:20]
+
+def split_name(fn):
+    # '<id>.json' -> (id, None), '<id>.<host>.json' -> (id, host)
+    parts = fn[:-len('.json')].split('.', 1)
+    return parts[0], (parts[1] if len(parts) > 1 else None)
+
+class Spool(object):
+    ''' Ticket files of one spool directory '''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        for d in SUBDIRS:
+            d = os.path.join(self.path, d)
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except EnvironmentError:
+                    # created by another host at the same time
+                    if not os.path.isdir(d):
+                        raise
+
+    def join(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def listdir(self, sub):
+        try:
+            return sorted(fn for fn in os.listdir(self.join(sub)) if fn.endswith('.json'))
+        except EnvironmentError:
+            return []
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def write(self, path, ticket):
+        # complete file or nothing, under its final name
+        tmp = self.join('tmp', '%s.%s' % (os.path.basename(path), new_host_id()))
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps(ticket, sort_keys=True).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+    def now(self, host):
+        # the file server's idea of the time, which sets the lease mtimes
+        probe = self.join('clock', host)
+        with open(probe, 'ab'):
+            pass
+        os.utime(probe, None)
+        return os.stat(probe).st_mtime
+
+    def known_ids(self):
+        return set(split_name(fn)[0] for sub in (QUEUE, CLAIMED, DONE, FAILED)
+                   for fn in self.listdir(sub))
+
+    def submit(self, books):
+        # queue books which are not already known; returns how many.
+        # Books are stored relative to the spool so hosts may mount the
+        # share in different places
+        added = 0
+        known = self.known_ids()
+        for book in books:
+            book = os.path.abspath(book)
+            tid = ticket_id(book)
+            if tid in known:
+                continue
+            known.add(tid)
+            try:
+                rel = os.path.relpath(book, self.path)
+            except ValueError:
+                # another drive on Windows
+                rel = None
+            self.write(self.join(QUEUE, tid + '.json'),
+                {'id': tid, 'book': book, 'rel': rel, 'failures': 0, 'reason': None})
+            added += 1
+        return added
+
+    def book_path(self, ticket):
+        if ticket.get('rel'):
+            path = os.path.normpath(self.join(ticket['rel']))
+            if os.path.exists(path):
+                return path
+        return ticket['book']
+
+    def status(self):
+        return {sub: len(self.listdir(sub)) for sub in (QUEUE, CLAIMED, DONE, FAILED)}
+
+class SpoolWorker(object):
+
+    def __init__(self, spool, dirout, dsettings={}, lease=LEASE, poll=2.0,
+            follow=False, max_failures=3, metrics=None, log=print, **kw):
+        # Extra keyword arguments are passed to scramble_ebook()
+        self.spool = spool if isinstance(spool, Spool) else Spool(spool)
+        self.dirout = os.path.abspath(dirout)
+        self.dsettings = dsettings
+        self.lease, self.poll = lease, poll
+        self.follow = follow
+        self.max_failures = max_failures
+        self.metrics = metrics
+        self.log = log
+        self.kw = kw
+        self.host = new_host_id()
+        self.staging = os.path.join(self.dirout, STAGING_DIR, self.host)
+        self.claims = set()     # paths of the tickets we hold
+        self.lost = set()       # ... which another host took over
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.counts = {'committed': 0, 'failed': 0, 'given_up': 0, 'taken_over': 0}
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def heartbeat(self):
+        # renew our leases well before they can expire
+        while not self.stopped.wait(self.lease / 4):
+            with self.lock:
+                for path in list(self.claims):
+                    try:
+                        os.utime(path, None)
+                    except EnvironmentError as err:
+                        if err.errno == errno.ENOENT:
+                            self.claims.discard(path)
+                            self.lost.add(path)
+
+    def take(self, src, tid):
+        # rename a ticket to ourselves; None if another host was quicker.
+        # Touch it first, a renamed file keeps its old mtime
+        dest = self.spool.join(CLAIMED, '%s.%s.json' % (tid, self.host))
+        try:
+            os.utime(src, None)
+            os.rename(src, dest)
+        except EnvironmentError as err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+        with self.lock:
+            self.claims.add(dest)
+        return dest
+
+    def still_ours(self, claim):
+        with self.lock:
+            if claim in self.lost:
+                return False
+        return os.path.exists(claim)
+
+    def release(self, claim):
+        # True if the claim was still ours
+        with self.lock:
+            self.claims.discard(claim)
+            lost = claim in self.lost
+            self.lost.discard(claim)
+        if lost:
+            return False
+        try:
+            os.remove(claim)
+        except EnvironmentError as err:
+            if err.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def requeue(self, claim, ticket, reason):
+        # count a failure and queue the book again, or give it up
+        if not self.still_ours(claim):
+            # the host which took it over has already queued it
+            self.release(claim)
+            return False
+        ticket['failures'] += 1
+        ticket['reason'] = reason
+        given_up = ticket['failures'] >= self.max_failures
+        self.spool.write(self.spool.join(FAILED if given_up else QUEUE, ticket['id'] + '.json'), ticket)
+        self.release(claim)
+        return given_up
+
+    def reap(self):
+        # hand back the books of hosts which stopped renewing their lease
+        now = self.spool.now(self.host)
+        # clocks and half written tickets of long gone hosts
+        for sub in ('clock', 'tmp'):
+            for fn in os.listdir(self.spool.join(sub)):
+                path = self.spool.join(sub, fn)
+                try:
+                    if now - os.stat(path).st_mtime > 10 * self.lease:
+                        os.remove(path)
+                except EnvironmentError:
+                    pass
+        for fn in self.spool.listdir(CLAIMED):
+            tid, host = split_name(fn)
+            if host == self.host:
+                continue
+            path = self.spool.join(CLAIMED, fn)
+            try:
+                if now - os.stat(path).st_mtime < self.lease:
+                    continue
+            except EnvironmentError:
+                continue
+            claim = self.take(path, tid)
+            if claim is None:
+                continue
+            self.counts['taken_over'] += 1
+            # its partial book, if it used the same output directory
+            shutil.rmtree(os.path.join(self.dirout, STAGING_DIR, host), ignore_errors=True)
+            if os.path.exists(self.spool.join(DONE, tid + '.json')):
+                # it finished, but died before removing its claim
+                self.release(claim)
+                continue
+            ticket = self.spool.read(claim)
+            given_up = self.requeue(claim, ticket, 'host %s stopped renewing its lease' % host)
+            self.log('%s: taken over from %s%s' % (ticket['book'], host,
+                ', giving up' if given_up else ''), file=sys.stderr)
+
+    def claim_next(self):
+        for fn in self.spool.listdir(QUEUE):
+            tid = split_name(fn)[0]
+            claim = self.take(self.spool.join(QUEUE, fn), tid)
+            if claim is not None:
+                return claim
+        return None
+
+    def process(self, claim):
+        ticket = self.spool.read(claim)
+        book = self.spool.book_path(ticket)
+        try:
+            staged, results, record = scramble_ebook(book, self.staging, self.dsettings, **self.kw)
+        except Exception as err:
+            reason = '%s: %s' % (err.__class__.__name__, err)
+            given_up = self.requeue(claim, ticket, reason)
+            self.counts['given_up' if given_up else 'failed'] += 1
+            if self.metrics is not None:
+                self.metrics.record_book(failed_book_record(book, get_book_format(book), err))
+            self.log('%s: FAILED: %s' % (book, reason), file=sys.stderr)
+            return
+        if not self.still_ours(claim):
+            # another host has (or will have) the book now
+            os.remove(staged)
+            self.log('%s: lease lost, result dropped' % book, file=sys.stderr)
+            return
+        outpath = commit_output(staged, self.dirout, book)
+        ticket.update({'output': outpath, 'host': self.host})
+        self.spool.write(self.spool.join(DONE, ticket['id'] + '.json'), ticket)
+        self.release(claim)
+        self.counts['committed'] += 1
+        if self.metrics is not None:
+            self.metrics.record_book(record)
+        self.log('%s --> %s' % (book, outpath))
+
+    def run(self):
+        # Returns counts of books by outcome. Without follow, stops once
+        # nothing is queued or claimed by any host
+        shutil.rmtree(self.staging, ignore_errors=True)
+        os.makedirs(self.staging)
+        beat = threading.Thread(target=self.heartbeat, name='SpoolHeartbeat')
+        beat.daemon = True
+        beat.start()
+        self.log('Spool %s as %s' % (self.spool.path, self.host))
+        last_reap = 0
+        try:
+            while not self.stopped.is_set():
+                if time.time() - last_reap >= self.poll:
+                    self.reap()
+                    last_reap = time.time()
+                claim = self.claim_next()
+                if claim is not None:
+                    self.process(claim)
+                    continue
+                if not self.follow and not self.spool.listdir(CLAIMED):
+                    break
+                self.stopped.wait(self.poll)
+        finally:
+            self.stopped.set()
+            beat.join()
+            # hand back anything we still hold, e.g. after a KeyboardInterrupt
+            for claim in list(self.claims):
+                try:
+                    if self.still_ours(claim):
+                        ticket = self.spool.read(claim)
+                        self.spool.write(self.spool.join(QUEUE, ticket['id'] + '.json'), ticket)
+                    self.release(claim)
+                except EnvironmentError:
+                    pass
+            shutil.rmtree(self.staging, ignore_errors=True)
+            try:
+                os.remove(self.spool.join('clock', self.host))
+            except EnvironmentError:
+                pass
+        return self.counts
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Complexity checks on pathological books, run with:
+#   calibre-debug -r ScrambleEbook -- stress [--stage anchors] [--scale 2]
+#
+# Each stage builds the same kind of pathological input at several sizes
+# (by default n, 2n and 4n), times the scrambling phase it exercises and
+# measures how far it raises the peak resident memory, then fits the
+# growth exponent on a log-log scale. Linear work has an exponent of about
+# 1; a stage fails if time or memory grows faster than max_slope.
+#
+#   text      one text node of tens of MB
+#   nesting   elements nested thousands deep
+#   anchors   tens of thousands of footnote, internal and external links
+#   newbase   file names which all collide with the txcontent_ prefix
+#   rename    x_fnames on a book with thousands of linked documents
+#   metadata  OPF with thousands of metadata entries and manifest items
+#
+# Books come from corpus.py. The pathological parts are added to the
+# parsed trees in memory, which also gets past parser limits such as the
+# maximum nesting depth. Parsing is done before timing starts.
+#
+# Memory is measured in a forked child for each size, as resident memory
+# (VmRSS/VmHWM on Linux, ru_maxrss elsewhere): most of it is lxml's C
+# trees, which tracemalloc does not see, and a fresh process is not
+# holding on to the peaks of the sizes before it. Without fork (Windows)
+# it falls back to tracemalloc, i.e. Python allocations only.
+
+import math
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+from lxml import etree
+
+from calibre.ebooks.oeb.base import XHTML_NS, DC11_NS, OPF2_NS
+from calibre.ebooks.oeb.polish.container import get_container
+
+from calibre_plugins.scrambleebook_plugin.corpus import BookGenerator, book_params
+from calibre_plugins.scrambleebook_plugin.pool import can_fork
+from calibre_plugins.scrambleebook_plugin.scramblecore import (MR_SETTINGS,
+    EbookScrambleAction, get_newbase, get_textnames)
+from calibre_plugins.scrambleebook_plugin.tempspace import get_tempspace
+
+FACTORS = (1, 2, 4)
+MAX_SLOPE = 1.3
+# too short to time reliably
+MIN_SECONDS = 0.005
+
+def xhtml(tag):
+    return '{%s}%s' % (XHTML_NS, tag)
+
+def first_body(ebook):
+    name = [n for n in get_textnames(ebook) if 'chapter' in n][0]
+    return name, ebook.parsed(name).xpath('//*[local-name()="body"]')[0]
+
+def add_text(ebook, n):
+    name, body = first_body(ebook)
+    p = etree.SubElement(body, xhtml('p'))
+    word = 'Lorem Ipsum dolor 1984 sit amet, '
+    p.text = word * (n // len(word))
+
+def add_nesting(ebook, n):
+    name, body = first_body(ebook)
+    parent = body
+    for i in range(n):
+        parent = etree.SubElement(parent, xhtml('span' if i % 2 else 'div'))
+        parent.text = 'Level %d' % i
+        parent.tail = 'after'
+
+def add_anchors(ebook, n):
+    name, body = first_body(ebook)
+    p = etree.SubElement(body, xhtml('p'))
+    for i in range(n):
+        kind = i % 3
+        a = etree.SubElement(p, xhtml('a'))
+        if kind == 0:
+            # numeric footnote, kept with keep_num_link
+            a.set('href', 'notes.xhtml#fn%d' % i)
+            a.text = '[%d]' % i
+        elif kind == 1:
+            a.set('href', 'chapter001.xhtml#p%d' % i)
+            a.text = 'See part %d' % i
+            etree.SubElement(a, xhtml('em')).text = 'here'
+        else:
+            a.set('href', 'http://example.com/%d' % i)
+            a.text = 'Site %d' % i
+        a.tail = ' text %d ' % i
+
+def add_metadata(ebook, n):
+    md = ebook.opf_xpath('//opf:metadata')[0]
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            e = etree.SubElement(md, '{%s}identifier' % DC11_NS)
+            e.set('id', 'id%d' % i)
+            e.text = 'urn:isbn:%013d' % i
+        elif kind == 1:
+            e = etree.SubElement(md, '{%s}meta' % OPF2_NS)
+            e.set('name', 'calibre:user_metadata:#col%d' % i)
+            e.set('content', 'x')
+        elif kind == 2:
+            e = etree.SubElement(md, '{%s}meta' % OPF2_NS)
+            e.set('property', 'dcterms:modified')
+            e.text = '2020-01-01'
+        else:
+            e = etree.SubElement(md, '{%s}subject' % DC11_NS)
+            e.text = 'Subject %d' % i
+    ebook.dirty(ebook.opf_name)
+
+# stage: (scrambler phase, rules, base size, book params for size n, add pathology)
+STAGES = {
+    'text': ('text', {'x_html': True, 'x_dgts': True}, 2000000,
+             lambda n: dict(spine=1, paragraphs=1), add_text),
+    'nesting': ('text', {'x_html': True}, 5000,
+                lambda n: dict(spine=1, paragraphs=1), add_nesting),
+    'anchors': ('text', {'x_html': True, 'x_dgts': True, 'keep_num_link': True, 'x_extlink': True}, 5000,
+                lambda n: dict(spine=1, paragraphs=1, footnotes=0), add_anchors),
+    'newbase': (None, {}, 5000, None, None),
+    'rename': ('filenames', {'x_fnames': True}, 200,
+               lambda n: dict(spine=n, paragraphs=2, words=20, links=0.5, footnotes=0.2), None),
+    'metadata': ('metadata', {'x_meta': True, 'x_meta_extra': True}, 2000,
+                 lambda n: dict(spine=1, paragraphs=1, extra_items=n), add_metadata),
+    }
+ORDER = ('text', 'nesting', 'anchors', 'newbase', 'rename', 'metadata')
+
+def colliding_names(n):
+    # 'txcontent_', 'txcontent_1', ... 'txcontent_n': every candidate base collides
+    return ['Text/txcontent_%s.xhtml' % (i or '') for i in range(n + 1)]
+
+def prepare(stage, n, tdir):
+    # (run, cleanup): run() scrambles the phase at size n and returns its time
+    phase, rules, base, params, add = STAGES[stage]
+    if stage == 'newbase':
+        fns = [name.rpartition('/')[-1].rpartition('.')[0] for name in colliding_names(n)]
+        def run():
+            start = time.time()
+            get_newbase('txcontent_', fns)
+            return time.time() - start
+        return run, lambda: None
+    path = os.path.join(tdir, '%s-%d.epub' % (stage, n))
+    if not os.path.exists(path):
+        BookGenerator(book_params('small', images=0, fonts=0, **params(n))).build(path)
+    settings = {k: False for k in MR_SETTINGS}
+    settings.update(rules)
+    etdir = get_tempspace().mkdtemp('_stress')
+    ebook = get_container(path, tdir=etdir)
+    if add is not None:
+        add(ebook, n)
+    [ebook.parsed(name) for name in get_textnames(ebook)]
+    def run():
+        return EbookScrambleAction(ebook, settings, b'', '').timings[phase]
+    return run, partial(get_tempspace().remove, etdir)
+
+def measure(stage, n, tdir, repeat=3):
+    # best time of one phase at size n
+    best = None
+    for i in range(repeat):
+        run, cleanup = prepare(stage, n, tdir)
+        try:
+            value = run()
+        finally:
+            cleanup()
+        best = value if best is None else min(best, value)
+    return best
+
+def proc_status():
+    # {'VmRSS': bytes, 'VmHWM': bytes} of this process, empty without /proc
+    values = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                key, sep, rest = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    values[key] = int(rest.split()[0]) * 1024
+    except (EnvironmentError, ValueError):
+        pass
+    return values
+
+def reset_peak_rss():
+    # make VmHWM start again from the current RSS (Linux 4.0+)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except EnvironmentError:
+        return False
+    return 'VmHWM' in proc_status()
+
+def max_rss():
+    # peak RSS of this process so far; ru_maxrss is in bytes on macOS only
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def trim_heap():
+    # give back to the OS the heap the parent had already freed, or the
+    # phase reuses it without raising the RSS (glibc only)
+    try:
+        import ctypes
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def rss_growth(stage, n, tdir):
+    # how far one phase raises the peak RSS above what it started with.
+    # Run in a child: without a peak reset ru_maxrss only ever grows
+    run, cleanup = prepare(stage, n, tdir)
+    try:
+        trim_heap()
+        if reset_peak_rss():
+            before = proc_status()['VmRSS']
+            run()
+            after = proc_status()['VmHWM']
+        else:
+            before = max_rss()
+            run()
+            after = max_rss()
+    finally:
+        cleanup()
+    return max(after - before, 0)
+
+def traced_growth(stage, n, tdir):
+    # peak Python allocations of one phase, where there is no fork
+    run, cleanup = prepare(stage, n, tdir)
+    try:
+        tracemalloc.start()
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        cleanup()
+
+def peak_memory(stage, n, tdir):
+    # bytes one phase at size n adds to the peak memory
+    if resource is None or not can_fork():
+        return traced_growth(stage, n, tdir)
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('fork')) as pool:
+        return pool.submit(rss_growth, stage, n, tdir).result()
+
+def slope(sizes, values):
+    # least squares exponent of values ~ sizes ** k
+    pts = [(math.log(s), math.log(max(v, 1e-9))) for s, v in zip(sizes, values)]
+    mx = sum(x for x, y in pts) / len(pts)
+    my = sum(y for x, y in pts) / len(pts)
+    den = sum((x - mx) ** 2 for x, y in pts)
+    return sum((x - mx) * (y - my) for x, y in pts) / den if den else 0
+
+def run_stress(stages=None, scale=1.0, factors=FACTORS, repeat=3, max_slope=MAX_SLOPE,
+               memory=True, log=print):
+    # returns [result dict per stage]; result['ok'] is False for a stage
+    # which grows faster than linearly
+    results = []
+    with get_tempspace().workspace('_stress') as tdir:
+        for stage in stages or ORDER:
+            sizes = [max(1, int(STAGES[stage][2] * scale * f)) for f in factors]
+            times = [measure(stage, n, tdir, repeat=repeat) for n in sizes]
+            mems = [peak_memory(stage, n, tdir) for n in sizes] if memory else []
+            res = {'stage': stage, 'sizes': sizes, 'times': times, 'memory': mems,
+                   'time_slope': slope(sizes, times), 'memory_slope': slope(sizes, mems) if mems else 0}
+            problems = []
+            if max(times) < MIN_SECONDS:
+                res['time_slope'] = 0
+            elif res['time_slope'] > max_slope:
+                problems.append('time grows as n^%.2f' % res['time_slope'])
+            if res['memory_slope'] > max_slope:
+                problems.append('memory grows as n^%.2f' % res['memory_slope'])
+            res['ok'] = not problems
+            results.append(res)
+            log('%-9s %-4s sizes %s  time %s (n^%.2f)  peak %s (n^%.2f)%s' % (
+                stage, 'ok' if res['ok'] else 'FAIL', '/'.join(str(s) for s in sizes),
+                '/'.join('%.3fs' % t for t in times), res['time_slope'],
+                '/'.join('%.1fMB' % (m / 1024**2) for m in mems) or '-', res['memory_slope'],
+                ('  ' + '; '.join(problems)) if problems else ''))
+    return results
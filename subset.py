@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Cut a book down to a minimal reproduction before scrambling: keep only
+# the chosen spine documents, plus whatever stylesheets, fonts and images
+# they still reference, and optionally only the first N blocks of each.
+# Documents are chosen by name or fnmatch pattern (e.g. 'Text/ch0[45]*'),
+# and/or by a CSS selector which must match something in them.
+
+import fnmatch
+
+from calibre.ebooks.oeb.base import OEB_DOCS, NCX_MIME
+
+from calibre_plugins.scrambleebook_plugin.optimize import remove_unreferenced
+
+BLOCK_TAGS = frozenset(('address', 'article', 'aside', 'blockquote', 'dd', 'div',
+    'dl', 'dt', 'figure', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header',
+    'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'ul'))
+
+def local_name(elem):
+    return elem.tag.rpartition('}')[-1].lower()
+
+def select_names(ebook, patterns=(), selector=None):
+    # spine names matching any pattern or containing a selector match
+    spine = [name for name, linear in ebook.spine_names]
+    keep = set(n for n in spine if any(n == p or fnmatch.fnmatch(n, p) for p in patterns))
+    if selector:
+        from css_selectors import Select
+        for name in spine:
+            if name not in keep:
+                select = Select(ebook.parsed(name), ignore_inappropriate_pseudo_classes=True)
+                for match in select(selector):
+                    keep.add(name)
+                    break
+    return [n for n in spine if n in keep]
+
+def get_nav_names(ebook):
+    # an EPUB 3 book is invalid without its nav document
+    id_map = ebook.manifest_id_map
+    return set(id_map[item.get('id')] for item in ebook.opf_xpath('//opf:manifest/opf:item[@properties]')
+               if 'nav' in item.get('properties').split() and item.get('id') in id_map)
+
+def truncate_doc(ebook, name, max_blocks):
+    # keep the first max_blocks innermost block elements of the body
+    root = ebook.parsed(name)
+    bodies = root.xpath('//*[local-name()="body"]')
+    if not bodies:
+        return False
+    body = bodies[0]
+    blocks = [e for e in body.iterdescendants('*') if local_name(e) in BLOCK_TAGS]
+    outer = set()
+    for elem in blocks:
+        for anc in elem.iterancestors('*'):
+            if anc is body:
+                break
+            if local_name(anc) in BLOCK_TAGS:
+                outer.add(anc)
+                break
+    leaves = [e for e in blocks if e not in outer]
+    if len(leaves) <= max_blocks:
+        return False
+    # drop everything after the last kept block, at every level up to the body
+    node = leaves[max_blocks - 1]
+    while node is not body:
+        for sib in list(node.itersiblings()):
+            node.getparent().remove(sib)
+        node = node.getparent()
+    ebook.dirty(name)
+    return True
+
+# (entry, link inside an entry, link attribute) for NCX and EPUB 3 nav TOCs
+TOC_NCX = ('navPoint', 'content', 'src')
+TOC_NAV = ('li', 'a', 'href')
+
+def prune_toc(ebook, removed):
+    # drop TOC entries which only lead to removed documents, and retarget
+    # entries which still have kept children to the first of them
+    for name, mt in list(ebook.mime_map.items()):
+        if mt == NCX_MIME:
+            entry, link, attr = TOC_NCX
+            entries = '//*[local-name()="navPoint"]'
+        elif mt in OEB_DOCS and name not in removed:
+            entry, link, attr = TOC_NAV
+            entries = '//*[local-name()="nav"]//*[local-name()="li"]'
+        else:
+            continue
+        root = ebook.parsed(name)
+        changed = False
+        # innermost first, so children are settled before their parents
+        for point in reversed(root.xpath(entries)):
+            links = point.xpath('./*[local-name()="%s"]' % link)
+            if not links or ebook.href_to_name(links[0].get(attr, ''), name) not in removed:
+                continue
+            kids = point.xpath('.//*[local-name()="%s"]/*[local-name()="%s"]' % (entry, link))
+            if kids:
+                links[0].set(attr, kids[0].get(attr))
+            else:
+                point.getparent().remove(point)
+            changed = True
+        if changed:
+            ebook.dirty(name)
+
+def unlink_removed(ebook, keep, removed):
+    # links from kept documents into removed ones become plain text
+    for name in keep:
+        root = ebook.parsed(name)
+        changed = False
+        for a in root.xpath('//*[local-name()="a" and @href]'):
+            if ebook.href_to_name(a.get('href'), name) in removed:
+                del a.attrib['href']
+                changed = True
+        if changed:
+            ebook.dirty(name)
+
+def make_subset(ebook, patterns=(), selector=None, max_blocks=None, log=None):
+    # reduce ebook in place. Returns the kept spine names
+    log = [] if log is None else log
+    keep = select_names(ebook, patterns, selector)
+    if not keep:
+        raise ValueError('No spine documents match %s' % ', '.join(
+            list(patterns) + ([selector] if selector else [])))
+    protected = set(keep) | get_nav_names(ebook) | set(ebook.names_that_must_not_be_changed)
+    removed = set(n for n, linear in ebook.spine_names if n not in protected)
+    log.append('   Reduced book to %d of %d documents:' % (len(keep), len(keep) + len(removed)))
+    log.extend('      + %s' % n for n in keep)
+    unlink_removed(ebook, keep, removed)
+    prune_toc(ebook, removed)
+    for name in sorted(removed):
+        ebook.remove_item(name)
+    if max_blocks:
+        for name in keep:
+            if truncate_doc(ebook, name, max_blocks):
+                log.append('      %s cut to %d blocks' % (name, max_blocks))
+    # stylesheets, fonts and images only the removed text used
+    remove_unreferenced(ebook, {}, log)
+    return keep
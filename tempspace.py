@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Temporary working space for unpacked and cloned books.
+# All working directories live under one base directory per user,
+# preferably a RAM backed one, named after the owning host and process
+# (pid and start time, as pids get reused) so that directories left behind
+# by a crash can be swept on the next startup. Optional quotas limit the
+# space used by a single book and by all books together, and are checked
+# after every scrambling phase.
+#
+# Configured from the environment, or by the command line options:
+#   SCRAMBLEEBOOK_TMPDIR            base directory
+#   SCRAMBLEEBOOK_BOOK_QUOTA_MB     max space used by one book (0 = no limit)
+#   SCRAMBLEEBOOK_GLOBAL_QUOTA_MB   max space used under the base directory
+
+import os
+import re
+import shutil
+import socket
+import tempfile
+import time
+from contextlib import contextmanager
+
+from calibre.constants import iswindows
+
+PREFIX = 'scrambleebook-'
+RAM_DIRS = ('/dev/shm',)
+RAM_MIN_FREE = 2 * 1024**3
+# on Windows we cannot safely test if a pid is alive, so age decides
+ORPHAN_AGE = 24 * 3600
+
+class TempSpaceError(Exception):
+    pass
+
+def free_space(path):
+    try:
+        st = os.statvfs(path)
+    except (AttributeError, EnvironmentError):
+        return 0
+    return st.f_bavail * st.f_frsize
+
+def user_dirname():
+    # /dev/shm and /tmp are shared by all users
+    getuid = getattr(os, 'getuid', None)
+    return PREFIX + ('tmp-%d' % getuid() if getuid else 'tmp')
+
+def host_tag():
+    # no '-' in it, it separates the parts of a directory name
+    return re.sub(r'[^A-Za-z0-9_.]+', '_', socket.gethostname()) or 'host'
+
+def process_start(pid):
+    # start time of a process in clock ticks since boot, 0 where unknown
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            data = f.read()
+    except EnvironmentError:
+        return 0
+    # after the command name, which may itself hold spaces and parentheses
+    try:
+        return int(data.rpartition(b')')[2].split()[19])
+    except (IndexError, ValueError):
+        return 0
+
+def default_base():
+    base = os.environ.get('SCRAMBLEEBOOK_TMPDIR')
+    if base:
+        return os.path.abspath(base)
+    for d in RAM_DIRS:
+        if os.path.isdir(d) and os.access(d, os.W_OK) and free_space(d) >= RAM_MIN_FREE:
+            return os.path.join(d, user_dirname())
+    return os.path.join(tempfile.gettempdir(), user_dirname())
+
+def disk_usage(path):
+    # bytes used below path, hard linked files are only counted once
+    seen, total = set(), 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, fn))
+            except EnvironmentError:
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key not in seen:
+                seen.add(key)
+                total += st.st_size
+    return total
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        # EPERM means the process exists but belongs to someone else
+        return err.errno == 1
+    return True
+
+def env_quota(key):
+    try:
+        return int(float(os.environ.get(key, 0)) * 1024**2)
+    except ValueError:
+        return 0
+
+
+class TempSpace(object):
+    ''' Creates, measures and removes working directories '''
+
+    def __init__(self, base=None, book_quota=None, global_quota=None):
+        self.base = os.path.abspath(base) if base else default_base()
+        self.book_quota = env_quota('SCRAMBLEEBOOK_BOOK_QUOTA_MB') if book_quota is None else book_quota
+        self.global_quota = env_quota('SCRAMBLEEBOOK_GLOBAL_QUOTA_MB') if global_quota is None else global_quota
+        self.host = host_tag()
+        self.started = {}
+
+    def owner(self):
+        # (pid, start time) of the calling process. Not fixed at creation:
+        # forked pool workers share this object but are processes of their own
+        pid = os.getpid()
+        if pid not in self.started:
+            self.started[pid] = process_start(pid)
+        return pid, self.started[pid]
+
+    def mkdtemp(self, suffix=''):
+        # the caller is responsible for calling remove()
+        if not os.path.exists(self.base):
+            os.makedirs(self.base, 0o700)
+        prefix = '%s%s-%d-%d-' % ((PREFIX, self.host) + self.owner())
+        return tempfile.mkdtemp(suffix=suffix, prefix=prefix, dir=self.base)
+
+    def remove(self, tdir):
+        shutil.rmtree(tdir, ignore_errors=True)
+
+    @contextmanager
+    def workspace(self, suffix='', needed=0):
+        # a working directory which is always removed on exit
+        self.check(needed=needed)
+        tdir = self.mkdtemp(suffix)
+        try:
+            yield tdir
+        finally:
+            self.remove(tdir)
+
+    def check(self, tdir=None, needed=0):
+        # raise TempSpaceError if a quota is, or would be, exceeded
+        if self.book_quota:
+            used = needed + (disk_usage(tdir) if tdir else 0)
+            if used > self.book_quota:
+                raise TempSpaceError('Book needs %d MB of temporary space, limit is %d MB' % (
+                    used // 1024**2, self.book_quota // 1024**2))
+        if self.global_quota and os.path.exists(self.base):
+            used = needed + disk_usage(self.base)
+            if used > self.global_quota:
+                raise TempSpaceError('Temporary space in %s would reach %d MB, limit is %d MB' % (
+                    self.base, used // 1024**2, self.global_quota // 1024**2))
+
+    def sweep(self):
+        # remove directories whose owning process no longer exists, only
+        # those of this host: the base may be on a shared filesystem.
+        # Returns the list of directories removed
+        removed = []
+        if not os.path.isdir(self.base):
+            return removed
+        now = time.time()
+        for fn in os.listdir(self.base):
+            if not fn.startswith(PREFIX):
+                continue
+            path = os.path.join(self.base, fn)
+            try:
+                host, pid, start = fn[len(PREFIX):].split('-', 3)[:3]
+                pid, start = int(pid), int(start)
+                mtime = os.path.getmtime(path)
+            except (ValueError, EnvironmentError):
+                continue
+            if host != self.host or (pid, start) == self.owner():
+                continue
+            if iswindows:
+                orphaned = now - mtime > ORPHAN_AGE
+            else:
+                # a live pid may belong to a later process
+                orphaned = not pid_alive(pid) or bool(start and process_start(pid) != start)
+            if orphaned:
+                self.remove(path)
+                removed.append(path)
+        return removed
+
+_tempspace = None
+
+def get_tempspace():
+    # the process wide TempSpace, orphans are swept on first use
+    global _tempspace
+    if _tempspace is None:
+        _tempspace = TempSpace()
+        _tempspace.sweep()
+    return _tempspace
+
+def configure(base=None, book_quota=None, global_quota=None):
+    # replace the process wide TempSpace, quotas in bytes
+    global _tempspace
+    _tempspace = TempSpace(base=base, book_quota=book_quota, global_quota=global_quota)
+    _tempspace.sweep()
+    return _tempspace
@@ -18,14 +18,16 @@ from calibre.gui2.actions import InterfaceAction
 
 # Get required support modules for all plugin actions
 import os
+from threading import Thread
 from PyQt5.Qt import (QMenu, QToolButton,
     QDialog, QLabel, QDialogButtonBox,
     QVBoxLayout, QHBoxLayout, QGroupBox, QRadioButton)
 
-from calibre.gui2 import error_dialog
+from calibre.gui2 import error_dialog, info_dialog, choose_dir
 
-#from calibre_plugins.scrambleebook_plugin.config import prefs
-from calibre_plugins.scrambleebook_plugin.scrambleebook import get_fileparts #, EbookScramble
+# scramblecore, and the lxml and calibre polish modules behind it, are only
+# imported once needed, not at calibre startup
+from calibre_plugins.scrambleebook_plugin.warmworker import send_to_worker
 
 OK_FORMATS = ('AZW3', 'EPUB', 'KEPUB')
 
@@ -107,6 +109,11 @@ class ScrambleEbookUiAction(InterfaceAction):
         # Selected book checks. If error raise SelectedBookError
         # Get book from currently selected row. Only single row is valid
         try:
+            # get paths to all known calibre libraries
+            excl = list(self.gui.iactions['Choose Library'].stats.stats.keys())
+            calibre_libpaths = [os.path.abspath(k) for k in excl]
+            calibre_libpaths.append(os.path.abspath(self.gui.current_db.library_path))
+
             rows = self.gui.current_view().selectionModel().selectedRows()
 
             if not rows or len(rows) == 0:
@@ -124,10 +131,6 @@ class ScrambleEbookUiAction(InterfaceAction):
 
                 db = self.gui.current_db.new_api
 
-                # get paths to all known calibre libraries
-                excl = list(self.gui.iactions['Choose Library'].stats.stats.keys())
-                calibre_libpaths = [os.path.abspath(k) for k in excl]
-
                 # check which formats exist and select one
                 avail_fmts = db.formats(book_id, verify_formats=True)
                 valid_fmts = [f for f in OK_FORMATS if f in avail_fmts]
@@ -136,10 +139,14 @@ class ScrambleEbookUiAction(InterfaceAction):
                     seldlg = EbookSelectFormat(self.gui, valid_fmts, self.gui)
                     if seldlg.exec_():
                         valid_fmts = seldlg.result
+                        if len(valid_fmts) > 1:
+                            # all formats in one pass, no dialog
+                            return self.scramble_all_formats(db, book_id, valid_fmts, calibre_libpaths)
 
                 try:
                     fmt = valid_fmts[0]
-                    path_to_ebook = db.format(book_id, fmt, as_path=True, preserve_filename=True)
+                    # a temporary copy is removed by the dialog when done
+                    path_to_ebook, copied = get_library_format(db, book_id, fmt)
                 except:
                     path_to_ebook = None
 
@@ -152,6 +159,7 @@ class ScrambleEbookUiAction(InterfaceAction):
                 path_to_ebook = paths[0]
                 book_id = None
 
+                from calibre_plugins.scrambleebook_plugin.scramblecore import get_fileparts
                 x, x, ext, x = get_fileparts(path_to_ebook)
                 if not ext.upper() in OK_FORMATS:
                     errmsg = 'Only books with file extensions %s are valid.\n\n' % ','.join(OK_FORMATS)
@@ -164,35 +172,107 @@ class ScrambleEbookUiAction(InterfaceAction):
             #from calibre.debug import run_calibre_debug
             #run_calibre_debug('--run-plugin', 'ScrambleEbook', path_to_ebook, str(book_id), 'True')
 
-            try:
-                # calibre 4 beta onwards
-                # view main dialog via launching a separate process which can access QtWebEngine
-                # NB: if name of function in run_plugin_as_process.py is 'main'
-                #     then the 'func' parameter below is not needed
-                self.gui.job_manager.launch_gui_app('webengine-dialog',
-                    kwargs={
-                        'module':'calibre_plugins.scrambleebook_plugin.run_plugin_as_process',
-                        # 'func': 'main',
-                        'path_to_ebook':path_to_ebook,
-                        'book_id':book_id,
-                        'from_calibre':True,
-                        'calibre_libpaths':calibre_libpaths
-                        }
-                    )
-            except:
-                # calibre 3.x.x
-                # view main dialog as standard UI plugin
-                from calibre_plugins.scrambleebook_plugin.scrambleebook import EbookScramble
-                dlg = EbookScramble(path_to_ebook, book_id=book_id, from_calibre=True, parent=self.gui)
-                dlg.exec_()
+            kwargs = {
+                'path_to_ebook':path_to_ebook,
+                'book_id':book_id,
+                'from_calibre':True,
+                'calibre_libpaths':calibre_libpaths
+                }
+            # talking to a running dialog process may block, so it is done
+            # off the GUI thread; the launch comes back to the GUI thread
+            t = Thread(target=self.send_or_launch,
+                args=(kwargs, self.Dispatcher(self.launch_dialog)), name='ScrambleEbookSend')
+            t.daemon = True
+            t.start()
 
         except SelectedBookError as err:
             return error_dialog(self.gui,
                     '%s: Book selection error' % self.name,
                     str(err), show=True)
 
+    def send_or_launch(self, kwargs, launch):
+        # reuse a dialog process left running by an earlier launch
+        if not send_to_worker(kwargs):
+            launch(kwargs)
+
+    def launch_dialog(self, kwargs):
+        # view main dialog via launching a separate process which can access QtWebEngine
+        # NB: if name of function in run_plugin_as_process.py is 'main'
+        #     then the 'func' parameter below is not needed
+        kwargs = dict(kwargs, module='calibre_plugins.scrambleebook_plugin.run_plugin_as_process')
+        # kwargs['func'] = 'main'
+        self.gui.job_manager.launch_gui_app('webengine-dialog', kwargs=kwargs)
+
+    def scramble_all_formats(self, db, book_id, fmts, calibre_libpaths):
+        # scramble every selected format of a book in a calibre worker process
+        dirout = choose_dir(self.gui, 'scrambleebook-all-formats-dir',
+            'Choose a folder for the scrambled books')
+        if not dirout:
+            return
+        dirout = os.path.abspath(dirout)
+        if [p for p in calibre_libpaths if dirout == p or dirout.startswith(p + os.sep)]:
+            return error_dialog(self.gui, '%s: Invalid folder' % self.name,
+                'The scrambled books may not be saved inside a calibre library', show=True)
+
+        rules = self.choose_rules()
+        if rules is None:
+            return
+
+        sources = [get_library_format(db, book_id, fmt) for fmt in fmts]
+        paths = [path for path, copied in sources]
+        copies = [path for path, copied in sources if copied]
+        title = db.field_for('title', book_id)
+
+        from functools import partial
+        self.gui.job_manager.run_job(
+            self.Dispatcher(partial(self.scramble_all_formats_done, copies)), 'arbitrary_n',
+            args=['calibre_plugins.scrambleebook_plugin.jobs', 'do_scramble_formats',
+                  (paths, dirout, rules)],
+            description='Scramble %s (%s)' % (title, ', '.join(fmts)))
+        self.gui.status_bar.show_message('Scrambling %s formats...' % ', '.join(fmts), 3000)
+
+    def choose_rules(self):
+        # the saved rules, to confirm or change for this run; None if cancelled
+        from calibre_plugins.scrambleebook_plugin.config import saved_rules, save_rules
+        from calibre_plugins.scrambleebook_plugin.scramblecore import MR_SETTINGS
+        from calibre_plugins.scrambleebook_plugin.scrambleebook import EbookScrambleRulesDlg
+        dlg = EbookScrambleRulesDlg(saved_rules(MR_SETTINGS), parent=self.gui)
+        if not dlg.exec_():
+            return None
+        save_rules(dlg.dsettings)
+        return dlg.dsettings
+
+    def scramble_all_formats_done(self, copies, job):
+        for path in copies:
+            remove_library_copy(path)
+        if job.failed:
+            return self.gui.job_exception(job, dialog_title='%s: Scramble failed' % self.name)
+        msg = 'Scrambled books saved as:\n\n' + '\n'.join(job.result)
+        info_dialog(self.gui, '%s: Scramble complete' % self.name, msg, show=True)
+
+def get_library_format(db, book_id, fmt):
+    # The stored format file itself, which is only ever read (see
+    # libfiles.py), rather than a temporary copy of it. Fall back to a
+    # copy if the library cannot give us a path. Returns (path, copied),
+    # a copy is the caller's to remove with remove_library_copy()
+    try:
+        path = db.format_abspath(book_id, fmt)
+    except Exception:
+        path = None
+    if path and os.path.isfile(path):
+        return path, False
+    return db.format(book_id, fmt, as_path=True, preserve_filename=True), True
+
+def remove_library_copy(path):
+    # the copy, and the temporary directory calibre made for it
+    try:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+    except EnvironmentError:
+        pass
+
 class EbookSelectFormat(QDialog):
-    # select a single format if >1 suitable to be scrambled
+    # select a single format, or all of them, if >1 suitable to be scrambled
     def __init__(self, gui, formats, parent=None):
         QDialog.__init__(self, parent=parent)
 
@@ -201,7 +281,8 @@ class EbookSelectFormat(QDialog):
         buttonBox = QDialogButtonBox(QDialogButtonBox.Ok)
 
         msg = '\nThis book has multiple formats which could be scrambled.\n' \
-            'Please select one of the following:\n'
+            'Please select one of the following, or all of them to scramble\n' \
+            'every format in one pass with the rules you choose next:\n'
         label = QLabel(msg)
 
         self.dradio = {}
@@ -214,6 +295,8 @@ class EbookSelectFormat(QDialog):
 
         for fmt in self.formats:
             lay1.addWidget(self.dradio[fmt])
+        self.allradio = QRadioButton('All')
+        lay1.addWidget(self.allradio)
 
         if 'EPUB' in self.formats:
             self.dradio['EPUB'].setChecked(True)
@@ -230,9 +313,11 @@ class EbookSelectFormat(QDialog):
         buttonBox.accepted.connect(self.accept)
         buttonBox.rejected.connect(self.reject)
 
-        self.setWindowTitle('ScrambleEbook: Select a single format')
+        self.setWindowTitle('ScrambleEbook: Select format')
         self.setWindowIcon(get_icons('images/plugin_icon.png'))
 
     @property
     def result(self):
+        if self.allradio.isChecked():
+            return tuple(self.formats)
         return tuple([k for k in self.formats if self.dradio[k].isChecked()])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Local socket shared by the calibre GUI and the long-lived dialog process
+# started by run_plugin_as_process.py (see EbookScrambleWorker). The GUI
+# uses send_to_worker() to hand a book to a running process instead of
+# launching a new one. No Qt here, this is loaded at calibre GUI startup.
+
+import os
+import tempfile
+
+from calibre.constants import iswindows
+
+# seconds a worker with no open dialogs waits for a new request before exiting
+IDLE_TIMEOUT = 600
+# seconds either side waits for the other to send its message
+CLIENT_TIMEOUT = 10
+
+def worker_address():
+    if iswindows:
+        import getpass
+        return r'\\.\pipe\scrambleebook-%s' % getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), 'scrambleebook-%d.sock' % os.getuid())
+
+def get_authkey():
+    # shared secret between the calibre GUI and the worker, readable
+    # only by the current user
+    from calibre.utils.config import config_dir
+    path = os.path.join(config_dir, 'plugins', 'ScrambleEbook.authkey')
+    try:
+        with open(path, 'rb') as f:
+            key = f.read()
+    except EnvironmentError:
+        key = b''
+    if len(key) < 16:
+        key = os.urandom(32)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+    return key
+
+def send_to_worker(kwargs):
+    # Returns True if a running worker accepted the request. This may
+    # block for a while, the calibre GUI calls it from a background thread
+    from multiprocessing.connection import Client
+    try:
+        conn = Client(worker_address(), authkey=get_authkey())
+    except Exception:
+        return False
+    try:
+        conn.send(kwargs)
+        return conn.poll(CLIENT_TIMEOUT) and conn.recv() == 'ok'
+    except Exception:
+        return False
+    finally:
+        conn.close()
+
+def authenticate(conn):
+    # The handshake Listener(authkey=...) would do inside accept(), where
+    # one stuck client holds up every later one. The worker does it in
+    # the client's own thread instead
+    from multiprocessing.connection import answer_challenge, deliver_challenge
+    key = get_authkey()
+    deliver_challenge(conn, key)
+    answer_challenge(conn, key)
+
+def create_listener():
+    # Returns None if another worker is already listening. Connections
+    # must be passed to authenticate() before anything else
+    from multiprocessing.connection import Listener
+    address = worker_address()
+    if not iswindows and os.path.exists(address):
+        if send_to_worker(None):
+            return None
+        # left behind by a worker which did not exit cleanly
+        try:
+            os.remove(address)
+        except EnvironmentError:
+            return None
+    try:
+        return Listener(address)
+    except Exception:
+        return None
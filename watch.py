@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# Watch-folder daemon, run with:
+#   calibre-debug -r ScrambleEbook -- watch -o /srv/scrambled /srv/dropbox
+#
+# Books dropped into a watched directory are scrambled on a worker pool.
+# The scrambled book and a <book>.txt report go to the output directory,
+# the original is moved to a .done (or .failed) subdirectory of the watched
+# one. A file is only picked up once its size and mtime have not changed
+# for `settle` seconds, so books still being copied in are left alone.
+#
+# On Linux the directories are watched with inotify, elsewhere (or with
+# --poll, e.g. for network shares) they are listed every `interval` seconds.
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import shutil
+import signal
+import struct
+import sys
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from calibre.utils.filenames import atomic_rename
+
+from calibre_plugins.scrambleebook_plugin.batch import STAGING_DIR, commit_output
+from calibre_plugins.scrambleebook_plugin.metrics import Metrics, failed_book_record
+from calibre_plugins.scrambleebook_plugin.pool import cpu_count, create_executor
+from calibre_plugins.scrambleebook_plugin.scramblecore import (get_book_format,
+    get_fileparts, scramble_ebook)
+
+OK_EXTS = ('epub', 'kepub', 'azw3')
+DONE_DIR, FAILED_DIR = '.done', '.failed'
+# partial downloads and editor/office lock files
+IGNORE_SUFFIXES = ('~', '.part', '.partial', '.tmp', '.crdownload')
+
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x8, 0x80, 0x100
+IN_Q_OVERFLOW = 0x4000
+EVENT_HEADER = struct.Struct('iIII')
+
+def is_candidate(path):
+    fn = os.path.basename(path)
+    if fn.startswith('.') or fn.lower().endswith(IGNORE_SUFFIXES):
+        return False
+    return get_book_format(path) in OK_EXTS
+
+def is_complete(path):
+    # an EPUB whose central directory is not there yet is still being written
+    if get_book_format(path) in ('epub', 'kepub'):
+        try:
+            return zipfile.is_zipfile(path)
+        except EnvironmentError:
+            return False
+    return True
+
+def list_dirs(dirs):
+    ans = set()
+    for d in dirs:
+        try:
+            ans.update(os.path.join(d, fn) for fn in os.listdir(d))
+        except EnvironmentError:
+            pass
+    return ans
+
+class PollWatcher(object):
+    ''' Report every file in the watched directories each interval '''
+    def __init__(self, dirs, interval=1.0):
+        self.dirs, self.interval = dirs, interval
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return list_dirs(self.dirs)
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    ''' Report files written or moved into the watched directories '''
+    def __init__(self, dirs):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.dirs = dirs
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.wds = {}
+        try:
+            for d in dirs:
+                wd = libc.inotify_add_watch(self.fd, os.fsencode(d),
+                    IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), 'Cannot watch %s' % d)
+                self.wds[wd] = d
+        except Exception:
+            self.close()
+            raise
+
+    def wait(self, timeout):
+        ans = set()
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error:
+            return ans
+        if not readable:
+            return ans
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return ans
+            raise
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, look at everything
+                return list_dirs(self.dirs)
+            if wd in self.wds and name:
+                ans.add(os.path.join(self.wds[wd], os.fsdecode(name)))
+        return ans
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+def create_watcher(dirs, poll=False, interval=1.0):
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(dirs)
+        except (OSError, AttributeError):
+            pass
+    return PollWatcher(dirs, interval)
+
+class WatchFolder(object):
+
+    def __init__(self, dirs, dirout, dsettings={}, workers=None, settle=2.0,
+            poll=False, interval=1.0, lazy=False, metrics=None, log=print):
+        self.dirs = [os.path.abspath(d) for d in dirs]
+        self.dirout = os.path.abspath(dirout)
+        self.staging = os.path.join(self.dirout, STAGING_DIR)
+        self.dsettings = dsettings
+        self.workers = workers or cpu_count()
+        self.settle = settle
+        self.poll, self.interval = poll, interval
+        self.lazy = lazy
+        self.metrics = metrics or Metrics()
+        self.log = log
+        self.pending = {}       # path -> (size, mtime, time it last changed)
+        self.running = {}       # future -> path
+        self.workdirs = {}      # future -> its staging directory
+        self.jobs = 0
+        self.stuck = {}         # path -> (size, mtime) of done books we could not move
+        self.stopped = False
+
+    def stop(self, *args):
+        self.stopped = True
+
+    def run(self):
+        # anything in staging is a partial book from an earlier run
+        shutil.rmtree(self.staging, ignore_errors=True)
+        os.makedirs(self.staging)
+        watcher = create_watcher(self.dirs, self.poll, self.interval)
+        executor = create_executor(self.workers)
+        signal.signal(signal.SIGTERM, self.stop)
+        self.log('Watching %s (%s), %d workers' % (', '.join(self.dirs),
+            'polling' if isinstance(watcher, PollWatcher) else 'inotify', self.workers))
+        # books dropped while we were not running
+        self.update(list_dirs(self.dirs))
+        try:
+            while not self.stopped:
+                self.update(watcher.wait(min(self.settle, self.interval)))
+                for path in self.ready():
+                    # books of the same name may be scrambled at once, each
+                    # gets its own staging directory
+                    self.jobs += 1
+                    workdir = os.path.join(self.staging, '%d' % self.jobs)
+                    os.mkdir(workdir)
+                    fut = executor.submit(scramble_ebook, path, workdir,
+                        self.dsettings, lazy=self.lazy)
+                    self.running[fut] = path
+                    self.workdirs[fut] = workdir
+                if self.running:
+                    done = wait(list(self.running), timeout=0, return_when=FIRST_COMPLETED)[0]
+                    for fut in done:
+                        self.finish(self.running.pop(fut), fut)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            self.log('Finishing %d running books' % len(self.running))
+            for fut in wait(list(self.running))[0]:
+                self.finish(self.running.pop(fut), fut)
+            executor.shutdown(wait=True)
+            self.metrics.close()
+            shutil.rmtree(self.staging, ignore_errors=True)
+
+    def update(self, paths):
+        now = time.time()
+        for path in paths:
+            if is_candidate(path) and path not in self.running.values():
+                # (re)start the settle clock on anything that moved
+                self.pending.setdefault(path, (None, None, now))
+
+    def ready(self):
+        # books whose size and mtime have been still for `settle` seconds
+        now = time.time()
+        ans = []
+        for path, (size, mtime, since) in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                del self.pending[path]
+                continue
+            if self.stuck.get(path) == (st.st_size, st.st_mtime):
+                del self.pending[path]
+            elif (st.st_size, st.st_mtime) != (size, mtime):
+                self.pending[path] = (st.st_size, st.st_mtime, now)
+            elif now - since >= self.settle and is_complete(path):
+                del self.pending[path]
+                ans.append(path)
+        return ans
+
+    def finish(self, path, fut):
+        dirname, fn, ext, x = get_fileparts(path)
+        try:
+            staged, results, record = fut.result()
+            outpath = commit_output(staged, self.dirout, path)
+        except Exception as err:
+            self.metrics.record_book(failed_book_record(path, get_book_format(path), err))
+            self.write_report(fn + '.' + ext + '.error.txt',
+                'Scrambling %s failed:\n%s: %s\n' % (path, err.__class__.__name__, err))
+            self.move_original(path, FAILED_DIR)
+            self.log('%s: FAILED: %s' % (path, err), file=sys.stderr)
+            return
+        finally:
+            shutil.rmtree(self.workdirs.pop(fut), ignore_errors=True)
+        self.metrics.record_book(record)
+        self.write_report(os.path.basename(outpath) + '.txt',
+            'Scrambled %s\n%s\n' % (path, results))
+        self.move_original(path, DONE_DIR)
+        self.log('%s --> %s' % (path, outpath))
+
+    def write_report(self, name, text):
+        with open(os.path.join(self.dirout, name), 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    def move_original(self, path, subdir):
+        # out of the watched directory, so it is not picked up again
+        dest = os.path.join(os.path.dirname(path), subdir)
+        try:
+            if not os.path.isdir(dest):
+                os.mkdir(dest)
+            atomic_rename(path, os.path.join(dest, os.path.basename(path)))
+        except EnvironmentError as err:
+            try:
+                st = os.stat(path)
+                self.stuck[path] = (st.st_size, st.st_mtime)
+            except EnvironmentError:
+                pass
+            self.log('Could not move %s to %s: %s' % (path, dest, err), file=sys.stderr)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+# An EPUB/KEPUB container backed directly by the source zip.
+# get_container() unpacks the whole book before any work starts. Here a
+# member is only decompressed when it is read: read-only access is served
+# from memory, and a member is only written to the temporary directory
+# when it is parsed, modified or needed as a real file (name_to_abspath).
+# Members never touched are copied straight from the source zip on commit,
+# still compressed.
+
+import mmap
+import os
+import shutil
+import struct
+import zipfile
+from io import BytesIO
+
+from polyglot.builtins import iteritems
+
+from calibre.ebooks.oeb.base import OPF_MIME
+from calibre.ebooks.oeb.polish.container import (Container, EpubContainer,
+    OCF_NS, guess_type, get_container)
+from calibre.ebooks.oeb.polish.utils import name_to_abspath
+from calibre.ptempfile import PersistentTemporaryDirectory
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.logging import default_log
+
+
+class SourceMap(mmap.mmap):
+    ''' A read-only mapping of the source zip '''
+    # zipfile.ZipFile.open() asks, mmap only has it from Python 3.13
+    def seekable(self):
+        return True
+
+
+class ZipEpubContainer(EpubContainer):
+    ''' EpubContainer which extracts members from the source zip on demand '''
+
+    def __init__(self, pathtoepub, log, clone_data=None, tdir=None, use_mmap=False):
+        if clone_data is not None:
+            EpubContainer.__init__(self, None, log, clone_data=clone_data)
+            self.open_source(clone_data['use_mmap'])
+            self.lazy_members = {n:self.zf.getinfo(n) for n in clone_data['lazy_members']}
+            return
+
+        self.pathtoepub = pathtoepub
+        self.is_dir = False
+        if tdir is None:
+            tdir = PersistentTemporaryDirectory('_epub_container')
+        root = os.path.abspath(os.path.realpath(tdir))
+        self.open_source(use_mmap)
+
+        self.lazy_members = {}
+        name_path_map, mime_map = {}, {}
+        for zi in self.zf.infolist():
+            name = zi.filename
+            if name.endswith('/'):
+                continue
+            name_path_map[name] = name_to_abspath(name, root)
+            mime_map[name] = guess_type(name)
+            self.lazy_members[name] = zi
+
+        opf_name = self.find_opf_name(name_path_map)
+        mime_map[opf_name] = guess_type('a.opf')
+        clone_data = {
+            'root': root,
+            'opf_name': opf_name,
+            'mime_map': mime_map,
+            'pretty_print': set(),
+            'encoding_map': {},
+            'tweak_mode': False,
+            'name_path_map': name_path_map,
+            }
+        Container.__init__(self, None, None, log, clone_data=clone_data)
+        # this is not a clone, so nothing is hard linked
+        self.cloned = False
+        self.refresh_mime_map()
+
+        self.obfuscated_fonts = {}
+        if 'META-INF/encryption.xml' in self.name_path_map:
+            self.process_encryption()
+
+    def open_source(self, use_mmap):
+        self.use_mmap = use_mmap
+        self.source_stream = open(self.pathtoepub, 'rb')
+        source = self.source_stream
+        if use_mmap:
+            source = SourceMap(self.source_stream.fileno(), 0, access=mmap.ACCESS_READ)
+        self.zf = zipfile.ZipFile(source)
+
+    def close_source(self):
+        self.zf.close()
+        self.source_stream.close()
+
+    def find_opf_name(self, names):
+        try:
+            root = self.parse_xml(self.zf.read('META-INF/container.xml'))
+            for rf in root.xpath('//ocf:rootfile[@full-path]', namespaces={'ocf':OCF_NS}):
+                if rf.get('media-type', OPF_MIME) == OPF_MIME and rf.get('full-path') in names:
+                    return rf.get('full-path')
+        except KeyError:
+            pass
+        opfs = sorted(n for n in names if n.lower().endswith('.opf'))
+        if not opfs:
+            raise zipfile.BadZipfile('No OPF file found in %s' % self.pathtoepub)
+        return opfs[0]
+
+    def extract_member(self, name):
+        # spill a member to the temporary directory
+        zi = self.lazy_members.pop(name)
+        path = self.name_path_map[name]
+        dirn = os.path.dirname(path)
+        if not os.path.exists(dirn):
+            os.makedirs(dirn)
+        with self.zf.open(zi) as src, open(path, 'wb') as dest:
+            shutil.copyfileobj(src, dest)
+
+    def name_to_abspath(self, name):
+        if name in self.lazy_members:
+            self.extract_member(name)
+        return EpubContainer.name_to_abspath(self, name)
+
+    def parse(self, path, mime):
+        name = self.abspath_to_name(path)
+        if name in self.lazy_members:
+            self.extract_member(name)
+        return EpubContainer.parse(self, path, mime)
+
+    def open(self, name, mode='rb'):
+        if name in self.lazy_members and name not in self.dirtied:
+            if mode in ('r', 'rb'):
+                self.parsed_cache.pop(name, False)
+                return BytesIO(self.zf.read(self.lazy_members[name]))
+            if 'w' in mode and '+' not in mode:
+                # about to be overwritten, no need to extract it first
+                del self.lazy_members[name]
+        return EpubContainer.open(self, name, mode)
+
+    def exists(self, name):
+        return name in self.lazy_members or EpubContainer.exists(self, name)
+
+    def filesize(self, name):
+        if name in self.lazy_members and name not in self.dirtied:
+            return self.lazy_members[name].file_size
+        return EpubContainer.filesize(self, name)
+
+    def remove_item(self, name, remove_from_guide=True):
+        if self.lazy_members.pop(name, None) is not None:
+            path = self.name_path_map[name]
+            dirn = os.path.dirname(path)
+            if not os.path.exists(dirn):
+                os.makedirs(dirn)
+            # empty stand-in for the base class to delete
+            open(path, 'wb').close()
+        return EpubContainer.remove_item(self, name, remove_from_guide=remove_from_guide)
+
+    def clone_data(self, dest_dir):
+        ans = EpubContainer.clone_data(self, dest_dir)
+        ans['lazy_members'] = tuple(self.lazy_members)
+        ans['use_mmap'] = self.use_mmap
+        return ans
+
+    def commit(self, outpath=None, keep_parsed=False):
+        Container.commit(self, keep_parsed=keep_parsed)
+
+        # re-obfuscate fonts while writing the zip, as EpubContainer does
+        restore_fonts = {}
+        for name, (alg, key) in iteritems(self.obfuscated_fonts):
+            if name not in self.name_path_map:
+                continue
+            restore_fonts[name] = data = self.raw_data(name, decode=False)
+            with self.open(name, 'wb') as f:
+                f.write(self.decrypt_font_data(key, data, alg))
+        try:
+            self.write_zip(outpath or self.pathtoepub)
+        finally:
+            for name, data in iteritems(restore_fonts):
+                with self.open(name, 'wb') as f:
+                    f.write(data)
+
+    def write_zip(self, outpath):
+        # source order first, then any new members
+        names = [zi.filename for zi in self.zf.infolist() if zi.filename in self.name_path_map]
+        seen = set(names)
+        names += sorted(n for n in self.name_path_map if n not in seen)
+
+        tmp = outpath + '.tmp'
+        with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zout:
+            zout.writestr(zipfile.ZipInfo('mimetype'), guess_type('a.epub'),
+                compress_type=zipfile.ZIP_STORED)
+            for name in names:
+                if name == 'mimetype':
+                    continue
+                zi = self.lazy_members.get(name)
+                if zi is not None:
+                    copy_member(self.zf, zi, zout)
+                else:
+                    zout.write(self.name_path_map[name], name)
+        atomic_rename(tmp, outpath)
+
+
+def copy_member(zin, zi, zout):
+    # Append a member of zin to zout as its compressed bytes, without
+    # inflating and deflating it again. zipfile has no API for this, so
+    # the local header is written here and the member registered with zout
+    # the way ZipFile.write() does it
+    fp = zin.fp
+    fp.seek(zi.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile('Bad local header for %s' % zi.filename)
+    fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+    nzi = zipfile.ZipInfo(zi.filename, zi.date_time)
+    nzi.compress_type = zi.compress_type
+    nzi.create_system = zi.create_system
+    nzi.external_attr = zi.external_attr
+    nzi.CRC, nzi.compress_size, nzi.file_size = zi.CRC, zi.compress_size, zi.file_size
+    # sizes go in the header, so no data descriptor
+    nzi.flag_bits = 0
+    zip64 = nzi.file_size > zipfile.ZIP64_LIMIT or nzi.compress_size > zipfile.ZIP64_LIMIT
+    nzi.header_offset = zout.fp.tell()
+    zout.fp.write(nzi.FileHeader(zip64))
+    left = zi.compress_size
+    while left > 0:
+        chunk = fp.read(min(left, 1024 * 1024))
+        if not chunk:
+            raise zipfile.BadZipfile('Truncated data for %s' % zi.filename)
+        zout.fp.write(chunk)
+        left -= len(chunk)
+    zout.filelist.append(nzi)
+    zout.NameToInfo[nzi.filename] = nzi
+    zout.start_dir = zout.fp.tell()
+    zout._didModify = True
+
+
+def normalize_zip(path, date_time=(1980, 1, 1, 0, 0, 0)):
+    # Rewrite a zip with fixed timestamps and attributes, so that the same
+    # content always gives the same bytes. Member order and compression
+    # (e.g. a stored mimetype) are kept.
+    tmp = path + '.tmp'
+    with zipfile.ZipFile(path) as zin:
+        with zipfile.ZipFile(tmp, 'w', allowZip64=True) as zout:
+            for zi in zin.infolist():
+                nzi = zipfile.ZipInfo(zi.filename, date_time)
+                nzi.compress_type = zi.compress_type
+                nzi.create_system = 3
+                nzi.external_attr = 0o644 << 16
+                zout.writestr(nzi, zin.read(zi))
+    atomic_rename(tmp, path)
+
+
+def get_book_container(pathtoebook, lazy=False, use_mmap=False, tdir=None):
+    # EPUB/KEPUB can be opened lazily, AZW3 always needs conversion
+    if lazy and pathtoebook.rpartition('.')[-1].lower() in ('epub', 'kepub'):
+        try:
+            return ZipEpubContainer(pathtoebook, default_log, tdir=tdir, use_mmap=use_mmap)
+        except zipfile.BadZipfile:
+            pass
+    return get_container(pathtoebook, tdir=tdir)